@@ -10,8 +10,10 @@ from __future__ import print_function
 
 import os
 import re
+import sys
 import unicodedata
 import uuid
+from itertools import islice
 
 import six
 
@@ -578,6 +580,14 @@ class BaseCorpus(object):
         """
         raise NotImplementedError
 
+    def saveSciDocs(self, docs):
+        """
+            Saves several documents. Override to save them in a single
+            request if the database allows it
+        """
+        for doc in docs:
+            self.saveSciDoc(doc)
+
     def connectToDB(self, suppress_error=False):
         raise NotImplementedError
 
@@ -618,12 +628,35 @@ class BaseCorpus(object):
         """
         raise NotImplementedError
 
+    def getMetadataByGUIDBatch(self, guids, fields=None):
+        """
+            Returns the metadata of several papers as a dict {guid: metadata}
+
+            Subclasses can override this to fetch them in fewer requests, and
+            only the given fields.
+        """
+        return {guid: self.getMetadataByGUID(guid) for guid in guids}
+
     def getMetadataByField(self, field, value):
         """
             Returns a single paper's metadata by any field
         """
         raise NotImplementedError
 
+    def getMetadataByFieldBatch(self, field, values):
+        """
+            Returns the metadata of several papers by any field, as a dict
+            {value: metadata}. Values for which no paper is found are not in it.
+
+            Subclasses can override this to avoid one query per value.
+        """
+        res = {}
+        for value in values:
+            metadata = self.getMetadataByField(field, value)
+            if metadata:
+                res[value] = metadata
+        return res
+
     def listFieldByField(self, field1, field2, value):
         """
             Returns a list: for each paper, field1 if field2==value
@@ -643,6 +676,19 @@ class BaseCorpus(object):
         """
         raise NotImplementedError
 
+    def iterPapers(self, conditions=None, max_results=sys.maxsize):
+        """
+            Like listPapers(), but yields the GUIDs instead of returning them
+            all at once, up to max_results
+        """
+        return islice(self.listPapers(conditions), max_results)
+
+    def countPapers(self, conditions=None):
+        """
+            Returns the number of papers where [conditions]
+        """
+        return len(self.listPapers(conditions))
+
     def runSingleValueQuery(self, query):
         raise NotImplementedError
 
@@ -12,6 +12,8 @@ import sys, json, datetime, re, copy
 
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionTimeout, ConnectionError, TransportError
+from elasticsearch.helpers import bulk
+from .elastic_serializer import serializerOptions
 import requests
 import six.moves.urllib.request, six.moves.urllib.parse, six.moves.urllib.error
 from six import string_types
@@ -38,6 +40,13 @@ ES_TYPE_LINK = "link"
 ES_TYPE_VENUE = "venue"
 ES_TYPE_MISSING_REFERENCES = "missing_reference"
 
+# max number of searches sent in a single multi-search request
+ES_MSEARCH_BATCH_SIZE = 100
+# ids to fetch in each multi-get request
+ES_MGET_BATCH_SIZE = 500
+# SciDocs sent in each bulk request by saveSciDocs(), they can be large
+ES_SCIDOC_BULK_CHUNK_SIZE = 50
+
 index_equivalence = {
     TABLE_PAPERS: {"index": ES_INDEX_PAPERS, "type": ES_TYPE_PAPER, "source": "metadata",
                    "non_nested_fields": ["norm_title", "author_ids", "has_scidoc"]},
@@ -80,8 +89,12 @@ logging.getLogger("requests").setLevel(logging.ERROR)
 logging.getLogger("urllib3").setLevel(logging.ERROR)
 
 
-def buildMetadataDSLQuery(must=None, should=None):
-    if not must and not should:
+def buildMetadataDSLQuery(must=None, should=None, filters=None):
+    """
+        Builds a nested query on the metadata. Clauses in filters must match
+        but aren't scored
+    """
+    if not must and not should and not filters:
         return {"query": {"match_all": {}}}
 
     query = {"query": {
@@ -97,6 +110,8 @@ def buildMetadataDSLQuery(must=None, should=None):
         query["query"]["nested"]["query"]["bool"]["must"] = must
     if should:
         query["query"]["nested"]["query"]["bool"]["should"] = should
+    if filters:
+        query["query"]["nested"]["query"]["bool"]["filter"] = filters
     return query
 
 
@@ -482,11 +497,39 @@ class ElasticCorpus(BaseCorpus):
             except ConnectionTimeout:
                 attempts += 1
 
+    def saveSciDocs(self, docs):
+        """
+            Saves the documents as JSON in the index with bulk requests
+        """
+        self.checkConnectedToDB()
+
+        timestamp = datetime.datetime.now()
+        actions = [{
+            "_op_type": "index",
+            "_index": ES_INDEX_SCIDOCS,
+            "_type": ES_TYPE_SCIDOC,
+            "_id": doc["metadata"]["guid"],
+            "_source": {
+                "scidoc": json.dumps(doc.data),
+                "guid": doc["metadata"]["guid"],
+                "time_created": timestamp,
+                "time_modified": timestamp,
+            }} for doc in docs]
+
+        attempts = 0
+        while attempts < 3:
+            try:
+                bulk(self.es, actions, chunk_size=ES_SCIDOC_BULK_CHUNK_SIZE)
+                break
+            except ConnectionTimeout:
+                attempts += 1
+
     def connectToDB(self, suppress_error=False):
         """
             Connects to database
         """
-        self.es = Elasticsearch([self.endpoint], timeout=self.default_timeout, http_auth=self.http_auth)
+        self.es = Elasticsearch([self.endpoint], timeout=self.default_timeout, http_auth=self.http_auth,
+                                **serializerOptions())
         self.es.retry_on_timeout = True
         # try:
         #     info = self.es.info()
@@ -530,6 +573,36 @@ class ElasticCorpus(BaseCorpus):
         """
         return self.getRecordField(guid, "papers")
 
+    def getMetadataByGUIDBatch(self, guids, fields=None):
+        """
+            Returns the metadata of several papers as a dict {guid: metadata},
+            fetching them in multi-get requests instead of one request each.
+
+            :param fields: if given, only these fields of the metadata are
+                fetched
+        """
+        self.checkConnectedToDB()
+
+        if fields:
+            source = ["metadata." + field for field in fields]
+        else:
+            source = "metadata"
+
+        guids = list(guids)
+        res = {}
+        for batch_start in range(0, len(guids), ES_MGET_BATCH_SIZE):
+            batch = guids[batch_start:batch_start + ES_MGET_BATCH_SIZE]
+            docs = self.es.mget(
+                index=ES_INDEX_PAPERS,
+                doc_type=ES_TYPE_PAPER,
+                body={"ids": batch},
+                _source=source)["docs"]
+
+            for doc in docs:
+                if doc.get("found"):
+                    res[doc["_id"]] = doc["_source"]["metadata"]
+        return res
+
     def getMetadataByField(self, field, value):
         """
             Returns a paper's metadata by any other field
@@ -563,6 +636,43 @@ class ElasticCorpus(BaseCorpus):
 
         return hits[0]["_source"]["metadata"]
 
+    def getMetadataByFieldBatch(self, field, values):
+        """
+            Returns the metadata of several papers by any other field, as a dict
+            {value: metadata}. Runs the same query as getMetadataByField() for
+            every value, but sends them in multi-search requests instead of
+            doing one round-trip per value.
+        """
+        self.checkConnectedToDB()
+
+        values = list(values)
+        res = {}
+        for batch_start in range(0, len(values), ES_MSEARCH_BATCH_SIZE):
+            batch = values[batch_start:batch_start + ES_MSEARCH_BATCH_SIZE]
+            body = []
+            for value in batch:
+                if self.use_dsl_queries:
+                    must = copy.deepcopy(self.dsl_query_filter)
+                    must.append({"match": {field: value}})
+                    query = buildMetadataDSLQuery(must)
+                else:
+                    query = {"query": {"query_string": {"query": self.filterQuery("%s:\"%s\"" % (field, value))}}}
+                query["_source"] = "metadata"
+                query["size"] = 1
+                body.append({})
+                body.append(query)
+
+            responses = self.es.msearch(
+                index=ES_INDEX_PAPERS,
+                doc_type=ES_TYPE_PAPER,
+                body=body)["responses"]
+
+            for value, response in zip(batch, responses):
+                hits = response.get("hits", {}).get("hits", [])
+                if len(hits) > 0:
+                    res[value] = hits[0]["_source"]["metadata"]
+        return res
+
     def setMetadata(self, metadata, op_type="update"):
         """
         Updates the metadata for one paper
@@ -702,37 +812,74 @@ class ElasticCorpus(BaseCorpus):
         prev_max_results = self.max_results
         self.max_results = max_results
 
+        query, query_args = self.buildRecordsQuery(conditions)
+        hits = self.unlimitedQuery(
+            index=es_index,
+            doc_type=es_type,
+            sort=sort,
+            _source=field,
+            **query_args
+        )
+
+        self.max_results = prev_max_results
+
+        return self.abstractNestedResults(query, hits, field)
+
+    def buildRecordsQuery(self, conditions=None):
+        """
+            Returns the query for listRecords() and the like, and the arguments
+            to pass it to elasticsearch with
+
+            :returns: tuple (query, dict of arguments)
+        """
         if isinstance(conditions, string_types):  # assuming not use_dsl_queries
             query = self.filterQuery(conditions)
             # query = conditions
-            hits = self.unlimitedQuery(
-                q=query,
-                index=es_index,
-                doc_type=es_type,
-                sort=sort,
-                _source=field,
-            )
-        else:
-            if isinstance(conditions, dict):
-                conditions = [conditions]
+            return query, {"q": query}
 
-            must = copy.deepcopy(self.dsl_query_filter)
-            if conditions:
-                must.extend(conditions)
+        if isinstance(conditions, dict):
+            conditions = [conditions]
 
-            query = buildMetadataDSLQuery(must)
+        filters = copy.deepcopy(self.dsl_query_filter)
+        if conditions:
+            filters.extend(conditions)
 
-            hits = self.unlimitedQuery(
-                body=query,
-                index=es_index,
-                doc_type=es_type,
+        # results aren't ranked, so there's no need to score them
+        query = buildMetadataDSLQuery(filters=filters)
+        return query, {"body": query}
+
+    def iterRecords(self, conditions=None, field="guid", max_results=sys.maxsize, table=TABLE_PAPERS, sort=None):
+        """
+            Like listRecords(), but yields the results as they are scrolled
+            through instead of collecting them all first
+        """
+        self.checkConnectedToDB()
+
+        query, query_args = self.buildRecordsQuery(conditions)
+        for hits in self.yieldingUnlimitedQuery(
+                index=index_equivalence[table]["index"],
+                doc_type=index_equivalence[table]["type"],
                 sort=sort,
                 _source=field,
-            )
+                max_results=max_results,
+                **query_args):
+            for record in self.abstractNestedResults(query, hits, field):
+                yield record
 
-        self.max_results = prev_max_results
+    def countRecords(self, conditions=None, table=TABLE_PAPERS):
+        """
+            Returns the number of records where [conditions], without
+            retrieving them
+        """
+        self.checkConnectedToDB()
 
-        return self.abstractNestedResults(query, hits, field)
+        query, query_args = self.buildRecordsQuery(conditions)
+        res = self.es.count(
+            index=index_equivalence[table]["index"],
+            doc_type=index_equivalence[table]["type"],
+            **query_args
+        )
+        return res["count"]
 
     def listPapers(self, conditions=None, field="guid", max_results=sys.maxsize, sort=None):
         """
@@ -740,6 +887,18 @@ class ElasticCorpus(BaseCorpus):
         """
         return self.listRecords(conditions, field, max_results, "papers", sort)
 
+    def iterPapers(self, conditions=None, field="guid", max_results=sys.maxsize, sort=None):
+        """
+            Yields the GUIDs in papers table where [conditions]
+        """
+        return self.iterRecords(conditions, field, max_results, "papers", sort)
+
+    def countPapers(self, conditions=None):
+        """
+            Returns the number of papers where [conditions]
+        """
+        return self.countRecords(conditions, "papers")
+
     def runSingleValueQuery(self, query):
         raise NotImplementedError
 
@@ -1101,11 +1260,15 @@ class ElasticCorpus(BaseCorpus):
 
     def yieldingUnlimitedQuery(self, *args, **kwargs):
         """
-            Unlimited query that yields results as they arrive
+            Unlimited query that yields results as they arrive, one page of
+            hits at a time
+
+            :param max_results: stop after this many hits, defaults to self.max_results
         """
         scroll_time = "20m"
 
-        size = min(self.max_results, 10000)
+        max_results = kwargs.pop("max_results", self.max_results)
+        size = min(max_results, 10000)
 
         sort = ["_doc"]
 
@@ -1122,15 +1285,17 @@ class ElasticCorpus(BaseCorpus):
             **kwargs
         )
 
-        results = res['hits']['hits']
-        scroll_size = res['hits']['total']
-        while (scroll_size > 0) and len(results) < self.max_results:
+        hits = res['hits']['hits']
+        num_yielded = 0
+        while hits and num_yielded < max_results:
+            hits = hits[:max_results - num_yielded]
+            yield hits
+            num_yielded += len(hits)
+            if num_yielded >= max_results:
+                break
             try:
-                scroll_id = res['_scroll_id']
-                rs = self.es.scroll(scroll_id=scroll_id, scroll=scroll_time)
-                res = rs
-                yield rs['hits']['hits'], scroll_size
-                scroll_size = len(rs['hits']['hits'])
+                res = self.es.scroll(scroll_id=res['_scroll_id'], scroll=scroll_time)
+                hits = res['hits']['hits']
             except Exception as e:
                 print(e)
                 break
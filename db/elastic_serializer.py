@@ -0,0 +1,40 @@
+# Faster JSON decoding of Elasticsearch responses
+#
+# Copyright:   (c) Daniel Duma 2016
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ORJSONSerializer(JSONSerializer):
+    """
+        Parses responses with orjson, which matters for the huge nested
+        explanations returned with explain=True. Requests are still encoded
+        by JSONSerializer, which knows about dates, decimals, etc.
+    """
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except ValueError as e:
+            raise SerializationError(s, e)
+
+
+def serializerOptions():
+    """
+        Returns the keyword arguments to create an Elasticsearch client with,
+        so it uses ORJSONSerializer if orjson is installed
+    """
+    if orjson is None:
+        return {}
+    return {"serializer": ORJSONSerializer()}
@@ -12,6 +12,7 @@ import json, sys, time, os, glob
 
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionTimeout, ConnectionError, TransportError
+from .elastic_serializer import serializerOptions
 from proc.nlp_functions import AZ_ZONES_LIST, CORESC_LIST, RANDOM_ZONES_7, RANDOM_ZONES_11
 from proc.general_utils import ensureDirExists
 
@@ -22,6 +23,16 @@ from six.moves import range
 DEFAULT_TIMEOUT = 600
 
 
+def createElasticClient(endpoint):
+    """
+        Returns a new Elasticsearch client for the endpoint, as used by
+        ElasticResultStorer. A single client can be shared by many storers.
+    """
+    es = Elasticsearch([endpoint], timeout=DEFAULT_TIMEOUT, **serializerOptions())
+    es.retry_on_timeout = True
+    return es
+
+
 def createResultStorers(exp_name, exp_random_zoning=False, clear_existing_prr_results=False):
     """
         Returns a dict with instances of ElasticResultStorer
@@ -29,28 +40,30 @@ def createResultStorers(exp_name, exp_random_zoning=False, clear_existing_prr_re
         :param exp_name:
         :string
     """
+    # all storers share the same connection
+    es = createElasticClient(cp.Corpus.endpoint)
     writers = {}
     if exp_random_zoning:
         for div in RANDOM_ZONES_7:
-            writers["RZ7_" + div] = ElasticResultStorer(exp_name, "prr_az_rz11", endpoint=cp.Corpus.endpoint)
+            writers["RZ7_" + div] = ElasticResultStorer(exp_name, "prr_az_rz11", endpoint=cp.Corpus.endpoint, es=es)
             if clear_existing_prr_results:
                 writers["RZ7_" + div].clearResults()
         for div in RANDOM_ZONES_11:
-            writers["RZ11_" + div] = ElasticResultStorer(exp_name, "prr_rz11", endpoint=cp.Corpus.endpoint)
+            writers["RZ11_" + div] = ElasticResultStorer(exp_name, "prr_rz11", endpoint=cp.Corpus.endpoint, es=es)
             if clear_existing_prr_results:
                 writers["RZ11_" + div].clearResults()
     else:
         for div in AZ_ZONES_LIST:
-            writers["az_" + div] = ElasticResultStorer(exp_name, "prr_az_" + div, endpoint=cp.Corpus.endpoint)
+            writers["az_" + div] = ElasticResultStorer(exp_name, "prr_az_" + div, endpoint=cp.Corpus.endpoint, es=es)
             if clear_existing_prr_results:
                 writers["az_" + div].clearResults()
         for div in CORESC_LIST:
             writers["csc_type_" + div] = ElasticResultStorer(exp_name, "prr_csc_type_" + div,
-                                                             endpoint=cp.Corpus.endpoint)
+                                                             endpoint=cp.Corpus.endpoint, es=es)
             if clear_existing_prr_results:
                 writers["csc_type_" + div].clearResults()
 
-    writers["ALL"] = ElasticResultStorer(exp_name, "prr_ALL", endpoint=cp.Corpus.endpoint)
+    writers["ALL"] = ElasticResultStorer(exp_name, "prr_ALL", endpoint=cp.Corpus.endpoint, es=es)
     if clear_existing_prr_results:
         writers["ALL"].clearResults()
 
@@ -62,7 +75,11 @@ class ElasticResultStorer(object):
         Class to store results in Elasticsearch
     """
 
-    def __init__(self, namespace, table_name, endpoint={"host": "localhost", "port": 9200}):
+    def __init__(self, namespace, table_name, endpoint={"host": "localhost", "port": 9200}, es=None):
+        """
+            :param es: an existing Elasticsearch client to use instead of opening
+                a new connection, see createElasticClient()
+        """
 
         assert isinstance(namespace, six.string_types)
         assert isinstance(table_name, six.string_types)
@@ -73,16 +90,16 @@ class ElasticResultStorer(object):
         self.index_name = namespace.lower() + "_" + table_name.lower()
 
         self.endpoint = endpoint
-        self.es = None
-        self.connect()
+        self.es = es
+        if self.es is None:
+            self.connect()
         self.createTable()
 
     def connect(self):
         """
             Connect to elasticsearch server
         """
-        self.es = Elasticsearch([self.endpoint], timeout=DEFAULT_TIMEOUT)
-        self.es.retry_on_timeout = True
+        self.es = createElasticClient(self.endpoint)
 
     def refreshIndex(self):
         self.es.indices.refresh(index=self.index_name)
@@ -289,7 +306,8 @@ class ResultIncrementalReader(object):
         """
         """
         self.result_storer = result_storer
-        if res_ids:
+        # an empty list of ids is a valid (empty) subset, not a request to list everything
+        if res_ids is not None:
             self.res_ids = res_ids
         else:
             self.res_ids = result_storer.getResultList(max_results=max_results)
@@ -373,12 +391,27 @@ class ResultDiskReader(ResultIncrementalReader):
         """
         res_path = os.path.join(self.own_dir, res_id + ".json")
         if os.path.exists(res_path):
-            return json.load(open(res_path, "r"))
+            with open(res_path, "r") as f:
+                return json.load(f)
         else:
             res = self.result_storer.getResult(res_id)
-            json.dump(res, open(res_path, "w"))
+            self.saveItem(res_path, res)
             return res
 
+    def saveItem(self, res_path, res):
+        """
+            Writes the item to a temporary file and then renames it, so other
+            processes reading the same cache never see a half-written file
+        """
+        temp_path = "%s.%d.tmp" % (res_path, os.getpid())
+        with open(temp_path, "w") as f:
+            json.dump(res, f)
+        try:
+            os.rename(temp_path, res_path)
+        except OSError:
+            # on Windows the rename fails if another process cached it first
+            os.remove(temp_path)
+
     def subset(self, items):
         """
             Selects a subset of the items it holds, returns a new instance with
@@ -407,7 +440,7 @@ class ResultDiskReader(ResultIncrementalReader):
             res_path = os.path.join(self.own_dir, res_id + ".json")
             if not os.path.exists(res_path):
                 res = self.result_storer.getResult(res_id)
-                json.dump(res, open(res_path, "w"))
+                self.saveItem(res_path, res)
 
 
 class OfflineResultReader(ResultIncrementalReader):
@@ -314,11 +314,11 @@ class AtharQueryGenerator(QueryGenerator):
             Args:
                 guid: self-explanatory
             Returns:
-                (doc, doctext, precomputed_file)
+                (doc, doctext, precomputed_file), or None if cannot load doc
         """
         doc=self.loadSciDoc(guid) # load the SciDoc JSON from the corpus
         if not doc:
-            raise ValueError("ERROR: Couldn't load SciDoc: %s" % guid)
+            return None
 
         doctext=doc.formatTextForExtraction(doc.getFullDocumentText()) #  store a plain text representation
 
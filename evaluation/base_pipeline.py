@@ -8,7 +8,7 @@
 from __future__ import print_function
 
 from __future__ import absolute_import
-import os, sys, json
+import os, sys
 from copy import deepcopy
 from collections import defaultdict
 
@@ -16,6 +16,7 @@ from retrieval.base_retrieval import BaseRetrieval, MAX_RESULTS_RECALL
 
 import db.corpora as cp
 from proc.results_logging import ResultsLogger
+from proc.general_utils import loadListFile, loadDictFile
 from .pipeline_functions import getDictOfTestingMethods
 from .weight_functions import addExtraWeights
 from six.moves import range
@@ -137,7 +138,7 @@ class BaseTestingPipeline(object):
             precomputed_queries_file_path = os.path.join(self.exp["exp_dir"],
                                                          self.exp.get("precomputed_queries_filename",
                                                                       "precomputed_queries.json"))
-        self.precomputed_queries = json.load(open(precomputed_queries_file_path, "r"))
+        self.precomputed_queries = loadListFile(precomputed_queries_file_path)
 
         self.precomputed_queries = self.precomputed_queries[self.options.get("run_query_start_at", 0):]
 
@@ -146,7 +147,7 @@ class BaseTestingPipeline(object):
             self.precomputed_queries = self.precomputed_queries[:max_queries_to_process]
 
         files_dict_filename = os.path.join(self.exp["exp_dir"], self.exp.get("files_dict_filename", "files_dict.json"))
-        self.files_dict = json.load(open(files_dict_filename, "r"))
+        self.files_dict = loadDictFile(files_dict_filename)
         self.files_dict["ALL_FILES"] = {}
 
     def populateMethods(self):
@@ -73,6 +73,7 @@ class Experiment(object):
         self.query_generator = QueryGenerator()
         self.query_generator.options["force_regenerate_resolvable_citations"] = self.options.get(
             "force_regenerate_resolvable_citations", False)
+        self.query_generator.options["num_processes"] = self.options.get("query_generation_processes", 1)
 
     def processCommandLineArguments(self):
         """
@@ -193,7 +194,12 @@ class Experiment(object):
             import retrieval.elastic_retrieval as retrieval_classes
             class_name = self.exp.get("retrieval_class", "ElasticRetrievalBoost")
 
-            self.indexer = ElasticIndexer(endpoint=cp.Corpus.endpoint, use_celery=self.use_celery)
+            from retrieval.elastic_writer import DEFAULT_BULK_CHUNK_SIZE, DEFAULT_BULK_MAX_CHUNK_BYTES
+            self.indexer = ElasticIndexer(endpoint=cp.Corpus.endpoint, use_celery=self.use_celery,
+                                          bulk_chunk_size=options.get("index_bulk_chunk_size",
+                                                                      DEFAULT_BULK_CHUNK_SIZE),
+                                          bulk_max_chunk_bytes=options.get("index_bulk_max_chunk_bytes",
+                                                                           DEFAULT_BULK_MAX_CHUNK_BYTES))
             self.retrieval_class = getattr(retrieval_classes, class_name)
 
         elif cp.Corpus.__class__.__name__ == "LocalCorpus":
@@ -8,9 +8,10 @@
 from __future__ import print_function
 
 from __future__ import absolute_import
-import json, os, time
+import os, time
 
 from .base_pipeline import BaseTestingPipeline
+from proc.general_utils import loadListFile, loadDictFile
 from retrieval.base_retrieval import BaseRetrieval
 
 from celery.result import ResultSet
@@ -49,12 +50,14 @@ class PrecomputedPipeline(BaseTestingPipeline):
                                                                       "precomputed_queries.json"))
 
         if "ALL" in self.exp.get("queries_to_process", ["ALL"]):
-            self.precomputed_queries = json.load(open(precomputed_queries_file_path, "r"))  # [:1]
+            self.precomputed_queries = loadListFile(precomputed_queries_file_path)  # [:1]
             # self.precomputed_queries = self.precomputed_queries[self.options.get("run_query_start_at", 0):]
         ##            precomputed_queries=json.load(open(self.exp["exp_dir"]+"precomputed_queries.json","r"))
         else:
-            queries_filename = "queries_by_" + self.exp["queries_classification"] + ".json"
-            queries_by_zone = json.load(open(self.exp["exp_dir"] + queries_filename, "r"))
+            # same format as the precomputed queries file
+            queries_filename = ("queries_by_" + self.exp["queries_classification"] +
+                                os.path.splitext(precomputed_queries_file_path)[1])
+            queries_by_zone = loadDictFile(self.exp["exp_dir"] + queries_filename)
             self.precomputed_queries = []
             for zone in queries_by_zone[self.exp["queries_to_process"]]:
                 self.precomputed_queries.extend(queries_by_zone[zone])
@@ -68,7 +71,7 @@ class PrecomputedPipeline(BaseTestingPipeline):
         print("Total precomputed queries: ", len(self.precomputed_queries))
 
         files_dict_filename = os.path.join(self.exp["exp_dir"], self.exp.get("files_dict_filename", "files_dict.json"))
-        self.files_dict = json.load(open(files_dict_filename, "r"))
+        self.files_dict = loadDictFile(files_dict_filename)
         self.files_dict["ALL_FILES"] = {}
 
         assert self.exp["name"] != "", "Experiment needs a name!"
@@ -8,15 +8,18 @@
 from __future__ import print_function
 
 from __future__ import absolute_import
-import math, os, random, json
-from copy import deepcopy
-from collections import defaultdict, OrderedDict
+import os, random
+from six.moves import intern
+import multiprocessing
+from collections import defaultdict
 
 import db.corpora as cp
 from proc.results_logging import ProgressIndicator
+from proc.general_utils import (saveJSON, loadJSON, saveDictFile, openListFileWriter, openDictFileWriter,
+                                 syncFile)
 # from tqdm import tqdm
 from proc.nlp_functions import AZ_ZONES_LIST, CORESC_LIST, RANDOM_ZONES_7, RANDOM_ZONES_11
-from proc.doc_representation import findCitationInFullTextXML, findCitationInFullTextUnderscores
+from proc.doc_representation import findAllCitationsInFullText
 from scidoc.citation_utils import getAuthorNamesAsOneString
 from .base_pipeline import getDictOfTestingMethods
 from importing.fix_citations import fixDocRemovedCitations
@@ -24,6 +27,19 @@ from proc.keyphrase_annotation import getMatchingKPsInContext
 
 GLOBAL_FILE_COUNTER = 0
 
+# the annotations of the citing sentence that the queries are indexed by in the queries_by_* files
+QUERY_ANNOTATION_TYPES = ["az", "cfc", "csc_type", "csc_adv", "csc_nov"]
+
+
+def internString(value):
+    """
+        Interns the values that repeat across many queries (annotation labels, method
+        names, guids) so that all the queries share a single copy of each string
+    """
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
 
 class QueryGenerator(object):
     """
@@ -38,61 +54,105 @@ class QueryGenerator(object):
                         "add_full_sentences": False,
                         "force_regenerate_resolvable_citations": False}
         self.exclude_sources_targets = {}
-        self.precomputed_queries = []
+        self.queries_by = {}
+        self.queries_writer = None
+        self.files_writer = None
+        self.qmethods_by_extractor = []
+        self.numchunks = 10
 
-    def saveAllQueries(self):
+    def groupQueryMethodsByExtractor(self, qmethods):
+        """
+            Groups the query methods by the extractor instance they use.
+
+            :param qmethods: exp["qmethods"] dict, with the extractors already bound
+            :returns: list of (extractor, [(method_name, method), ...]) tuples
         """
-            Dumps all precomputed queries to disk.
+        groups = []
+        for method_name, method in qmethods.items():
+            for extractor, methods in groups:
+                if extractor is method["extractor"]:
+                    methods.append((method_name, method))
+                    break
+            else:
+                groups.append((method["extractor"], [(method_name, method)]))
+        return groups
+
+    def createQueryIndexes(self):
+        """
+            Creates the empty queries_by_* indexes, which are filled in as the queries
+            are generated
         """
-        json.dump(self.precomputed_queries,
-                  open(os.path.join(self.exp["exp_dir"],
-                                    self.exp.get("precomputed_queries_filename", "precomputed_queries.json")), "w"))
         queries_by = {}
-        annot_types = ["az", "cfc", "csc_type", "csc_adv", "csc_nov"]
-        for annot_type in annot_types:
-            queries_by[annot_type] = defaultdict(lambda: [])
+        if self.exp.get("use_rhetorical_annotation", False):
+            for annot_type in QUERY_ANNOTATION_TYPES:
+                queries_by[annot_type] = defaultdict(list)
 
         if self.exp.get("random_zoning", False):
-            queries_by["rz7"] = defaultdict(lambda: [])
-            queries_by["rz11"] = defaultdict(lambda: [])
-        if self.exp.get("use_rhetorical_annotation", False):
-            for precomputed_query in self.precomputed_queries:
-                for annot_type in annot_types:
-                    if precomputed_query.get(annot_type, "") != "":
-                        queries_by[annot_type][precomputed_query[annot_type]].append(precomputed_query)
+            queries_by["rz7"] = defaultdict(list)
+            queries_by["rz11"] = defaultdict(list)
+        return queries_by
 
-                if self.exp.get("random_zoning", False):
-                    queries_by["rz7"][random.choice(RANDOM_ZONES_7)].append(precomputed_query)
-                    queries_by["rz11"][random.choice(RANDOM_ZONES_11)].append(precomputed_query)
+    def addGeneratedQueries(self, queries):
+        """
+            Streams the generated queries to the precomputed queries file as they come
+            and adds them to the queries_by_* indexes
+        """
+        use_rhetorical_annotation = self.exp.get("use_rhetorical_annotation", False)
+        random_zoning = self.exp.get("random_zoning", False)
+        queries_by = self.queries_by
 
-        json.dump(self.files_dict,
-                  open(os.path.join(self.exp["exp_dir"], self.exp.get("files_dict_filename", "files_dict.json")), "w"))
+        for query in queries:
+            self.queries_writer.write(query)
+
+            if use_rhetorical_annotation:
+                for annot_type in QUERY_ANNOTATION_TYPES:
+                    if query.get(annot_type, "") != "":
+                        queries_by[annot_type][query[annot_type]].append(query)
+
+                if random_zoning:
+                    queries_by["rz7"][random.choice(RANDOM_ZONES_7)].append(query)
+                    queries_by["rz11"][random.choice(RANDOM_ZONES_11)].append(query)
+
+    def saveAllQueries(self):
+        """
+            Finishes writing the precomputed queries file and dumps everything else to disk.
+        """
+        # these are the final outputs of query generation, so make sure they are on disk
+        # before the next stage of the experiment starts reading them
+        self.queries_writer.close(sync=True)
+        self.queries_writer = None
+        self.files_writer.close(sync=True)
+        self.files_writer = None
+
+        # the queries_by_* files are saved in the same format as the precomputed queries
+        ext = os.path.splitext(self.exp.get("precomputed_queries_filename", "precomputed_queries.json"))[1]
         if self.exp.get("use_rhetorical_annotation", False):
-            for annot_type in annot_types:
-                json.dump(queries_by[annot_type],
-                          open(os.path.join(self.exp["exp_dir"], "queries_by_%s.json" % annot_type), "w"))
+            for annot_type in QUERY_ANNOTATION_TYPES:
+                saveDictFile(self.queries_by[annot_type],
+                             os.path.join(self.exp["exp_dir"], "queries_by_%s%s" % (annot_type, ext)),
+                             sync=True)
 
         if self.exp.get("random_zoning", False):
-            json.dump(queries_by["rz7"], open(os.path.join(self.exp["exp_dir"], "queries_by_rz7.json"), "w"))
-            json.dump(queries_by["rz11"], open(os.path.join(self.exp["exp_dir"], "queries_by_rz11.json"), "w"))
+            saveDictFile(self.queries_by["rz7"], os.path.join(self.exp["exp_dir"], "queries_by_rz7" + ext),
+                         sync=True)
+            saveDictFile(self.queries_by["rz11"], os.path.join(self.exp["exp_dir"], "queries_by_rz11" + ext),
+                         sync=True)
 
-        json.dump(self.exclude_sources_targets,
-                  open(os.path.join(self.exp["exp_dir"], "exclude_sources_targets.json"), "w"))
+        saveJSON(self.exclude_sources_targets,
+                 os.path.join(self.exp["exp_dir"], "exclude_sources_targets.json"), sync=True)
 
     def loadDocAndResolvableCitations(self, guid):
         """
             Deals with all the loading of the SciDoc.
 
-            Throws ValueError if cannot load doc.
-
             :param guid: GUID of the doc to load
-            :returns (doc, doctext, precomputed_file)
+            :returns (doc, doctext, precomputed_file), or None if cannot load doc
             :rtype: tuple
         """
         doc = cp.Corpus.loadSciDoc(guid, ignore_errors=[
             "error_match_citation_with_reference"])  # load the SciDoc JSON from the cp.Corpus
         if not doc:
-            raise ValueError("ERROR: Couldn't load pickled doc: %s" % guid)
+            return None
 
         doctext = doc.formatTextForExtraction(doc.getFullDocumentText())  # store a plain text representation
 
@@ -115,35 +175,42 @@ class QueryGenerator(object):
             :param queries: the returned queries, as generated by extractMulti()
             :param precomputed_query: pre-filled dict with other values to be incorporated in the final dict
         """
-        base_dict = {"az": parent_s.get("az", "").strip(),
-                     "cfc": cit_dict.get("cfunc", ""),
-                     "csc_type": parent_s.get("csc_type", "").strip(),
-                     "csc_adv": parent_s.get("csc_adv", ""),
-                     "csc_nov": parent_s.get("csc_nov", ""),
-                     }
+        # built once per citation as a tuple of pairs, then merged into every query.
+        # The annotation fields are only read when the experiment uses rhetorical annotation
+        if self.exp.get("use_rhetorical_annotation", False):
+            base_items = (("az", internString(parent_s.get("az", "").strip())),
+                          ("cfc", internString(cit_dict.get("cfunc", ""))),
+                          ("csc_type", internString(parent_s.get("csc_type", "").strip())),
+                          ("csc_adv", internString(parent_s.get("csc_adv", ""))),
+                          ("csc_nov", internString(parent_s.get("csc_nov", ""))),
+                          )
+        else:
+            base_items = ()
 
         generated_queries = []
 
         # for every generated query for this context
         for qmethod in queries:
-            this_query = deepcopy(precomputed_query)
-            this_query["query_method"] = qmethod
-            this_query["query_text"] = queries[qmethod].get("text", "")
-            this_query["vis_text"] = queries[qmethod].get("vis_text", "")
-            # print("bam",this_query["vis_text"])
-            this_query["structured_query"] = queries[qmethod]["structured_query"]
-            if "keyphrases" in queries[qmethod]:
-                this_query["keyphrases"] = queries[qmethod]["keyphrases"]
-            this_query["doc_position"] = doc_position
-            for key in base_dict:
-                this_query[key] = base_dict[key]
+            query = queries[qmethod]
+            # precomputed_query only holds scalars and the match_guids list, which is never
+            # modified, so a shallow copy is all that's needed
+            this_query = dict(precomputed_query,
+                              query_method=internString(qmethod),
+                              query_text=query.get("text", ""),
+                              vis_text=query.get("vis_text", ""),
+                              structured_query=query["structured_query"],
+                              doc_position=doc_position)
+            if "keyphrases" in query:
+                this_query["keyphrases"] = query["keyphrases"]
+            if base_items:
+                this_query.update(base_items)
 
             # for every method used for extracting BOWs
             generated_queries.append(this_query)
 
         return generated_queries
 
-    def generateQueriesForCitation(self, citation, doc, doctext, precomputed_query):
+    def generateQueriesForCitation(self, citation, doc, doctext, precomputed_query, citation_matches=None):
         """
             Generate all queries for a resolvable citation.
 
@@ -155,21 +222,25 @@ class QueryGenerator(object):
             :type doctext:basestring
             :param precomputed_query: pre-filled dict
             :type precomputed_query:dict
+            :param citation_matches: the result of findAllCitationsInFullText(doctext),
+                computed here if not passed
+            :type citation_matches:dict
         """
         queries = {}
         generated_queries = []
+        cit = citation["cit"]
+        cit_id = str(cit["id"]).lower()
 
-        match = findCitationInFullTextXML(citation["cit"], doctext)
-        if not match:
-            match = findCitationInFullTextUnderscores(citation["cit"], doctext)
+        if citation_matches is None:
+            citation_matches = findAllCitationsInFullText(doctext)
+
+        match = citation_matches.get(cit_id)
         if not match:
-            print("Weird! can't find citation in text!", citation["cit"])
+            print("Weird! can't find citation in text!", cit)
             print("Fixing document ", doc["metadata"]["guid"])
             fixDocRemovedCitations(doc)
             doctext = doc.formatTextForExtraction(doc.getFullDocumentText())
-            match = findCitationInFullTextXML(citation["cit"], doctext)
-            if not match:
-                match = findCitationInFullTextUnderscores(citation["cit"], doctext)
+            match = findAllCitationsInFullText(doctext).get(cit_id)
             if not match:
                 print("Failed to fix for this citation")
                 return generated_queries
@@ -178,44 +249,49 @@ class QueryGenerator(object):
 
         # this is where we are in the document
         position = match.start()
-        doc_position = math.floor((position / float(len(doctext))) * self.exp.get("numchunks", 10)) + 1
-
-        # generate all the queries from the contexts
-        for method_name in self.exp["qmethods"]:
-            method = self.exp["qmethods"][method_name]
-
-            params = {
-                "method_name": method_name,
-                "match_start": match.start(),
-                "match_end": match.end(),
-                "doctext": doctext,
-                "docfrom": doc,
-                "cit": citation["cit"],
-                "dict_key": "text",
-                "parameters": method["parameters"],
-                "separate_by_tag": method.get("separate_by_tag", ""),
-                "options": self.options
-            }
-
-            all_queries = method["extractor"].extractMulti(params)
+        doc_position = (position * self.numchunks) // len(doctext) + 1
+
+        # these are the same for every query method
+        base_params = {
+            "match_start": match.start(),
+            "match_end": match.end(),
+            "doctext": doctext,
+            "docfrom": doc,
+            "cit": cit,
+            "dict_key": "text",
+            "options": self.options
+        }
+
+        # generate all the queries from the contexts, all methods that share an extractor at once
+        for extractor, methods in self.qmethods_by_extractor:
+            all_queries = extractor.extractMultiBatch(base_params, methods)
             for query in all_queries:
                 queries[query["query_method_id"]] = query
 
-        parent_s = doc.element_by_id[citation["cit"]["parent_s"]]
-        cit_dict = doc.citation_by_id[citation["cit"]["id"]]
+        parent_s = doc.element_by_id[cit["parent_s"]]
+        cit_dict = doc.citation_by_id[cit["id"]]
         generated_queries = self.makeIndividualDictForEachQuery(cit_dict, parent_s, queries, precomputed_query,
                                                                 doc_position)
 
         return generated_queries
 
-    def processOneFile(self, guid):
+    def generateQueriesForFile(self, guid, max_citations):
         """
-            Precompute the queries for a single test document
+            Precompute the queries for a single test document. This doesn't modify the
+            state of the generator, so it can run in a worker process: the results are
+            added with addFileQueries()
 
             :param guid: GUID of the document to process
             :type guid: string
+            :param max_citations: maximum number of citations to generate queries for
+            :returns: dict with the precomputed_file, the authors of the document and a
+                list of (match_guids, queries) tuples, one per citation. None if cannot load doc
+            :rtype: dict
         """
-        doc, doctext, citations_data = self.loadDocAndResolvableCitations(guid)
+        loaded = self.loadDocAndResolvableCitations(guid)
+        if loaded is None:
+            return None
+        doc, doctext, citations_data = loaded
 
         resolvable = citations_data["resolvable"]  # list of resolvable citations
         in_collection_references = citations_data["outlinks"]  # list of cited documents (refereces)
@@ -235,10 +311,15 @@ class QueryGenerator(object):
                                                              self.exp["full_corpus"])
                 precomputed_file["tfidf_models"].append({"method": method, "actual_dir": actual_dir})
 
-        self.files_dict[guid] = precomputed_file
+        citation_matches = findAllCitationsInFullText(doctext)
 
-        citations_processed = 0
-        citations_ignored = 0
+        file_queries = {"guid": guid,
+                        "doc_guid": doc.metadata["guid"],
+                        "authors": getAuthorNamesAsOneString(doc.metadata),
+                        "precomputed_file": precomputed_file,
+                        "citations": [],
+                        "citations_ignored": 0,
+                        }
 
         for citation in resolvable:
             if citation["cit"].get("multi", 1) < self.exp.get("resolvable_cit_min_multi", 1):
@@ -246,38 +327,108 @@ class QueryGenerator(object):
                 #                                                citation["cit"].get("multi", 1),
                 #                                                self.exp.get("resolvable_cit_min_multi", 1),
                 #                                                ))
-                citations_ignored += 1
+                file_queries["citations_ignored"] += 1
                 continue
-            citations_processed += 1
 
             if not "match_guids" in citation:
                 citation["match_guids"] = [citation["match_guid"]]
 
-            precomputed_query = {"file_guid": guid,
+            if len(file_queries["citations"]) >= max_citations:
+                # still recorded for exclude_sources_targets, but no queries are generated
+                file_queries["citations"].append((citation["match_guids"], None))
+                break
+
+            precomputed_query = {"file_guid": internString(guid),
                                  "citation_id": citation["cit"]["id"],
                                  "match_guids": citation["match_guids"],
                                  "citation_multi": citation["cit"].get("multi", 1),
                                  }
-            for match_guid in citation["match_guids"]:
+            file_queries["citations"].append((citation["match_guids"],
+                                              self.generateQueriesForCitation(citation,
+                                                                              doc,
+                                                                              doctext,
+                                                                              precomputed_query,
+                                                                              citation_matches)))
+        return file_queries
+
+    def addFileQueries(self, file_queries):
+        """
+            Adds the results of generateQueriesForFile() to the files_dict file, the
+            exclude_sources_targets and the precomputed queries
+
+            :param file_queries: dict returned by generateQueriesForFile()
+        """
+        guid = file_queries["guid"]
+        self.files_writer.write(guid, file_queries["precomputed_file"])
+        authors = file_queries["authors"]
+
+        citations_processed = 0
+        for match_guids, queries in file_queries["citations"]:
+            citations_processed += 1
+            for match_guid in match_guids:
                 self.exclude_sources_targets[match_guid] = self.exclude_sources_targets.get(match_guid, {"authors": [],
                                                                                                          "guids_from": []})
-                authors = getAuthorNamesAsOneString(doc.metadata)
                 try:
                     self.exclude_sources_targets[match_guid]["authors"].append(authors[0])
-                    self.exclude_sources_targets[match_guid]["guids_from"].append(doc.metadata["guid"])
+                    self.exclude_sources_targets[match_guid]["guids_from"].append(file_queries["doc_guid"])
                 except Exception as e:
                     print(e)
 
-            if self.citations_processed >= self.exp.get("max_queries_generated", 10000000):
-                return
-            self.precomputed_queries.extend(self.generateQueriesForCitation(citation,
-                                                                            doc,
-                                                                            doctext,
-                                                                            precomputed_query))
+            if queries is None or self.citations_processed >= self.exp.get("max_queries_generated", 10000000):
+                break
+            self.addGeneratedQueries(queries)
             self.citations_processed += 1
 
         if self.exp.get("resolvable_cit_min_multi", 1) > 1:
-            print("Multi: %d \tIgnored: %d \tTotal: %d" % (citations_processed, citations_ignored, self.citations_processed))
+            print("Multi: %d \tIgnored: %d \tTotal: %d" % (citations_processed,
+                                                            file_queries["citations_ignored"],
+                                                            self.citations_processed))
+
+    def processOneFile(self, guid):
+        """
+            Precompute the queries for a single test document
+
+            :param guid: GUID of the document to process
+            :type guid: string
+            :returns: False if cannot load doc
+        """
+        max_citations = self.exp.get("max_queries_generated", 10000000) - self.citations_processed
+        file_queries = self.generateQueriesForFile(guid, max_citations)
+        if file_queries is None:
+            return False
+
+        self.addFileQueries(file_queries)
+        return True
+
+    def processFilesInParallel(self, guids, num_processes):
+        """
+            Generates the queries for the documents in a pool of worker processes,
+            yielding the results in order as they become available
+
+            :param guids: list of document GUIDs
+            :param num_processes: number of worker processes
+        """
+        max_citations = self.exp.get("max_queries_generated", 10000000)
+        pool = multiprocessing.Pool(num_processes, initializer=initQueryGenerationWorker, initargs=(self,))
+        try:
+            for file_queries in pool.imap(generateQueriesForFileInWorker,
+                                          [(guid, max_citations) for guid in guids],
+                                          chunksize=QUERY_GENERATION_CHUNKSIZE):
+                yield file_queries
+        finally:
+            pool.terminate()
+
+    def __getstate__(self):
+        """
+            Workers only need what's required to generate queries, not the open file
+            or the queries accumulated so far
+        """
+        state = self.__dict__.copy()
+        state["queries_writer"] = None
+        state["files_writer"] = None
+        state["queries_by"] = {}
+        state["exclude_sources_targets"] = {}
+        return state
 
     def generateQueries(self, exp):
         """
@@ -290,15 +441,22 @@ class QueryGenerator(object):
         print("Generating queries...")
 
         logger = ProgressIndicator(True, numitems=len(exp["test_files"]))  # init all the logging/counting
-        logger.numchunks = exp.get("numchunks", 10)
+        self.numchunks = exp.get("numchunks", 10)
+        logger.numchunks = self.numchunks
 
         cp.Corpus.loadAnnotators(self.exp.get("rhetorical_annotations", []))
 
         # convert nested dict to flat dict where each method includes its parameters in the name
         self.all_doc_methods = getDictOfTestingMethods(exp["doc_methods"])
+        self.qmethods_by_extractor = self.groupQueryMethodsByExtractor(exp["qmethods"])
 
-        self.precomputed_queries = []
-        self.files_dict = OrderedDict()
+        self.queries_by = self.createQueryIndexes()
+        # if the filenames end in .msgpack, these are written as MessagePack instead of JSON
+        self.files_writer = openDictFileWriter(os.path.join(self.exp["exp_dir"],
+                                                            self.exp.get("files_dict_filename", "files_dict.json")))
+        self.queries_writer = openListFileWriter(os.path.join(self.exp["exp_dir"],
+                                                              self.exp.get("precomputed_queries_filename",
+                                                                           "precomputed_queries.json")))
 
         ##        if exp["full_corpus"]:
         ##            files_dict["ALL_FILES"]={}
@@ -311,21 +469,58 @@ class QueryGenerator(object):
         # ===================================
         # MAIN LOOP over all testing files
         # ===================================
-        for guid in exp["test_files"]:
-            try:
-                self.processOneFile(guid)
-            except ValueError:
-                print("Can't load SciDoc ", guid)
-                continue
-
-            if self.citations_processed >= self.exp.get("max_queries_generated", 10000000):
-                break
-            logger.showProgressReport(guid)  # prints out info on how it's going
+        num_processes = self.options.get("num_processes", 1)
+        if num_processes > 1:
+            for guid, file_queries in self.processFilesInParallel(exp["test_files"], num_processes):
+                if file_queries is None:
+                    print("Can't load SciDoc ", guid)
+                    continue
+
+                self.addFileQueries(file_queries)
+                if self.citations_processed >= self.exp.get("max_queries_generated", 10000000):
+                    break
+                logger.showProgressReport(guid)  # prints out info on how it's going
+        else:
+            for guid in exp["test_files"]:
+                if not self.processOneFile(guid):
+                    print("Can't load SciDoc ", guid)
+                    continue
+
+                if self.citations_processed >= self.exp.get("max_queries_generated", 10000000):
+                    break
+                logger.showProgressReport(guid)  # prints out info on how it's going
 
         self.saveAllQueries()
         print("Precomputed queries saved.")
 
 
+QUERY_GENERATION_CHUNKSIZE = 8
+
+# the QueryGenerator in each worker process
+worker_query_generator = None
+
+
+def initQueryGenerationWorker(query_generator):
+    """
+        Initializer for the query generation worker processes. The connection to
+        the database can't be shared with the parent process, so it is opened again.
+    """
+    global worker_query_generator
+    worker_query_generator = query_generator
+    cp.Corpus.connectToDB(suppress_error=True)
+
+
+def generateQueriesForFileInWorker(args):
+    """
+        Runs QueryGenerator.generateQueriesForFile() in a worker process
+
+        :param args: (guid, max_citations) tuple
+        :returns: (guid, file_queries) tuple, file_queries is None if the doc can't be loaded
+    """
+    guid, max_citations = args
+    return guid, worker_query_generator.generateQueriesForFile(guid, max_citations)
+
+
 # ===============================================================================
 #  functions to measure score
 # ===============================================================================
@@ -366,14 +561,14 @@ def createExplainQueriesByAZ(retrieval_results_filename="prr_all_ilc_AZ_paragrap
     """
         Creates _by_az and _by_cfc files from precomputed_retrieval_results
     """
-    retrieval_results = json.load(open(cp.Corpus.paths.prebuiltBOWs + retrieval_results_filename, "r"))
+    retrieval_results = loadJSON(cp.Corpus.paths.prebuiltBOWs + retrieval_results_filename)
     retrieval_results_by_az = {zone: [] for zone in AZ_ZONES_LIST}
 
     for retrieval_result in retrieval_results:
         retrieval_results_by_az[retrieval_result["az"]].append(retrieval_result)
     ##        retrieval_results_by_cfc[retrieval_result["query"]["cfc"]].append(retrieval_result)
 
-    json.dump(retrieval_results_by_az, open(cp.Corpus.paths.prebuiltBOWs + "retrieval_results_by_az.json", "w"))
+    saveJSON(retrieval_results_by_az, cp.Corpus.paths.prebuiltBOWs + "retrieval_results_by_az.json")
 
 
 ##    json.dump(retrieval_results_by_cfc,open(cp.Corpus.paths.prebuiltBOWs+"retrieval_results_by_cfc.json","w"))
@@ -390,25 +585,30 @@ def fixEndOfFile():
     AZ_LIST = [zone for zone in AZ_ZONES_LIST if zone != "OWN"]
     print(AZ_LIST)
 
-    for div in AZ_LIST:
-        files["AZ_" + div] = open(exp["exp_dir"] + "prr_AZ_" + div + ".json", "r+")
+    try:
+        for div in AZ_LIST:
+            files["AZ_" + div] = open(exp["exp_dir"] + "prr_AZ_" + div + ".json", "r+b", buffering=1 << 16)
 
-    ##    for div in CORESC_LIST:
-    ##        files["CSC_"+div]=open(exp["exp_dir"]+"prr_CSC_"+div+".json","r+")
-
-    files["ALL"] = open(exp["exp_dir"] + "prr_ALL.json", "r+")
+        ##    for div in CORESC_LIST:
+        ##        files["CSC_"+div]=open(exp["exp_dir"]+"prr_CSC_"+div+".json","r+b", buffering=1 << 16)
 
-    for div in AZ_LIST:
-        files["AZ_" + div].seek(-1, os.SEEK_END)
-        files["AZ_" + div].write("]")
+        files["ALL"] = open(exp["exp_dir"] + "prr_ALL.json", "r+b", buffering=1 << 16)
 
+        # binary mode is needed to seek relative to the end of the file
+        for div in AZ_LIST:
+            files["AZ_" + div].seek(-1, os.SEEK_END)
+            files["AZ_" + div].write(b"]")
+            syncFile(files["AZ_" + div])
 
-##    for div in CORESC_LIST:
-##        files["CSC_"+div].seek(-1,os.SEEK_END)
-##        files["CSC_"+div].write("]")
-
-##    files["ALL"].seek(-1,os.SEEK_END)
-##    files["ALL"].write("]")
+    ##    for div in CORESC_LIST:
+    ##        files["CSC_"+div].seek(-1,os.SEEK_END)
+    ##        files["CSC_"+div].write("]")
+
+    ##    files["ALL"].seek(-1,os.SEEK_END)
+    ##    files["ALL"].write(b"]")
+    finally:
+        for f in files.values():
+            f.close()
 
 
 def main():
@@ -25,13 +25,19 @@ def getAnnotationStatistics(doc):
     citation_zone_counts={}
     zone_list=[]
 
+    # CoreSC annotation takes precedence over AZ for each sentence. The counts are
+    # dicts seeded with the known labels rather than Counters, so it takes a
+    # single pass and an unknown label raises a KeyError
     for sentence in doc.allsentences:
-        if sentence.get("csc_type","") != "":
-            csc_counts[sentence["csc_type"]] += 1
-            zone_list.append(sentence["csc_type"])
-        elif sentence.get("az","") != "":
-            az_counts[sentence["az"]] += 1
-            zone_list.append(sentence["az"])
+        csc_type=sentence.get("csc_type")
+        if csc_type:
+            csc_counts[csc_type] += 1
+            zone_list.append(csc_type)
+        else:
+            az=sentence.get("az")
+            if az:
+                az_counts[az] += 1
+                zone_list.append(az)
 
     for citation in doc.citations:
         parent=citation.get("parent_s",None)
@@ -40,13 +46,6 @@ def getAnnotationStatistics(doc):
         if not parent:
             continue
 
-        if sentence.get("csc_type","") != "":
-            csc_counts[sentence["csc_type"]] += 1
-            zone_list.append(sentence["csc_type"])
-        elif sentence.get("az","") != "":
-            az_counts[sentence["az"]] += 1
-            zone_list.append(sentence["az"])
-
         s_type=doc.element_by_id[parent].get("csc_type", "")
         if s_type == "":
             s_type=doc.element_by_id[parent].get("az", "")
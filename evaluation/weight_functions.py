@@ -8,12 +8,13 @@
 from __future__ import absolute_import
 import random
 from copy import deepcopy
+import numpy
 from multiprocessing import Pool, cpu_count
 
 from sklearn import model_selection
 
 from .pipeline_functions import getDictOfTestingMethods
-from retrieval.stored_formula import StoredFormula
+from retrieval.stored_formula import StoredFormula, StoredFormulaBatch
 
 ##def runSingleFormula(result_tuple):
 ##    """
@@ -45,7 +46,9 @@ def runPrecomputedQuery(retrieval_results, parameters):
         This takes a query that has already had the results added and parameters
         and returns the computed scores
     """
-    scores=[]
+    batch=StoredFormulaBatch([unique_result["formula"] for unique_result in retrieval_results])
+    scores=[(score, {"guid":unique_result["guid"]})
+            for score, unique_result in zip(batch.computeScores(parameters), retrieval_results)]
 ##    numproc=cpu_count()
 ##    pool = Pool(numproc)
 ####    print("Spawning workers")
@@ -54,15 +57,148 @@ def runPrecomputedQuery(retrieval_results, parameters):
 ##        scores.extend(new_scores)
 ##    pool.close()
 ##    pool.join()
-    for unique_result in retrieval_results:
-        formula=StoredFormula(unique_result["formula"])
-        score=formula.computeScore(formula.formula, parameters)
-        scores.append((score,{"guid":unique_result["guid"]}))
+##    for unique_result in retrieval_results:
 ##        scores.append(runSingleFormula([unique_result,parameters]))
 
     scores.sort(key=lambda x:x[0],reverse=True)
     return scores
 
+def prepareLinearizedResults(retrieval_results, dtype=numpy.float64):
+    """
+        Reads a set of precomputed retrieval results once and decomposes every
+        formula that is linear in the field weights into per-field coefficients
+        (see StoredFormula.linearCoefficients()). The coefficients of all the
+        retrieved documents of all the results are stacked into a single
+        (num_docs, num_fields) matrix, so scoring with new weights is one
+        matrix-vector product and changing a single weight is an update of the
+        cached scores, see applyWeightDelta().
+
+        Results with formulas that aren't linear keep their formulas and are
+        recomputed in full with runPrecomputedQuery(). Results with errors
+        (no "formulas") are skipped.
+
+        :param dtype: numpy type of the coefficients and scores. The default
+            float64 gives the same scores as StoredFormula.computeScore(); float32
+            halves the memory and bandwidth needed, but documents with very close
+            scores may be ranked differently.
+        :returns: dict to be passed to setLinearizedScores(), applyWeightDelta()
+            and rankPreparedResult(). Its "results" list has one entry per result.
+            If every result could be linearized, it also has the arrays needed
+            by weight_kernels.scoreLinearizedResults() and "kernel_ready" is True.
+    """
+    entries=[]
+    fields={}
+    rows=[]
+    consts=[]
+    targets=[]
+    kernel_ready=True
+    for result in retrieval_results:
+        if "formulas" not in result:
+            # there was an error reading this result
+            continue
+
+        formulas=[StoredFormula(unique_result["formula"]) for unique_result in result["formulas"]]
+        linear=[formula.linearCoefficients() for formula in formulas]
+        if any(item is None for item in linear):
+            # keeping the StoredFormula instances means each formula is only compiled once
+            entries.append({"result":result,
+                            "formulas":[(formula, {"guid":unique_result["guid"]})
+                                        for formula, unique_result in zip(formulas, result["formulas"])],
+                            })
+            continue
+
+        # the formulas themselves are not needed anymore
+        entry={"result":{key:result[key] for key in result if key != "formulas"},
+               "docs":[{"guid":unique_result["guid"]} for unique_result in result["formulas"]],
+               "start":len(rows),
+               "end":len(rows)+len(linear),
+               }
+
+        # the kernel finds the rank of each correct document directly
+        match_guids=set(result["match_guids"])
+        doc_guids=[doc["guid"] for doc in entry["docs"]]
+        if len(match_guids) == 0 or len(set(doc_guids)) != len(doc_guids):
+            kernel_ready=False
+        entry["target_start"]=len(targets)
+        targets.extend(entry["start"]+index for index, guid in enumerate(doc_guids) if guid in match_guids)
+        entry["target_end"]=len(targets)
+        entry["num_matches"]=len(match_guids)
+        for coefs, const in linear:
+            row={}
+            for field in coefs:
+                row[fields.setdefault(field, len(fields))]=coefs[field]
+            rows.append(row)
+            consts.append(const)
+        entries.append(entry)
+
+    coef_matrix=numpy.zeros((len(rows), len(fields)), dtype=dtype)
+    for index, row in enumerate(rows):
+        for field_index in row:
+            coef_matrix[index, field_index]=row[field_index]
+
+    prepared={"results":entries,
+              "fields":fields,
+              "coefs":coef_matrix,
+              "consts":numpy.array(consts, dtype=dtype),
+              "scores":None,
+              "kernel_ready":kernel_ready and all("docs" in entry for entry in entries),
+              }
+    if prepared["kernel_ready"]:
+        for key, array_key in [("start", "starts"), ("end", "ends"), ("target_start", "target_starts"),
+                               ("target_end", "target_ends"), ("num_matches", "num_matches")]:
+            prepared[array_key]=numpy.array([entry[key] for entry in entries], dtype=numpy.int64)
+        prepared["targets"]=numpy.array(targets, dtype=numpy.int64)
+    return prepared
+
+def setLinearizedScores(prepared, parameters):
+    """
+        (Re)computes from scratch the cached scores of the linearized results
+        for the given weights
+    """
+    fields=prepared["fields"]
+    weights=numpy.zeros(len(fields), dtype=prepared["coefs"].dtype)
+    for field in fields:
+        weights[fields[field]]=parameters[field]
+    prepared["scores"]=prepared["coefs"].dot(weights) + prepared["consts"]
+
+def applyWeightDelta(prepared, weight_name, delta):
+    """
+        Updates the cached scores of the linearized results after the weight
+        of a single field has changed by `delta`, without rescoring everything
+    """
+    if delta == 0 or weight_name not in prepared["fields"]:
+        return
+    prepared["scores"] += delta * prepared["coefs"][:, prepared["fields"][weight_name]]
+
+def getActiveWeights(prepared, weight_names):
+    """
+        Returns the weights, out of `weight_names`, that affect the score of at
+        least one document of the prepared results. Changing any of the others
+        can't make any difference.
+    """
+    if any("docs" not in entry for entry in prepared["results"]):
+        # there's no telling for formulas that aren't linear
+        return list(weight_names)
+
+    fields=prepared["fields"]
+    activity=numpy.abs(prepared["coefs"]).sum(axis=0)
+    return [name for name in weight_names if name in fields and activity[fields[name]] > 0]
+
+def rankPreparedResult(prepared, entry, parameters):
+    """
+        Returns the retrieved documents for one of the prepared results in the
+        same format as runPrecomputedQuery()
+    """
+    if "docs" not in entry:
+        scores=[(formula.computeScore(formula.formula, parameters), doc) for formula, doc in entry["formulas"]]
+        scores.sort(key=lambda x:x[0],reverse=True)
+        return scores
+
+    scores=prepared["scores"][entry["start"]:entry["end"]]
+    # stable sort on the negated scores keeps ties in the same order as list.sort(reverse=True)
+    order=numpy.argsort(-scores, kind="mergesort")
+    docs=entry["docs"]
+    return [(scores[index], docs[index]) for index in order.tolist()]
 
 def main():
     pass
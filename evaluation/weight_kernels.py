@@ -0,0 +1,115 @@
+# Compiled kernels for scoring linearized precomputed results in weight training
+#
+# Copyright:   (c) Daniel Duma 2016
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+import math
+import numpy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# rank used for the average when a correct document isn't retrieved, as in measureScores()
+NOT_FOUND_RANK = 200
+
+if NUMBA_AVAILABLE:
+    prange = numba.prange
+else:
+    prange = range
+
+
+def scoreLinearizedResults(scores, starts, ends, targets, target_starts, target_ends, num_matches):
+    """
+        Computes the same mrr, ndcg, precision and rank as measureScores() for
+        every result, from the flat array of scores of all the retrieved
+        documents. No sorting is needed: the rank of a correct document is the
+        number of documents with a higher score, plus those with the same score
+        that come before it, as list.sort(reverse=True) is stable.
+
+        Assumes the guids retrieved for each result are unique.
+
+        :param scores: float64 array with the score of every retrieved document
+        :param starts: the retrieved documents of result i are scores[starts[i]:ends[i]]
+        :param targets: indices in scores of the correct documents that were retrieved,
+            those of result i are targets[target_starts[i]:target_ends[i]]
+        :param num_matches: number of distinct correct guids for each result
+        :returns: tuple of arrays (mrr, ndcg, precision, rank), one value per result
+    """
+    num_results = starts.shape[0]
+    mrr = numpy.zeros(num_results)
+    ndcg = numpy.zeros(num_results)
+    precision = numpy.zeros(num_results)
+    rank = numpy.zeros(num_results)
+    idcg = 1 / math.log(2)
+
+    for result in prange(num_results):
+        multi = num_matches[result]
+        if ends[result] == starts[result]:
+            # the query was empty or something
+            continue
+
+        sum_mrr = 0.0
+        sum_ndcg = 0.0
+        sum_precision = 0.0
+        sum_rank = 0
+        for target_index in range(target_starts[result], target_ends[result]):
+            target = targets[target_index]
+            target_score = scores[target]
+            target_rank = 1
+            for doc in range(starts[result], ends[result]):
+                if scores[doc] > target_score or (scores[doc] == target_score and doc < target):
+                    target_rank += 1
+
+            if multi > 1 and target_rank <= multi:
+                sum_mrr += 1.0
+                sum_ndcg += 1.0
+                sum_precision += 1.0
+                sum_rank += 1
+            else:
+                sum_mrr += 1.0 / target_rank
+                sum_ndcg += (1 / math.log(1 + target_rank)) / idcg
+                if multi == 1 and target_rank == 1:
+                    sum_precision += 1.0
+                sum_rank += target_rank
+
+        not_found = multi - (target_ends[result] - target_starts[result])
+        sum_rank += not_found * NOT_FOUND_RANK
+
+        mrr[result] = sum_mrr / multi
+        ndcg[result] = sum_ndcg / multi
+        precision[result] = sum_precision / multi
+        rank[result] = int(sum_rank / multi)
+
+    return mrr, ndcg, precision, rank
+
+
+if NUMBA_AVAILABLE:
+    scoreLinearizedResults = numba.njit(cache=True, parallel=True)(scoreLinearizedResults)
+
+
+def setNumThreads(num_threads):
+    """
+        Limits the number of threads the parallel kernels use, e.g. when
+        several processes run them at the same time
+    """
+    if not NUMBA_AVAILABLE:
+        return
+    numba.set_num_threads(max(1, min(num_threads, numba.config.NUMBA_NUM_THREADS)))
+
+
+def warmUpKernels():
+    """
+        Triggers the compilation of the kernels on a tiny input, so the time it
+        takes isn't added to the first real call
+    """
+    if not NUMBA_AVAILABLE:
+        return
+    index = numpy.zeros(1, dtype=numpy.int64)
+    scoreLinearizedResults(numpy.zeros(1), index, index + 1, index, index, index + 1, index + 1)
@@ -8,9 +8,10 @@
 from __future__ import print_function
 
 from __future__ import absolute_import
-import json, os, time
+import os, time
 
 from .base_pipeline import BaseTestingPipeline
+from proc.general_utils import loadListFile, loadDictFile
 from retrieval.base_retrieval import BaseRetrieval
 
 from celery.result import ResultSet
@@ -78,12 +79,13 @@ class WeightTestingPipeline(BaseTestingPipeline):
 
         """
         preset_weights = self.main_all_doc_methods[method].get("preset_runtime_weights", [])
-        if precomputed_query["az"] in preset_weights:
+        if precomputed_query.get("az", "") in preset_weights:
             query_type = precomputed_query["az"]
-        elif precomputed_query["csc_type"] in preset_weights:
+        elif precomputed_query.get("csc_type", "") in preset_weights:
             query_type = precomputed_query["csc_type"]
         else:
-            print("Query type %s %s not found in preset_weights" % (precomputed_query["az"], precomputed_query["csc_type"]))
+            print("Query type %s %s not found in preset_weights" % (precomputed_query.get("az", ""),
+                                                                    precomputed_query.get("csc_type", "")))
             raise ValueError
 
         return preset_weights[query_type]
@@ -99,12 +101,14 @@ class WeightTestingPipeline(BaseTestingPipeline):
                                                                       "precomputed_queries.json"))
 
         if "ALL" in self.exp.get("queries_to_process", ["ALL"]):
-            self.precomputed_queries = json.load(open(precomputed_queries_file_path, "r"))  # [:1]
+            self.precomputed_queries = loadListFile(precomputed_queries_file_path)  # [:1]
             self.precomputed_queries = self.precomputed_queries[self.options.get("run_query_start_at", 0):]
         ##            precomputed_queries=json.load(open(self.exp["exp_dir"]+"precomputed_queries.json","r"))
         else:
-            queries_filename = "queries_by_" + self.exp["queries_classification"] + ".json"
-            queries_by_zone = json.load(open(self.exp["exp_dir"] + queries_filename, "r"))
+            # same format as the precomputed queries file
+            queries_filename = ("queries_by_" + self.exp["queries_classification"] +
+                                os.path.splitext(precomputed_queries_file_path)[1])
+            queries_by_zone = loadDictFile(self.exp["exp_dir"] + queries_filename)
             self.precomputed_queries = []
             for zone in queries_by_zone[self.exp["queries_to_process"]]:
                 self.precomputed_queries.extend(queries_by_zone[zone])
@@ -113,7 +117,7 @@ class WeightTestingPipeline(BaseTestingPipeline):
 
         files_dict_filename = os.path.join(self.exp["exp_dir"],
                                            self.exp.get("files_dict_filename", "files_dict.json"))
-        self.files_dict = json.load(open(files_dict_filename, "r"))
+        self.files_dict = loadDictFile(files_dict_filename)
         self.files_dict["ALL_FILES"] = {}
 
         assert self.exp["name"] != "", "Experiment needs a name!"
@@ -9,7 +9,9 @@ from __future__ import print_function
 
 from __future__ import absolute_import
 import  gc, random, os
-from collections import defaultdict
+import multiprocessing
+import numpy
+from collections import defaultdict, OrderedDict
 from sklearn import model_selection
 import pandas as pd
 
@@ -17,11 +19,44 @@ import db.corpora as cp
 from proc.results_logging import ResultsLogger
 ##from proc.nlp_functions import AZ_ZONES_LIST, CORESC_LIST, RANDOM_ZONES_7, RANDOM_ZONES_11
 from .base_pipeline import getDictOfTestingMethods
-from .weight_functions import runPrecomputedQuery, addExtraWeights
-from db.result_store import ElasticResultStorer, ResultIncrementalReader, ResultDiskReader
+from .weight_functions import (runPrecomputedQuery, addExtraWeights, prepareLinearizedResults,
+                               setLinearizedScores, applyWeightDelta, rankPreparedResult, getActiveWeights)
+from .weight_kernels import NUMBA_AVAILABLE, scoreLinearizedResults, warmUpKernels, setNumThreads
+from db.result_store import ElasticResultStorer, ResultIncrementalReader, ResultDiskReader, createElasticClient
 from six.moves import range
 
 GLOBAL_FILE_COUNTER=0
+# how much each weight is moved by at every step of the greedy search
+WEIGHT_MOVEMENTS=[-1,6,-2]
+# the greedy search stops when a pass improves the score by less than this fraction of the initial score
+WEIGHT_SEARCH_TOLERANCE=1e-6
+
+def defaultWeight():
+    """
+        Default factory for the weights of an empty training fold. Must be
+        a module-level function so the defaultdict can be pickled back from
+        trainFoldInWorker()
+    """
+    return 1
+
+def trainFoldInWorker(args):
+    """
+        Runs the weight search for a single cross-validation fold in a worker
+        process. Each worker builds its own WeightTrainer, so the readers of
+        precomputed formulas are opened in the worker and never pickled.
+
+        :param args: tuple of (exp, options, split_fold, num_threads), where
+            num_threads is how many threads the scoring kernels can use
+        :returns: tuple of (split_fold, best_weights for that fold)
+    """
+    exp, options, split_fold, num_threads=args
+    # the other folds are running their kernels at the same time
+    setNumThreads(num_threads)
+    trainer=WeightTrainer(exp, options)
+    trainer.all_doc_methods=getDictOfTestingMethods(exp["doc_methods"])
+    best_weights=trainer.dynamicWeightValues(split_fold)
+    gc.collect()
+    return split_fold, best_weights
 
 class WeightTrainer(object):
     """
@@ -33,6 +68,12 @@ class WeightTrainer(object):
         self.exp=exp
         self.options=options
         self.all_doc_methods={}
+        # readers of precomputed formulas, by query_type, shared by all folds
+        self.formulas_cache={}
+        # KFold splits, by (number of results, number of folds)
+        self.fold_splits_cache={}
+        # a single connection to Elastic for all the readers
+        self.es_client=None
 
     def dynamicWeightValues(self, split_fold):
         """
@@ -46,7 +87,7 @@ class WeightTrainer(object):
     ##    initialization_methods=[1,"random"]
         MIN_WEIGHT=0
     ##    self.exp["movements"]=[-1,3]
-        self.exp["movements"]=[-1,6,-2]
+        self.exp["movements"]=list(WEIGHT_MOVEMENTS)
 
         best_weights={}
 
@@ -67,10 +108,7 @@ class WeightTrainer(object):
                 print("Number of results is smaller than number of folds for zone type ", query_type)
                 continue
 
-            cv = model_selection.KFold(n_splits=numfolds, shuffle=False, random_state=None)
-            cv = zip(cv.split(retrieval_results))
-
-            traincv, testcv=cv[split_fold]
+            traincv, testcv=self.getFoldSplit(retrieval_results, numfolds, split_fold)
             if isinstance(retrieval_results, ResultIncrementalReader):
                 train_set=retrieval_results.subset(traincv)
             elif isinstance(retrieval_results, list):
@@ -81,9 +119,15 @@ class WeightTrainer(object):
 ##            train_set=[retrieval_results[i] for i in traincv]
             if len(train_set) == 0:
                 print("Training set len is 0!")
-                return defaultdict(lambda:1)
+                return defaultdict(defaultWeight)
 
             print("Training for citations in ",query_type,"zones:",len(train_set),"/",len(retrieval_results))
+            # the training set is read and decomposed only once per fold, then every
+            # change of weights only updates the cached scores
+            prepared_train_set=prepareLinearizedResults(train_set,
+                numpy.float32 if self.exp.get("weight_training_float32", False) else numpy.float64)
+            fixed_weights=self.exp.get("fixed_runtime_parameters",{})
+
             for method in annotated_boost_methods:
                 res={}
 
@@ -96,8 +140,12 @@ class WeightTrainer(object):
     ##                    counter.weights={x:random.randint(-10,10) for x in all_doc_methods[method]["runtime_parameters"]}
 
                     all_doc_methods[method]["runtime_parameters"]=weights
+                    # the weights with the fixed ones added, kept in step with weights
+                    # below so they don't have to be rebuilt for every probe
+                    parameters=addExtraWeights(weights, self.exp)
                     print("Computing initial score...")
-                    scores=self.measurePrecomputedResolution(train_set, method, addExtraWeights(weights, self.exp), query_type)
+                    setLinearizedScores(prepared_train_set, parameters)
+                    scores=self.measurePreparedResolution(prepared_train_set, method, parameters, query_type)
 
                     score_baseline=scores[0][self.exp["metric"]]
                     previous_score=score_baseline
@@ -112,28 +160,39 @@ class WeightTrainer(object):
                     overall_improvement = score_baseline
                     passes=0
 
+                    # only the values of the weights change, never the keys. Weights that
+                    # are fixed or don't affect any score in the training set are never moved
+                    weight_names=[name for name in getActiveWeights(prepared_train_set, weights.keys())
+                                  if name not in fixed_weights]
+                    tolerance=WEIGHT_SEARCH_TOLERANCE*first_baseline
+
                     print("Finding best weights...")
-                    while passes < 3 or overall_improvement > 0:
+                    while weight_names and (passes < 3 or overall_improvement > tolerance):
                         for direction in self.exp["movements"]: # [-1,6,-2]
                             print("Direction: ", direction)
-                            for index in range(len(weights)):
-##                                print("Weight: ", index)
-                                weight_name=list(weights.keys())[index]
+                            for weight_name in weight_names:
                                 prev_weight=weights[weight_name]
                                 # hard lower limit of 0 for weights
                                 weights[weight_name]=max(MIN_WEIGHT,weights[weight_name]+direction)
+                                parameters[weight_name]=weights[weight_name]
+                                delta=weights[weight_name]-prev_weight
+                                applyWeightDelta(prepared_train_set, weight_name, delta)
 
-                                scores=self.measurePrecomputedResolution(train_set,method,addExtraWeights(weights, self.exp), query_type)
+                                scores=self.measurePreparedResolution(prepared_train_set,method,parameters, query_type,
+                                                                      lightweight=True)
                                 this_score=scores[0][self.exp["metric"]]
 
                                 if this_score <= previous_score:
                                     weights[weight_name]=prev_weight
+                                    parameters[weight_name]=prev_weight
+                                    applyWeightDelta(prepared_train_set, weight_name, -delta)
                                 else:
                                     previous_score=this_score
 
-                        overall_improvement=this_score-score_baseline
-                        score_baseline=this_score
-                        score_progression.append(this_score)
+                        # previous_score is the best score at the end of this pass
+                        overall_improvement=previous_score-score_baseline
+                        score_baseline=previous_score
+                        score_progression.append(previous_score)
 
                         # This is to export the graphs as weights are trained
 ##                        drawWeights(self.exp,weights,query_type+"_weights_"+str(GLOBAL_FILE_COUNTER))
@@ -142,7 +201,9 @@ class WeightTrainer(object):
 
                         passes+=1
 
-                    scores=self.measurePrecomputedResolution(train_set, method, addExtraWeights(weights, self.exp), query_type)
+                    # recompute the scores from scratch to not carry over any rounding errors
+                    setLinearizedScores(prepared_train_set, parameters)
+                    scores=self.measurePreparedResolution(prepared_train_set, method, parameters, query_type)
                     this_score=scores[0][self.exp["metric"]]
 
     ##                if split_fold is not None:
@@ -194,13 +255,36 @@ class WeightTrainer(object):
         return best_weights
 
 
+    def getFoldSplit(self, retrieval_results, numfolds, split_fold):
+        """
+            Returns the (traincv, testcv) indices of the given fold. The splits
+            only depend on the number of results and folds, so they are computed
+            once and reused for every fold and query_type.
+        """
+        key=(len(retrieval_results), numfolds)
+        if key not in self.fold_splits_cache:
+            cv = model_selection.KFold(n_splits=numfolds, shuffle=False, random_state=None)
+            self.fold_splits_cache[key]=list(cv.split(range(len(retrieval_results))))
+        return self.fold_splits_cache[key][split_fold]
+
     def loadPrecomputedFormulas(self, query_type):
         """
             Loads the previously computed retrieval results, including query, etc.
+
+            The reader is only created once per query_type: every fold and the
+            final scoring iterate over the same one, which reads the results
+            from its local disk cache instead of going to Elastic again.
         """
-        prr=ElasticResultStorer(self.exp["name"],"prr_"+self.exp["queries_classification"]+"_"+query_type, cp.Corpus.endpoint)
+        if query_type in self.formulas_cache:
+            return self.formulas_cache[query_type]
+
+        if self.es_client is None:
+            self.es_client=createElasticClient(cp.Corpus.endpoint)
+        prr=ElasticResultStorer(self.exp["name"],"prr_"+self.exp["queries_classification"]+"_"+query_type, cp.Corpus.endpoint,
+                                es=self.es_client)
         reader=ResultDiskReader(prr, cache_dir=os.path.join(self.exp["exp_dir"], "cache"), max_results=self.exp.get("max_per_class_results",1000))
         reader.bufsize=30
+        self.formulas_cache[query_type]=reader
         return reader
 
 ##        return prr.readResults(250)
@@ -236,9 +320,7 @@ class WeightTrainer(object):
                     print("Number of results is smaller than number of folds for zone type ", query_type)
                     continue
 
-                cv = model_selection.KFold( n_splits=numfolds, shuffle=False, random_state=None)
-                cv=[k for k in cv] # run the generator
-                traincv, testcv=cv[split_fold]
+                traincv, testcv=self.getFoldSplit(retrieval_results, numfolds, split_fold)
                 if isinstance(retrieval_results, ResultIncrementalReader):
                     test_set=retrieval_results.subset(testcv)
                 elif isinstance(retrieval_results, list):
@@ -246,10 +328,15 @@ class WeightTrainer(object):
                 else:
                     raise ValueError("Unkown class of results")
 
+                # read the test set only once for all methods and both sets of weights
+                prepared_test_set=prepareLinearizedResults(test_set,
+                    numpy.float32 if self.exp.get("weight_training_float32", False) else numpy.float64)
+
                 for method in weights[query_type]:
                     weights_baseline=addExtraWeights({x:1 for x in self.all_doc_methods[method]["runtime_parameters"]}, self.exp)
 
-                    scores=self.measurePrecomputedResolution(test_set, method, weights_baseline, query_type)
+                    setLinearizedScores(prepared_test_set, weights_baseline)
+                    scores=self.measurePreparedResolution(prepared_test_set, method, weights_baseline, query_type)
                     baseline_score=scores[0][self.exp["metric"]]
         ##            print "Score for "+query_type+" weights=1:", baseline_score
                     result={"query_type":query_type,
@@ -266,7 +353,8 @@ class WeightTrainer(object):
                         result[weight]=1
                     results.append(result)
 
-                    scores=self.measurePrecomputedResolution(test_set, method, weights[query_type][method], query_type)
+                    setLinearizedScores(prepared_test_set, weights[query_type][method])
+                    scores=self.measurePreparedResolution(prepared_test_set, method, weights[query_type][method], query_type)
                     this_score=scores[0][self.exp["metric"]]
         ##            print "Score with trained weights:",this_score
                     impro=this_score-baseline_score
@@ -336,29 +424,113 @@ class WeightTrainer(object):
 
             formulas=result["formulas"]
             retrieved=runPrecomputedQuery(formulas,parameters)
+            self.logPrecomputedResult(logger, result, retrieved, method)
 
-            result_dict={"file_guid":result["file_guid"],
-                         "citation_id":result["citation_id"],
-                         "doc_position":result["doc_position"],
-                         "query_method":result["query_method"],
-                         "doc_method":method,
-                         "az":result["az"],
-                         "cfc":result["cfc"],
-                         "match_guids":result["match_guids"]}
-
-            if not retrieved or len(retrieved)==0:    # the query was empty or something
-##                print "Error: ", doc_method , qmethod,retrieval_models[method].indexDir
-##                logger.addResolutionResult(guid,m,doc_position,qmethod,doc_method ,0,0,0)
-                result_dict["mrr_score"]=0
-                result_dict["precision_score"]=0
-                result_dict["ndcg_score"]=0
-                result_dict["rank"]=0
-                result_dict["first_result"]=""
-
-                logger.addResolutionResultDict(result_dict)
-            else:
-                result=logger.measureScoreAndLog(retrieved, result["citation_multi"], result_dict)
+        return self.averagePrecomputedScores(logger, parameters, citation_az)
+
+    def measurePreparedResolution(self, prepared_results, method, parameters, citation_az="*", lightweight=False):
+        """
+            Same as measurePrecomputedResolution() but for results already run
+            through prepareLinearizedResults(), whose cached scores must match
+            @parameters (see setLinearizedScores() and applyWeightDelta())
 
+            :param lightweight: if True, only the average scores are needed, not
+                the per-result logging, so the results are scored with
+                scoreLinearizedResults() even if it isn't compiled with numba
+        """
+        if prepared_results["kernel_ready"] and (NUMBA_AVAILABLE or lightweight):
+            return self.measurePreparedResolutionWithKernel(prepared_results, method, citation_az)
+
+        logger=ResultsLogger(False, dump_straight_to_disk=False) # init all the logging/counting
+        logger.startCounting() # for timing the process, start now
+
+        logger.setNumItems(len(prepared_results["results"]),print_out=False)
+
+        for entry in prepared_results["results"]:
+            retrieved=rankPreparedResult(prepared_results, entry, parameters)
+            self.logPrecomputedResult(logger, entry["result"], retrieved, method)
+
+        return self.averagePrecomputedScores(logger, parameters, citation_az)
+
+    def measurePreparedResolutionWithKernel(self, prepared_results, method, citation_az="*"):
+        """
+            Computes the same average scores as measurePreparedResolution() in a
+            single pass over all the results (compiled if numba is available),
+            without sorting anything or going through the ResultsLogger
+        """
+        mrr, ndcg, precision, rank=scoreLinearizedResults(prepared_results["scores"],
+                                                          prepared_results["starts"],
+                                                          prepared_results["ends"],
+                                                          prepared_results["targets"],
+                                                          prepared_results["target_starts"],
+                                                          prepared_results["target_ends"],
+                                                          prepared_results["num_matches"])
+        if "query_method_groups" not in prepared_results:
+            # the grouping never changes between calls, so it's only done once
+            by_query_method=OrderedDict()
+            for index, entry in enumerate(prepared_results["results"]):
+                by_query_method.setdefault(entry["result"]["query_method"], []).append(index)
+            prepared_results["query_method_groups"]=[(query_method, numpy.array(by_query_method[query_method]))
+                                                     for query_method in by_query_method]
+
+        groups=prepared_results["query_method_groups"]
+        if len(groups) == 1:
+            # the usual case when training weights: a single query method, so
+            # there's no need to select the results that belong to it
+            query_method=groups[0][0]
+            return [{"query_method":query_method,"doc_method":method,"citation_az":citation_az,
+                     "avg_mrr":mrr.mean(),
+                     "avg_ndcg":ndcg.mean(),
+                     "avg_precision":precision.mean(),
+                     "avg_rank":rank.mean(),
+                     "precision_total":precision.sum(),
+                     }]
+
+        results=[]
+        for query_method, indices in groups:
+            data_line={"query_method":query_method,"doc_method":method,"citation_az":citation_az,
+                       "avg_mrr":mrr[indices].mean(),
+                       "avg_ndcg":ndcg[indices].mean(),
+                       "avg_precision":precision[indices].mean(),
+                       "avg_rank":rank[indices].mean(),
+                       "precision_total":precision[indices].sum(),
+                       }
+            results.append(data_line)
+
+        return results
+
+    def logPrecomputedResult(self, logger, result, retrieved, method):
+        """
+            Scores the documents retrieved for one precomputed query and adds
+            them to the logger
+        """
+        result_dict={"file_guid":result["file_guid"],
+                     "citation_id":result["citation_id"],
+                     "doc_position":result["doc_position"],
+                     "query_method":result["query_method"],
+                     "doc_method":method,
+                     "az":result.get("az",""),
+                     "cfc":result.get("cfc",""),
+                     "match_guids":result["match_guids"]}
+
+        if not retrieved or len(retrieved)==0:    # the query was empty or something
+##            print "Error: ", doc_method , qmethod,retrieval_models[method].indexDir
+##            logger.addResolutionResult(guid,m,doc_position,qmethod,doc_method ,0,0,0)
+            result_dict["mrr_score"]=0
+            result_dict["precision_score"]=0
+            result_dict["ndcg_score"]=0
+            result_dict["rank"]=0
+            result_dict["first_result"]=""
+
+            logger.addResolutionResultDict(result_dict)
+        else:
+            logger.measureScoreAndLog(retrieved, result["citation_multi"], result_dict)
+
+    def averagePrecomputedScores(self, logger, parameters, citation_az):
+        """
+            Returns the average scores collected in the logger, one line per
+            query_method and doc_method
+        """
         logger.computeAverageScores()
         results=[]
         for query_method in logger.averages:
@@ -381,6 +553,8 @@ class WeightTrainer(object):
         gc.collect()
         options=self.options
         self.all_doc_methods=getDictOfTestingMethods(self.exp["doc_methods"])
+        # compile the scoring kernels now rather than in the middle of the first fold
+        warmUpKernels()
 
         best_weights={}
         if options.get("override_folds",None):
@@ -390,10 +564,30 @@ class WeightTrainer(object):
         numfolds=self.exp.get("cross_validation_folds",2)
 
         # First we find the highest weights for each fold's training set
-        for split_fold in range(numfolds):
-            print("\nFold #"+str(split_fold))
-            best_weights[split_fold]=self.dynamicWeightValues(split_fold)
-            gc.collect()
+        if options.get("parallel_folds", False) and numfolds > 1:
+            # each fold is independent, so they can be trained at the same time
+            num_processes=min(numfolds, options.get("num_processes", multiprocessing.cpu_count()))
+            print("\nTraining", numfolds, "folds in", num_processes, "processes")
+            # the training sets of the folds overlap, so the disk cache is filled
+            # here once rather than by several workers writing the same files
+            for query_type in self.exp["train_weights_for"]:
+                self.loadPrecomputedFormulas(query_type).cacheAllItems()
+            num_threads=max(1, multiprocessing.cpu_count() // num_processes)
+            pool=multiprocessing.Pool(processes=num_processes)
+            try:
+                for split_fold, fold_weights in pool.imap_unordered(trainFoldInWorker,
+                        [(self.exp, self.options, split_fold, num_threads) for split_fold in range(numfolds)]):
+                    best_weights[split_fold]=fold_weights
+            finally:
+                pool.close()
+                pool.join()
+            # dynamicWeightValues() only sets these on the workers' copy of exp
+            self.exp["movements"]=list(WEIGHT_MOVEMENTS)
+        else:
+            for split_fold in range(numfolds):
+                print("\nFold #"+str(split_fold))
+                best_weights[split_fold]=self.dynamicWeightValues(split_fold)
+                gc.collect()
 
         # Then we actually test them against the
         print("Now applying and testing weights...\n")
@@ -7,7 +7,8 @@
 
 from __future__ import print_function
 from __future__ import absolute_import
-import os, re
+import os, re, hashlib
+import multiprocessing
 
 from importing.corpus_import import CorpusImporter
 import db.corpora as cp
@@ -16,7 +17,13 @@ from scidoc.xmlformats.read_paperxml import PaperXMLReader
 from importing.aan_metadata import convertAANcitations
 from proc.nlp_functions import tokenizeText, basic_stopwords
 from string import punctuation
-from proc.general_utils import getRootDir
+from proc.general_utils import getRootDir, loadJSON, saveJSON, ensureDirExists
+
+BOW_PUNCTUATION_REGEX = re.compile(r"[\.,;\-\"]")
+# tokens that are never added to a reference's bag-of-words
+BOW_IGNORE_TOKENS = frozenset(basic_stopwords) | frozenset(punctuation)
+# increase whenever processBOW() changes, so BOWs cached on disk are not reused
+BOW_CACHE_VERSION = 1
 
 
 class AANReferenceMatcher(BaseReferenceMatcher):
@@ -24,30 +31,71 @@ class AANReferenceMatcher(BaseReferenceMatcher):
         Matches references using information from the annotated AAN corpus
     """
 
-    def __init__(self, infile):
+    def __init__(self, infile, bow_cache_dir=None):
         """
             Loads AAN citation graph
 
             Args:
                 infile: path to acl.txt
+                bow_cache_dir: if given, the BOWs built for each document are
+                    cached in this directory, one file per document, and reused
+                    on the next run
         """
         super(self.__class__, self).__init__(cp.Corpus)
         self.citations = convertAANcitations(infile)
         # keep track of which document we're processing so that we only load
         # the references once
         self.current_corpus_id = None
+        self.bow_cache_dir = bow_cache_dir
+        self.bow_cache = None
+        self.bow_cache_changed = False
+        if bow_cache_dir:
+            ensureDirExists(bow_cache_dir)
+
+    def loadBOWCache(self, corpus_id):
+        """
+            Loads the cached BOWs for a document, if any
+        """
+        self.bow_cache = {}
+        self.bow_cache_changed = False
+        cache_path = os.path.join(self.bow_cache_dir, corpus_id + ".json")
+        if os.path.exists(cache_path):
+            try:
+                data = loadJSON(cache_path)
+            except ValueError:
+                return
+            if data.get("version") == BOW_CACHE_VERSION:
+                self.bow_cache = data["bows"]
+
+    def saveBOWCache(self, corpus_id):
+        """
+            Saves the BOWs computed for a document if there are new ones
+        """
+        if self.bow_cache_changed:
+            saveJSON({"version": BOW_CACHE_VERSION, "bows": self.bow_cache},
+                     os.path.join(self.bow_cache_dir, corpus_id + ".json"))
+            self.bow_cache_changed = False
 
     def processBOW(self, text):
         """
             Takes a list of strings, returns a set of tokens.
         """
         text = " ".join(text)
+        if self.bow_cache is not None:
+            key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            if key in self.bow_cache:
+                return set(self.bow_cache[key])
+
         text = text.lower()
-        text = re.sub(r"[\.,;\-\"]", " ", text)
+        text = BOW_PUNCTUATION_REGEX.sub(" ", text)
         tokens = tokenizeText(text)
         ##        tokens=text.lower().split()
-        tokens = [token for token in tokens if token not in punctuation and token not in basic_stopwords]
-        return set(tokens)
+        bow = set(token for token in tokens if token not in BOW_IGNORE_TOKENS)
+
+        if self.bow_cache is not None:
+            self.bow_cache[key] = sorted(bow)
+            self.bow_cache_changed = True
+        return bow
 
     def makeBOW(self, metadata):
         """
@@ -93,18 +141,31 @@ class AANReferenceMatcher(BaseReferenceMatcher):
     def chooseNextBest(self, cit_data):
         """
             Very simple choosing function, using set intersection
+
+            :returns: tuple (index, ref) of the best of the available references,
+                or None if none is good enough
         """
+        # only the references that pass autorsYearMatch(): the year and at least
+        # one of the authors' tokens in their BOW
+        candidates = set(self.refs_by_token.get(cit_data["data"]["year"], []))
+        if candidates:
+            author_candidates = set()
+            for token in cit_data["authors_bow"]:
+                author_candidates.update(self.refs_by_token.get(token, []))
+            candidates &= author_candidates
+
         scores = []
-        for ref in self.available_references:
-            if not self.autorsYearMatch(cit_data, ref):
+        for index in sorted(candidates):
+            if not self.available_mask[index]:
                 continue
+            ref = self.available_references[index]
             score = len(ref["bow"] & cit_data["bow"])
             if score > len(cit_data["bow"]) / 4:
-                scores.append([score, ref])
+                scores.append([score, index, ref])
 
         res = sorted(scores, key=lambda x: x[0], reverse=True)
         if len(res) > 0:
-            return res[0][1]
+            return res[0][1], res[0][2]
         else:
             return None
 
@@ -122,9 +183,14 @@ class AANReferenceMatcher(BaseReferenceMatcher):
         print("Matching outlinks with references for ", doc.metadata["corpus_id"])
         self.guid_index = {}
         self.doc_outlinks = []
-
-        for cited_id in self.citations[doc.metadata["corpus_id"]]:
-            metadata = cp.Corpus.getMetadataByField("metadata.corpus_id", cited_id)
+        if self.bow_cache_dir:
+            self.loadBOWCache(doc.metadata["corpus_id"])
+
+        cited_ids = list(self.citations[doc.metadata["corpus_id"]])
+        # fetch the metadata of all cited papers at once
+        all_metadata = cp.Corpus.getMetadataByFieldBatch("metadata.corpus_id", cited_ids)
+        for cited_id in cited_ids:
+            metadata = all_metadata.get(cited_id)
             if metadata:
                 ##                metadata=metadata["metadata"]
                 self.doc_outlinks.append({
@@ -137,15 +203,26 @@ class AANReferenceMatcher(BaseReferenceMatcher):
         for ref in doc.references:
             self.available_references.append({"bow": self.makeBOW(ref), "data": ref})
 
+        if self.bow_cache_dir:
+            self.saveBOWCache(doc.metadata["corpus_id"])
+        # references already matched are marked as unavailable instead of removed from the list
+        self.available_mask = [True] * len(self.available_references)
+        # inverted index of the references' BOW tokens, to only look at likely candidates
+        self.refs_by_token = {}
+        for index, ref in enumerate(self.available_references):
+            for token in ref["bow"]:
+                self.refs_by_token.setdefault(token, []).append(index)
+
         # match each AAN-sponsored paper with its best reference in the doc
         for cit_data in self.doc_outlinks:
-            chosen_ref = self.chooseNextBest(cit_data)
-            if chosen_ref:
+            chosen = self.chooseNextBest(cit_data)
+            if chosen:
+                chosen_index, chosen_ref = chosen
                 ##                print(json.dumps(chosen_ref["data"]),"\n",json.dumps(cit_data["data"]),"\n\n")
                 chosen_ref["data"]["guid"] = cit_data["data"]["guid"]
                 chosen_ref["data"]["corpus_id"] = cit_data["data"].get("corpus_id", "")
                 self.guid_index[chosen_ref["data"]["guid"]] = cit_data["data"]
-                self.available_references.remove(chosen_ref)
+                self.available_mask[chosen_index] = False
             else:
                 print("Couldn't match reference ", cit_data["data"]["corpus_id"])
 
@@ -175,9 +252,12 @@ def getACL_corpus_id(filename):
     return os.path.split(filename)[1].replace("-paper.xml", "").lower()
 
 
-def import_aac_corpus(endpoint, use_celery=True):
+def import_aac_corpus(endpoint, use_celery=True, num_processes=None):
     """
         Do the importing of the AAC corpus
+
+        :param num_processes: when not using celery, number of local processes
+            to import the files with. Defaults to the number of CPUs.
     """
     importer = CorpusImporter(reader=PaperXMLReader())
     importer.collection_id = "AAC"
@@ -193,9 +273,11 @@ def import_aac_corpus(endpoint, use_celery=True):
     ##    corpus_import.FILES_TO_PROCESS_TO=500
 
     ##    importer.restartCollectionImport(options)
-    cp.Corpus.matcher = AANReferenceMatcher(os.path.join(getRootDir("aan"), "release" + os.sep + "acl_full.txt"))
+    cp.Corpus.matcher = AANReferenceMatcher(os.path.join(getRootDir("aan"), "release" + os.sep + "acl_full.txt"),
+                                            bow_cache_dir=os.path.join(getRootDir("aan"), "bow_cache"))
 
     importer.use_celery = use_celery
+    importer.num_processes = num_processes or multiprocessing.cpu_count()
     importer.importCorpus(os.path.join(getRootDir("aac"), "inputXML"), file_mask="*-paper.xml", import_options=options)
 
 
@@ -10,6 +10,7 @@ from __future__ import print_function
 from __future__ import absolute_import
 import sys, os, datetime, fnmatch, random
 import logging
+import multiprocessing
 
 from proc.general_utils import (ensureTrailingBackslash, loadFileList,
     saveFileList, ensureDirExists)
@@ -18,11 +19,41 @@ from proc.results_logging import ProgressIndicator
 import db.corpora as cp
 
 from .importing_functions import (convertXMLAndAddToCorpus, updatePaperInCollectionReferences)
-from multi.tasks import (importXMLTask, updateReferencesTask)
+from multi.tasks import (importXMLTask, importXMLBatchTask, importXMLChain, updateReferencesTask)
 from six.moves import range
 
 FILES_TO_PROCESS_FROM=0
 FILES_TO_PROCESS_TO=sys.maxsize
+# files imported by each celery task
+IMPORT_BATCH_SIZE=20
+
+
+def initImportWorker(matcher):
+    """
+        Initializer for the processes that import files when not using celery.
+
+        Elasticsearch connections are not safe to share across a fork, so each
+        worker opens its own. The reference matcher is handed over once per
+        worker, so any data it loaded isn't loaded again for every file.
+    """
+    cp.Corpus.connectToDB()
+    if matcher is not None:
+        cp.Corpus.matcher=matcher
+
+
+def importXMLInWorker(args):
+    """
+        Converts one file and adds it to the corpus, in a worker process
+
+        :param args: tuple of the arguments to convertXMLAndAddToCorpus()
+        :returns: the path of the file, or None if it couldn't be converted
+    """
+    try:
+        convertXMLAndAddToCorpus(*args)
+    except ValueError:
+        logging.exception("ERROR: Couldn't convert %s" % args[0])
+        return None
+    return args[0]
 
 
 class CorpusImporter(object):
@@ -48,6 +79,8 @@ class CorpusImporter(object):
         self.import_id=import_id
         self.generate_corpus_id=getDefault_corpus_id
         self.use_celery=use_celery
+        # when not using celery, number of local processes to convert files with
+        self.num_processes=1
 
 ##    def convertDoc(self, filename, corpus_id):
 ##        """
@@ -76,6 +109,18 @@ class CorpusImporter(object):
         """
         progress=ProgressIndicator(True, self.num_files_to_process, dot_every_xitems=20)
         tasks=[]
+        # files to convert in local processes
+        jobs=[]
+        use_pool=not self.use_celery and self.num_processes > 1
+        # files for the next celery task
+        batch=[]
+
+        def sendBatch():
+            tasks.append(importXMLBatchTask.apply_async(
+                args=[list(batch), self.import_id, self.collection_id, import_options],
+                queue="import_xml"
+                ))
+            del batch[:]
 
         for fn in ALL_INPUT_FILES[FILES_TO_PROCESS_FROM:FILES_TO_PROCESS_TO]:
             corpus_id=self.generate_corpus_id(fn)
@@ -83,24 +128,31 @@ class CorpusImporter(object):
             if not match or import_options.get("reload_xml_if_doc_in_collection",False):
                 if self.use_celery:
                         match_id=match["guid"] if match else None
-                        tasks.append(importXMLTask.apply_async(
-                          args=[
-                                os.path.join(inputdir,fn),
-                                corpus_id,
-                                self.import_id,
-                                self.collection_id,
-                                import_options,
-                                match_id
-                                ],
-                                queue="import_xml"
-                                ))
+                        if import_options.get("split_import_tasks",False):
+                            # fetch, parse and index in separate queues
+                            tasks.append(importXMLChain(os.path.join(inputdir,fn),
+                                                        corpus_id,
+                                                        self.import_id,
+                                                        self.collection_id,
+                                                        import_options,
+                                                        match_id).apply_async())
+                        else:
+                            batch.append([os.path.join(inputdir,fn), corpus_id, match_id])
+                            if len(batch) >= IMPORT_BATCH_SIZE:
+                                sendBatch()
                 else:
                     # main loop over all files
                     filename=cp.Corpus.paths.inputXML+fn
                     corpus_id=self.generate_corpus_id(fn)
 
                     match=cp.Corpus.getMetadataByField("metadata.filename",os.path.basename(fn))
-                    if not match:
+                    if not match and use_pool:
+                        jobs.append((os.path.join(inputdir,fn),
+                                     corpus_id,
+                                     self.import_id,
+                                     self.collection_id,
+                                     import_options))
+                    elif not match:
                         try:
                             doc=convertXMLAndAddToCorpus(
                                 os.path.join(inputdir,fn),
@@ -115,6 +167,20 @@ class CorpusImporter(object):
 
                         progress.showProgressReport("Importing -- latest file %s" % fn)
 
+        if batch:
+            sendBatch()
+
+        if jobs:
+            pool=multiprocessing.Pool(processes=self.num_processes,
+                                      initializer=initImportWorker,
+                                      initargs=(cp.Corpus.matcher,))
+            try:
+                for file_path in pool.imap_unordered(importXMLInWorker, jobs):
+                    if file_path:
+                        progress.showProgressReport("Importing -- latest file %s" % os.path.basename(file_path))
+            finally:
+                pool.close()
+                pool.join()
 
 
     def updateInCollectionReferences(self, ALL_GUIDS, import_options={}):
@@ -11,7 +11,7 @@ from __future__ import absolute_import
 import logging
 from copy import deepcopy
 
-from proc.general_utils import normalizeTitle, copyDictExceptKeys
+from proc.general_utils import normalizeTitle, copyDictExceptKeys, loadFileText
 
 import db.corpora as cp
 from scidoc.xmlformats.read_auto import AutoXMLReader
@@ -41,10 +41,16 @@ def addSciDocToDB(doc, import_id, collection_id):
     meta["collection_id"]=collection_id
     cp.Corpus.addPaper(meta, check_existing=False)
 
-def convertXMLAndAddToCorpus(file_path, corpus_id, import_id, collection_id,
-    import_options, xml_string=None, existing_guid=None):
+def convertXMLToSciDoc(file_path, corpus_id, import_options, xml_string=None,
+    existing_guid=None, xml_file=None):
     """
-        Reads the input XML and saves a SciDoc
+        Reads the input XML into a SciDoc, without saving anything
+
+        :param xml_string: the XML, if already loaded
+        :param xml_file: local file to read the XML from instead of file_path,
+            e.g. a downloaded copy. file_path is still the document's identifier
+        :returns: tuple (doc, update_existing). doc is None if the document is
+            already in the collection and shouldn't be loaded again
     """
     update_existing=False
     if not existing_guid:
@@ -53,13 +59,15 @@ def convertXMLAndAddToCorpus(file_path, corpus_id, import_id, collection_id,
     if existing_guid:
         if not import_options.get("reload_xml_if_doc_in_collection",False):
             print("Document %s is already in the collection. Ignoring." % corpus_id)
-            return
+            return None, False
         update_existing=True
 
     reader=AutoXMLReader()
 ##    try:
     if xml_string:
         doc=reader.read(xml_string, file_path)
+    elif xml_file:
+        doc=reader.read(loadFileText(xml_file), file_path)
     else:
         doc=reader.readFile(file_path)
 ##    except:
@@ -76,6 +84,22 @@ def convertXMLAndAddToCorpus(file_path, corpus_id, import_id, collection_id,
     if doc.metadata.get("corpus_id", "") == "":
         doc.metadata["corpus_id"]=corpus_id
 
+    return doc, update_existing
+
+def convertXMLAndAddToCorpus(file_path, corpus_id, import_id, collection_id,
+    import_options, xml_string=None, existing_guid=None, xml_file=None):
+    """
+        Reads the input XML and saves a SciDoc
+
+        See convertXMLToSciDoc() for the arguments
+    """
+    doc, update_existing=convertXMLToSciDoc(file_path, corpus_id, import_options,
+                                            xml_string=xml_string,
+                                            existing_guid=existing_guid,
+                                            xml_file=xml_file)
+    if doc is None:
+        return
+
     cp.Corpus.saveSciDoc(doc)
 
     if not update_existing:
@@ -83,6 +107,19 @@ def convertXMLAndAddToCorpus(file_path, corpus_id, import_id, collection_id,
 
     return doc
 
+def addConvertedSciDocsToCorpus(converted, import_id, collection_id):
+    """
+        Saves SciDocs converted with convertXMLToSciDoc() all at once, then
+        adds the new ones to the database like convertXMLAndAddToCorpus()
+
+        :param converted: list of (doc, update_existing) tuples
+    """
+    cp.Corpus.saveSciDocs([doc for doc, update_existing in converted])
+
+    for doc, update_existing in converted:
+        if not update_existing:
+            addSciDocToDB(doc, import_id, collection_id)
+
 def updatePaperInCollectionReferences(doc_id, import_options):
     """
         Updates a single paper's in-collection references
@@ -15,12 +15,14 @@ from .corpus_import import CorpusImporter
 import db.corpora as cp
 from scidoc.xmlformats.read_sapienta_jatsxml import SapientaJATSXMLReader
 
+PMC_ID_REGEX=re.compile(r"(\d+)_(?:annotated|done)\.xml", re.IGNORECASE)
+
 def getPMC_CSC_corpus_id(filename):
     """
         Returns the ACL id for a file
     """
     fn=os.path.split(filename)[1]
-    match=re.search(r"(\d+)_(?:annotated|done)\.xml",fn.replace("-paper.xml","").lower(),flags=re.IGNORECASE)
+    match=PMC_ID_REGEX.search(fn.replace("-paper.xml","").lower())
     if match:
         return match.group(1)
     else:
@@ -66,17 +68,31 @@ def fix_authors_full_corpus():
         shouldn't
     """
     from proc.results_logging import ProgressIndicator
+    from elasticsearch import helpers
+    from db.elastic_corpus import ES_INDEX_PAPERS, ES_TYPE_PAPER
     cp.useElasticCorpus()
     cp.Corpus.connectCorpus("g:\\nlp\\phd\\pmc_coresc")
-    guids=cp.Corpus.listPapers()
-    progress=ProgressIndicator(True, len(guids), True)
-    for guid in guids:
-        doc_meta=cp.Corpus.getMetadataByGUID(guid)
-        new_authors=[]
-        for old_author in doc_meta.authors:
-            del old_author["papers"]
-        cp.Corpus.updatePaper(doc_meta)
-        progress.showProgressReport("Removing redundant author information")
+    progress=ProgressIndicator(True, cp.Corpus.countPapers(), True)
+
+    def authorUpdates():
+        """
+            Yields a partial update for every paper with authors to fix,
+            scanning only the authors of each paper
+        """
+        for hit in helpers.scan(cp.Corpus.es, index=ES_INDEX_PAPERS, doc_type=ES_TYPE_PAPER,
+                                _source=["metadata.authors"]):
+            progress.showProgressReport("Removing redundant author information")
+            authors=hit["_source"].get("metadata", {}).get("authors", [])
+            if not any("papers" in author for author in authors):
+                continue
+            new_authors=[{key:author[key] for key in author if key != "papers"} for author in authors]
+            yield {"_op_type": "update",
+                   "_index": ES_INDEX_PAPERS,
+                   "_type": ES_TYPE_PAPER,
+                   "_id": hit["_id"],
+                   "doc": {"metadata": {"authors": new_authors}}}
+
+    helpers.bulk(cp.Corpus.es, authorUpdates(), chunk_size=500)
 
 def fix_broken_scidocs():
     """
@@ -37,6 +37,9 @@ app.conf.update(
     CELERY_QUEUES=(
         Queue('default', Exchange('default'), routing_key='default'),
         Queue('import_xml', Exchange('import_xml'), routing_key='import_xml'),
+        Queue('fetch_xml', Exchange('fetch_xml'), routing_key='fetch_xml'),
+        Queue('parse_xml', Exchange('parse_xml'), routing_key='parse_xml'),
+        Queue('index_scidoc', Exchange('index_scidoc'), routing_key='index_scidoc'),
         Queue('update_references', Exchange('update_references'), routing_key='update_references'),
         Queue('prebuild_bows', Exchange('prebuild_bows'), routing_key='prebuild_bows'),
         Queue('add_to_index', Exchange('add_to_index'), routing_key='add_to_index'),
@@ -48,6 +51,10 @@ app.conf.update(
 
     CELERY_ROUTES={
         'importXMLTask': {'queue': 'import_xml', 'routing_key': 'import_xml'},
+        'importXMLBatchTask': {'queue': 'import_xml', 'routing_key': 'import_xml'},
+        'fetchXMLTask': {'queue': 'fetch_xml', 'routing_key': 'fetch_xml'},
+        'parseXMLTask': {'queue': 'parse_xml', 'routing_key': 'parse_xml'},
+        'indexSciDocTask': {'queue': 'index_scidoc', 'routing_key': 'index_scidoc'},
         'updateReferencesTask': {'queue': 'update_references', 'routing_key': 'update_references'},
         'prebuildBOWTask': {'queue': 'prebuild_bows', 'routing_key': 'prebuild_bows'},
         'addToIndexTask': {'queue': 'add_to_index', 'routing_key': 'add_to_index'},
@@ -9,11 +9,18 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import logging
+import os
+import shutil
+import tempfile
 
 from elasticsearch import TransportError
 
 import db.corpora as cp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from celery import chain
+from celery.signals import worker_process_init
 from celery.utils.log import get_task_logger
 from db.elastic_corpus import ElasticCorpus
 from db.result_store import createResultStorers, ElasticResultStorer
@@ -21,8 +28,11 @@ from evaluation.keyword_functions import annotateKeywords
 from evaluation.prebuild_functions import prebuildMulti
 from evaluation.precompute_functions import addPrecomputeExplainFormulas
 from evaluation.statistics_functions import computeAnnotationStatistics
-from importing.importing_functions import (convertXMLAndAddToCorpus,
+from importing.importing_functions import (convertXMLAndAddToCorpus, convertXMLToSciDoc,
+                                           addConvertedSciDocsToCorpus,
                                            updatePaperInCollectionReferences)
+from proc.general_utils import loadFileText
+from scidoc.scidoc import SciDoc
 from proc.keyphrase_annotation import annotateDocWithKPs
 from retrieval.elastic_retrieval import ElasticRetrieval
 from retrieval.index_functions import addBOWsToIndex
@@ -38,6 +48,19 @@ logger = get_task_logger(__name__)
 RUN_LOCALLY = False
 MAX_RETRIES = 1000
 
+# (connect, read) timeouts in seconds for the file server
+FILE_SERVER_TIMEOUT = (5, 60)
+# files are downloaded to disk in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# shared by all the downloads of this worker process, so the connections to
+# the file server are kept alive between tasks. Failed connections are retried
+# here, HTTP errors are left to the tasks
+FILE_SERVER_SESSION = requests.Session()
+for prefix in ("http://", "https://"):
+    FILE_SERVER_SESSION.mount(prefix, HTTPAdapter(pool_connections=16, pool_maxsize=64,
+                                                  max_retries=Retry(total=3, backoff_factor=0.2)))
+
 
 def checkCorpusConnection(local_corpus_dir="",
                           corpus_endpoint=celery_app.MINERVA_ELASTICSEARCH_ENDPOINT):
@@ -52,11 +75,46 @@ def checkCorpusConnection(local_corpus_dir="",
         sleep(random() / float(100))
 
 
+def ensureCorpusConnection():
+    """
+        Connects this worker to the corpus if it isn't already. Called at the
+        start of every task that uses it, as worker_process_init is only sent
+        by the prefork pool, not solo, threads or gevent/eventlet
+    """
+    checkCorpusConnection(corpus_endpoint=celery_app.MINERVA_ELASTICSEARCH_ENDPOINT)
+
+
+def downloadInputFile(file_path, session=FILE_SERVER_SESSION):
+    """
+        Streams an input file from the file server to a temporary file, so it
+        is never held in memory whole. The caller must remove the file.
+
+        :param session: requests.Session to download with
+        :returns: the path of the temporary file
+        :raises requests.HTTPError: if the server returns an error
+    """
+    with session.get(celery_app.MINERVA_FILE_SERVER_URL + "/file/" + file_path,
+                     stream=True, timeout=FILE_SERVER_TIMEOUT) as r:
+        if not r.ok:
+            raise requests.HTTPError("HTTP Error code %d: %s" % (r.status_code, r.content), response=r)
+
+        r.raw.decode_content = True
+        xml_file = tempfile.NamedTemporaryFile(suffix=".xml", delete=False)
+        try:
+            with xml_file:
+                shutil.copyfileobj(r.raw, xml_file, DOWNLOAD_CHUNK_SIZE)
+        except Exception:
+            os.remove(xml_file.name)
+            raise
+    return xml_file.name
+
+
 @app.task(ignore_result=True, bind=True)
 def importXMLTask(self, file_path, corpus_id, import_id, collection_id, import_options, existing_guid):
     """
         Reads the input XML and saves a SciDoc
     """
+    ensureCorpusConnection()
     if RUN_LOCALLY:
         convertXMLAndAddToCorpus(
             file_path,
@@ -66,13 +124,15 @@ def importXMLTask(self, file_path, corpus_id, import_id, collection_id, import_o
             import_options,
             existing_guid=existing_guid)
     else:
-        r = requests.get(celery_app.MINERVA_FILE_SERVER_URL + "/file/" + file_path)
-        if not r.ok:
-            logger.error("HTTP Error code %d" % r.status_code)
-            if r.status_code == 500:
+        try:
+            xml_file_name = downloadInputFile(file_path)
+        except requests.HTTPError as e:
+            logger.error("HTTP Error code %d" % e.response.status_code)
+            if e.response.status_code == 500:
                 raise self.retry(countdown=120)
             else:
-                raise RuntimeError("HTTP Error code %d: %s" % (r.status_code, r.content))
+                raise RuntimeError(str(e))
+
         try:
             convertXMLAndAddToCorpus(
                 file_path,
@@ -80,15 +140,143 @@ def importXMLTask(self, file_path, corpus_id, import_id, collection_id, import_o
                 import_id,
                 collection_id,
                 import_options,
-                xml_string=r.content,
+                xml_file=xml_file_name,
                 existing_guid=existing_guid)
         except MemoryError:
             logging.exception("Exception: Out of memory in importXMLTask")
             raise self.retry(countdown=120, max_retries=4)
-        except:
+        except Exception:
             # TODO what other exceptions?
             logging.exception("Exception in importXMLTask")
             raise self.retry(countdown=60, max_retries=4)
+        finally:
+            os.remove(xml_file_name)
+
+
+@app.task(ignore_result=True, bind=True)
+def importXMLBatchTask(self, jobs, import_id, collection_id, import_options):
+    """
+        Reads several input XML files and saves their SciDocs in one go. The
+        downloads share the connection to the file server and the SciDocs are
+        sent to the index in bulk.
+
+        A file that fails is handed over to its own importXMLTask, which
+        retries it on its own.
+
+        :param jobs: list of [file_path, corpus_id, existing_guid]
+    """
+    ensureCorpusConnection()
+    converted = []
+    for file_path, corpus_id, existing_guid in jobs:
+        xml_file_name = None
+        try:
+            if not RUN_LOCALLY:
+                xml_file_name = downloadInputFile(file_path)
+            doc, update_existing = convertXMLToSciDoc(file_path, corpus_id, import_options,
+                                                      existing_guid=existing_guid,
+                                                      xml_file=xml_file_name)
+        except Exception:
+            logging.exception("Exception in importXMLBatchTask, importing %s on its own" % file_path)
+            importXMLTask.apply_async(
+                args=[file_path, corpus_id, import_id, collection_id, import_options, existing_guid],
+                queue="import_xml")
+            continue
+        finally:
+            if xml_file_name:
+                os.remove(xml_file_name)
+
+        if doc is not None:
+            converted.append((doc, update_existing))
+
+    try:
+        addConvertedSciDocsToCorpus(converted, import_id, collection_id)
+    except Exception:
+        logging.exception("Exception in importXMLBatchTask")
+        raise self.retry(countdown=60, max_retries=4)
+
+
+@app.task(ignore_result=True, bind=True)
+def fetchXMLTask(self, file_path):
+    """
+        First step of importXMLChain(): downloads the input XML, returns it
+        as a string
+    """
+    if RUN_LOCALLY:
+        return loadFileText(file_path)
+
+    try:
+        xml_file_name = downloadInputFile(file_path)
+    except requests.HTTPError as e:
+        logger.error("HTTP Error code %d" % e.response.status_code)
+        if e.response.status_code == 500:
+            raise self.retry(countdown=120)
+        else:
+            raise RuntimeError(str(e))
+    except Exception:
+        logging.exception("Exception in fetchXMLTask")
+        raise self.retry(countdown=60, max_retries=4)
+
+    try:
+        return loadFileText(xml_file_name)
+    finally:
+        os.remove(xml_file_name)
+
+
+@app.task(ignore_result=True, bind=True)
+def parseXMLTask(self, xml, file_path, corpus_id, import_options, existing_guid):
+    """
+        Second step of importXMLChain(): converts the XML to a SciDoc
+
+        :returns: [scidoc data, update_existing], or None if the document is
+            already in the collection
+    """
+    ensureCorpusConnection()
+    try:
+        doc, update_existing = convertXMLToSciDoc(file_path, corpus_id, import_options,
+                                                  xml_string=xml,
+                                                  existing_guid=existing_guid)
+    except MemoryError:
+        logging.exception("Exception: Out of memory in parseXMLTask")
+        raise self.retry(countdown=120, max_retries=4)
+    except Exception:
+        logging.exception("Exception in parseXMLTask")
+        raise self.retry(countdown=60, max_retries=4)
+
+    if doc is None:
+        return None
+    return [doc.data, update_existing]
+
+
+@app.task(ignore_result=True, bind=True)
+def indexSciDocTask(self, converted, import_id, collection_id):
+    """
+        Last step of importXMLChain(): saves the SciDoc and adds it to the
+        database
+    """
+    ensureCorpusConnection()
+    if converted is None:
+        return
+    data, update_existing = converted
+    try:
+        addConvertedSciDocsToCorpus([(SciDoc(data), update_existing)], import_id, collection_id)
+    except Exception:
+        logging.exception("Exception in indexSciDocTask")
+        raise self.retry(countdown=60, max_retries=4)
+
+
+def importXMLChain(file_path, corpus_id, import_id, collection_id, import_options, existing_guid=None):
+    """
+        Does the same as importXMLTask split in three tasks: fetching the XML,
+        parsing it and indexing the SciDoc. Each goes to its own queue, so
+        each can have as many workers as its bottleneck, network or CPU, needs.
+
+        :returns: the celery chain, call apply_async() on it
+    """
+    return chain(
+        fetchXMLTask.s(file_path).set(queue="fetch_xml"),
+        parseXMLTask.s(file_path, corpus_id, import_options, existing_guid).set(queue="parse_xml"),
+        indexSciDocTask.s(import_id, collection_id).set(queue="index_scidoc"),
+    )
 
 
 @app.task(ignore_result=True, bind=True)
@@ -96,9 +284,10 @@ def updateReferencesTask(self, doc_id, import_options):
     """
         Updates one paper's in-collection references, etc.
     """
+    ensureCorpusConnection()
     try:
         updatePaperInCollectionReferences(doc_id, import_options)
-    except:
+    except Exception:
         logging.exception("Exception in updateReferencesTask")
         raise self.retry(countdown=120, max_retries=4)
 
@@ -109,6 +298,7 @@ def prebuildBOWTask(self, method_name, parameters, function, guid, overwrite_exi
     """
         Builds the BOW for a single paper
     """
+    ensureCorpusConnection()
     try:
         sleep(random() / 10.0)
         prebuildMulti(method_name, parameters, function, None, None, guid,
@@ -127,6 +317,7 @@ def addToindexTask(self, guid, indexNames, index_max_year):
         Adds one paper to the index for all indexes. If its BOW has not already
         been built, it builds it too.
     """
+    ensureCorpusConnection()
     logging.error("processing ", guid, indexNames, index_max_year)
     try:
         sleep(random() / float(100))
@@ -144,11 +335,12 @@ def precomputeFormulasTask(self, precomputed_query, doc_method, doc_list, index_
         Runs one precomputed query, and the explain formulas and adds them to
         the DB.
     """
+    ensureCorpusConnection()
     try:
         model = ElasticRetrieval(index_name, doc_method, max_results=max_results, es_instance=cp.Corpus.es)
         writers = createResultStorers(exp_name)
         addPrecomputeExplainFormulas(precomputed_query, doc_method, doc_list, model, writers, experiment_id)
-    except:
+    except Exception:
         logging.exception("Error running addPrecomputeExplainFormulas")
         self.retry(countdown=120, max_retries=4)
 
@@ -157,9 +349,10 @@ def precomputeFormulasTask(self, precomputed_query, doc_method, doc_list, index_
 def computeAnnotationStatisticsTask(self, guid):
     """
     """
+    ensureCorpusConnection()
     try:
         computeAnnotationStatistics(guid)
-    except:
+    except Exception:
         logging.exception("Error running computeAnnotationStatisticsTask")
         self.retry(countdown=120, max_retries=4)
 
@@ -183,6 +376,7 @@ def annotateKeywordsTask(self, precomputed_query,
 
         FIXME: CAN'T RUN ON staff.compute right now because the spacy model is too big to fit on AFS FFS
     """
+    ensureCorpusConnection()
     try:
         model = ElasticRetrieval(index_name, doc_method, max_results=max_results, es_instance=cp.Corpus.es)
         writers = {"ALL": ElasticResultStorer(self.exp["name"], "kw_data", endpoint=cp.Corpus.endpoint)}
@@ -190,7 +384,7 @@ def annotateKeywordsTask(self, precomputed_query,
         annotateKeywords(precomputed_query, doc_method, doc_list, model, writers, experiment_id, context_extraction,
                          extraction_parameter, keyword_selection_method, keyword_selection_parameters, weights,
                          annotator)
-    except:
+    except Exception:
         logging.exception("Error running annotateKeywords")
         self.retry(countdown=120, max_retries=4)
 
@@ -199,12 +393,21 @@ def annotateKeywordsTask(self, precomputed_query,
 def annotateDocWithKPsTask(self, guid):
     """
     """
+    ensureCorpusConnection()
     try:
         annotateDocWithKPs(guid)
-    except:
+    except Exception:
         logging.exception("Error running annotateDocWithKPsTask")
         self.retry(countdown=120, max_retries=4)
 
 
+@worker_process_init.connect
+def connectWorkerProcess(**kwargs):
+    """
+        Connects each worker process to the corpus once, after it is forked,
+        instead of every process that imports this module doing it at import
+    """
+    ensureCorpusConnection()
+
+
 celery_app.MINERVA_ELASTICSEARCH_ENDPOINT = celery_app.set_config()
-checkCorpusConnection(corpus_endpoint=celery_app.MINERVA_ELASTICSEARCH_ENDPOINT)
@@ -48,6 +48,29 @@ def findCitationInFullTextUnderscores(cit, doctext):
     return re.search(r"\_\_" + str(cit["id"]).lower(), doctext, flags=re.DOTALL | re.IGNORECASE)
 
 
+CITATION_XML_REGEX = re.compile(r"<cit\sid=(.+?)\s*?/>", flags=re.DOTALL | re.IGNORECASE)
+CITATION_UNDERSCORES_REGEX = re.compile(r"\_\_(cit\d+)", flags=re.IGNORECASE)
+
+
+def findAllCitationsInFullText(doctext):
+    """
+        Scans the text once for all citations, so they don't each need their own
+        search through the whole text. The first occurrence of a citation wins, and
+        XML citations take precedence over underscore ones, same as trying
+        findCitationInFullTextXML() before findCitationInFullTextUnderscores()
+
+        :param doctext: full document text
+        :returns: dict {citation_id: match}, with lowercase citation ids
+    """
+    res = {}
+    for regex in [CITATION_UNDERSCORES_REGEX, CITATION_XML_REGEX]:
+        found = {}
+        for match in regex.finditer(doctext):
+            found.setdefault(match.group(1).lower(), match)
+        res.update(found)
+    return res
+
+
 def getDictOfLuceneIndeces(prebuild_indices):
     """
         Make a simple dictionary of {method_10:{method details}}
@@ -7,7 +7,7 @@
 
 from __future__ import absolute_import
 from __future__ import print_function
-import os, re, codecs, datetime, random, sys, unicodedata, math
+import os, re, codecs, datetime, random, sys, unicodedata, math, json, mmap
 import six
 from six.moves import range
 
@@ -16,6 +16,20 @@ try:
 except:
     import pickle
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_WRITE_BUFFER_SIZE = 1 << 20
+# JSON files at least this big are parsed straight from a memory map
+JSON_MMAP_MIN_SIZE = 16 << 20
+
 
 class AttributeDict(dict):
     """
@@ -159,9 +173,7 @@ def loadFileText(filename, encoding="utf-8"):
         Opens a file using codecs, reads full contents into a string, returns string.
     """
     with codecs.open(filename, "rb", encoding, errors="replace") as f:
-        lines = f.readlines()
-        text = u"".join(lines)
-        return text
+        return f.read()
     return None
 
 
@@ -222,6 +234,278 @@ def saveListToTxtFile(guids, filename):
             f.write(guid + "\n")
     return guids
 
+
+def syncFile(f):
+    """
+        Flushes a file and makes sure its contents are actually on disk
+    """
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def saveJSON(obj, filename, sync=False):
+    """
+        Serializes an object to a JSON file. The whole thing is encoded into a
+        single buffer first (with orjson if it's installed) and written out once,
+        as json.dump() would call write() once per token.
+
+        :param sync: if True, fsync the file before closing it
+    """
+    with open(filename, "wb", buffering=JSON_WRITE_BUFFER_SIZE) as f:
+        f.write(dumpJSONBytes(obj))
+        if sync:
+            syncFile(f)
+
+
+def loadJSON(filename):
+    """
+        Loads a JSON file, reading it in one go and parsing it with orjson if it's installed.
+        orjson parses big files directly from a memory map of the file, so
+        there's no copy of the whole contents in memory while it builds the objects.
+    """
+    if orjson is not None and os.path.getsize(filename) >= JSON_MMAP_MIN_SIZE:
+        with open(filename, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(mapped)
+                try:
+                    return orjson.loads(view)
+                finally:
+                    # the map can't be closed while the view exists
+                    view.release()
+            finally:
+                mapped.close()
+    return loadJSONBytes(loadFileBytes(filename))
+
+
+def loadFileBytes(filename):
+    """
+        Returns the raw contents of a file
+    """
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def loadJSONBytes(data):
+    """
+        Parses UTF-8 encoded JSON, with orjson if it's installed
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def dumpJSONBytes(obj, indent=None):
+    """
+        Returns the UTF-8 encoded JSON serialization of an object, compact unless
+        an indent is given. Non-ASCII characters are written as they are instead
+        of as \\uXXXX escapes.
+
+        orjson can only indent by 2 spaces, other indents go through json.dumps()
+    """
+    if orjson is not None and indent in (None, 0, 2):
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if indent:
+        return json.dumps(obj, indent=indent, ensure_ascii=False).encode("utf-8")
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+class JSONListWriter(object):
+    """
+        Writes a JSON list to a file one item at a time, so the full list never
+        has to be held in memory. The resulting file loads as a normal JSON list.
+    """
+    opening = b"["
+    closing = b"]"
+
+    def __init__(self, filename):
+        self.file = open(filename, "wb", buffering=JSON_WRITE_BUFFER_SIZE)
+        self.file.write(self.opening)
+        self.count = 0
+
+    def writeSeparator(self):
+        if self.count:
+            self.file.write(b",")
+        self.count += 1
+
+    def write(self, item):
+        self.writeSeparator()
+        self.file.write(dumpJSONBytes(item))
+
+    def close(self, sync=False):
+        self.file.write(self.closing)
+        if sync:
+            syncFile(self.file)
+        self.file.close()
+
+
+class JSONDictWriter(JSONListWriter):
+    """
+        Same as JSONListWriter, but writes a JSON object one key at a time
+    """
+    opening = b"{"
+    closing = b"}"
+
+    def write(self, key, value):
+        self.writeSeparator()
+        self.file.write(dumpJSONBytes(key))
+        self.file.write(b":")
+        self.file.write(dumpJSONBytes(value))
+
+
+def saveJSONDictStreamed(obj, filename, indent=None):
+    """
+        Saves a dict to a JSON file, encoding the items of its list values one
+        at a time, so the serialization of the whole thing is never held in
+        memory. The file is byte for byte what saveJSON() would write with the
+        same indent.
+    """
+    if indent:
+        newline = b"\n"
+        padding = b" " * indent
+        key_separator = b": "
+    else:
+        newline = padding = b""
+        key_separator = b":"
+
+    def indented(data, prefix):
+        # JSON strings can't contain raw newlines, so these are all line breaks
+        return data.replace(b"\n", b"\n" + prefix) if indent else data
+
+    with open(filename, "wb", buffering=JSON_WRITE_BUFFER_SIZE) as f:
+        f.write(b"{")
+        for num, (key, value) in enumerate(six.iteritems(obj)):
+            if num:
+                f.write(b",")
+            f.write(newline + padding + dumpJSONBytes(six.text_type(key)) + key_separator)
+            if isinstance(value, list) and value:
+                f.write(b"[")
+                for item_num, item in enumerate(value):
+                    if item_num:
+                        f.write(b",")
+                    f.write(newline + padding * 2 + indented(dumpJSONBytes(item, indent=indent), padding * 2))
+                f.write(newline + padding + b"]")
+            else:
+                f.write(indented(dumpJSONBytes(value, indent=indent), padding))
+        if obj:
+            f.write(newline)
+        f.write(b"}")
+
+
+class MsgpackListWriter(object):
+    """
+        Writes a list to a MessagePack file one item at a time, as a stream of
+        packed objects. Read it back with loadMsgpackList()
+    """
+
+    def __init__(self, filename):
+        if msgpack is None:
+            raise ImportError("msgpack is needed to write %s" % filename)
+        self.file = open(filename, "wb", buffering=JSON_WRITE_BUFFER_SIZE)
+        self.packer = msgpack.Packer(use_bin_type=True)
+
+    def write(self, item):
+        self.file.write(self.packer.pack(item))
+
+    def close(self, sync=False):
+        if sync:
+            syncFile(self.file)
+        self.file.close()
+
+
+class MsgpackDictWriter(MsgpackListWriter):
+    """
+        Writes a dict to a MessagePack file one key at a time, as a stream of
+        alternating keys and values. Read it back with loadMsgpackDict()
+    """
+
+    def write(self, key, value):
+        self.file.write(self.packer.pack(key))
+        self.file.write(self.packer.pack(value))
+
+
+def iterateMsgpackFile(filename):
+    """
+        Yields every object in a MessagePack stream file
+    """
+    with open(filename, "rb") as f:
+        for item in msgpack.Unpacker(f, raw=False, max_buffer_size=0):
+            yield item
+
+
+def loadMsgpackList(filename):
+    """
+        Loads a list written with MsgpackListWriter
+    """
+    return list(iterateMsgpackFile(filename))
+
+
+def loadMsgpackDict(filename):
+    """
+        Loads a dict written with MsgpackDictWriter
+    """
+    items = iterateMsgpackFile(filename)
+    return dict(zip(items, items))
+
+
+def isMsgpackFile(filename):
+    return filename.endswith(".msgpack")
+
+
+def openListFileWriter(filename):
+    """
+        Returns a writer for a list file, MessagePack if the filename ends in .msgpack, JSON otherwise
+    """
+    if isMsgpackFile(filename):
+        return MsgpackListWriter(filename)
+    return JSONListWriter(filename)
+
+
+def openDictFileWriter(filename):
+    """
+        Returns a writer for a dict file, MessagePack if the filename ends in .msgpack, JSON otherwise
+    """
+    if isMsgpackFile(filename):
+        return MsgpackDictWriter(filename)
+    return JSONDictWriter(filename)
+
+
+def saveDictFile(obj, filename, sync=False):
+    """
+        Saves a dict in the format given by the file extension, see openDictFileWriter()
+    """
+    if not isMsgpackFile(filename):
+        return saveJSON(obj, filename, sync=sync)
+
+    writer = MsgpackDictWriter(filename)
+    try:
+        for key in obj:
+            writer.write(key, obj[key])
+    finally:
+        writer.close(sync=sync)
+
+
+def loadListFile(filename):
+    """
+        Loads a list saved in either format, see openListFileWriter()
+    """
+    if isMsgpackFile(filename):
+        return loadMsgpackList(filename)
+    return loadJSON(filename)
+
+
+def loadDictFile(filename):
+    """
+        Loads a dict saved in either format, see openDictFileWriter()
+    """
+    if isMsgpackFile(filename):
+        return loadMsgpackDict(filename)
+    return loadJSON(filename)
+
+
 def writeTuplesToCSV(columns, tuples, filename):
     """
         Rakes a list of columns and a lsit of tuples, assumes each tuple has the required number of elements
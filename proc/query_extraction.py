@@ -123,6 +123,34 @@ class BaseQueryExtractor(object):
         """
         raise NotImplementedError
 
+    def methodParams(self, base_params, method_name, method):
+        """
+            Returns the params dict for one query method, built from the params shared
+            by all methods. It is a new dict every time, as extractMulti() modifies it.
+        """
+        return dict(base_params,
+                    method_name=method_name,
+                    parameters=method["parameters"],
+                    separate_by_tag=method.get("separate_by_tag", ""))
+
+    def extractMultiBatch(self, base_params, methods):
+        """
+            Extracts the queries for all the query methods that use this extractor
+            for the same citation in one call, so that subclasses can do any work
+            shared between the methods only once.
+
+            Args:
+                base_params: dict with the parameters common to all methods (match_start,
+                    match_end, doctext, docfrom, cit, dict_key, options)
+                methods: list of (method_name, method) tuples from exp["qmethods"]
+            Returns:
+                list of query dicts for all methods
+        """
+        res = []
+        for method_name, method in methods:
+            res.extend(self.extractMulti(self.methodParams(base_params, method_name, method)))
+        return res
+
 
 class WindowQueryExtractor(BaseQueryExtractor):
     """
@@ -201,13 +229,10 @@ class WindowQueryExtractor(BaseQueryExtractor):
         """
         return self.extractMulti(params)
 
-    def extractMulti(self, params):
+    def normalizeParameters(self, params):
         """
-            Default method, up to x words left, x words right
-
-            :returns: dict {"left_start", "right_end", "query_method_id", "structured_query"}
+            Makes sure every parameter is a (wleft, wright) tuple
         """
-        ##match, doctext, parameters=[(20,20)], options={"jump_paragraphs":True}
         new_params = []
         for param in params["parameters"]:
             if not isinstance(param, tuple) or isinstance(param, list) or isinstance(param, string_types):
@@ -216,15 +241,56 @@ class WindowQueryExtractor(BaseQueryExtractor):
 
         params["parameters"] = new_params
 
+    def tokenizeContextForParameters(self, params, parameters):
+        """
+            Tokenizes a context wide enough for the largest window in parameters
+        """
         context_params = {
-            "wleft": max([x[0] for x in params["parameters"]]),
-            "wright": max([x[1] for x in params["parameters"]]),
+            "wleft": max([x[0] for x in parameters]),
+            "wright": max([x[1] for x in parameters]),
             "match_start": params["match_start"],
             "match_end": params["match_end"],
             "doctext": params["doctext"],
         }
-        context = self.tokenizeContext(context_params)
+        return self.tokenizeContext(context_params)
 
+    def extractMulti(self, params):
+        """
+            Default method, up to x words left, x words right
+
+            :returns: dict {"left_start", "right_end", "query_method_id", "structured_query"}
+        """
+        ##match, doctext, parameters=[(20,20)], options={"jump_paragraphs":True}
+        self.normalizeParameters(params)
+        context = self.tokenizeContextForParameters(params, params["parameters"])
+        return self.extractFromContext(context, params)
+
+    def extractMultiBatch(self, base_params, methods):
+        """
+            Tokenizes the context around the citation only once, wide enough for
+            the largest window of all methods, and selects every window from it.
+        """
+        all_params = []
+        for method_name, method in methods:
+            params = self.methodParams(base_params, method_name, method)
+            self.normalizeParameters(params)
+            all_params.append(params)
+
+        all_parameters = [parameter for params in all_params for parameter in params["parameters"]]
+        if not all_parameters:
+            return []
+
+        context = self.tokenizeContextForParameters(base_params, all_parameters)
+        res = []
+        for params in all_params:
+            res.extend(self.extractFromContext(context, params))
+        return res
+
+    def extractFromContext(self, context, params):
+        """
+            Extracts a query for each window size in params["parameters"] from
+            the already tokenized context
+        """
         res = []
 
         for parameter in params["parameters"]:
@@ -0,0 +1,81 @@
+# Compiled kernels for counting words over all the sentences of a document at once
+#
+# Copyright:   (c) Daniel Duma 2016
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+import re
+import numpy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# below this many texts the per-text regex is faster than building the buffer
+MIN_TEXTS_FOR_KERNEL = 64
+
+WORD_CHAR_REGEX = re.compile(r"\w", re.UNICODE)
+WORD_REGEX = re.compile(r"\w+", re.UNICODE)
+
+
+def countWordRuns(buf, starts, ends, extra_word_chars, out):
+    """
+        Counts the runs of word characters in each text, same as
+        len(re.findall(r"\\w+", text)).
+
+        :param buf: uint32 array of the code points of all the texts
+        :param starts: text i is buf[starts[i]:ends[i]]
+        :param extra_word_chars: sorted array of the non-ASCII code points that are word characters
+        :param out: int32 array where the count of each text is written
+    """
+    num_extra = extra_word_chars.shape[0]
+    for text in range(starts.shape[0]):
+        count = 0
+        in_word = False
+        for pos in range(starts[text], ends[text]):
+            c = buf[pos]
+            if c < 128:
+                is_word = (48 <= c <= 57) or (65 <= c <= 90) or (97 <= c <= 122) or c == 95
+            else:
+                index = numpy.searchsorted(extra_word_chars, c)
+                is_word = index < num_extra and extra_word_chars[index] == c
+            if is_word and not in_word:
+                count += 1
+            in_word = is_word
+        out[text] = count
+
+
+if NUMBA_AVAILABLE:
+    countWordRuns = numba.njit(cache=True)(countWordRuns)
+
+
+def countWords(texts):
+    """
+        Returns a list with the number of \\w+ matches in each text. Short lists,
+        or when numba isn't installed, just use the regex on each text.
+    """
+    if not NUMBA_AVAILABLE or len(texts) < MIN_TEXTS_FOR_KERNEL:
+        return [len(WORD_REGEX.findall(text)) for text in texts]
+
+    # the newline separator is not a word character, so runs never cross texts
+    try:
+        joined = u"\n".join(texts)
+        buf = numpy.frombuffer(joined.encode("utf-32-le"), dtype=numpy.uint32)
+    except UnicodeError:
+        return [len(WORD_REGEX.findall(text)) for text in texts]
+
+    lengths = numpy.fromiter((len(text) + 1 for text in texts), dtype=numpy.int64, count=len(texts))
+    ends = numpy.cumsum(lengths) - 1
+    starts = ends - lengths + 1
+
+    extra_word_chars = numpy.array(sorted(ord(c) for c in set(joined)
+                                          if ord(c) > 127 and WORD_CHAR_REGEX.match(c)),
+                                   dtype=numpy.uint32)
+    out = numpy.zeros(len(texts), dtype=numpy.int32)
+    countWordRuns(buf, starts, ends, extra_word_chars, out)
+    return out.tolist()
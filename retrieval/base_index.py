@@ -10,6 +10,8 @@ from __future__ import print_function
 from __future__ import absolute_import
 import sys
 import logging
+from multiprocessing.pool import ThreadPool
+from itertools import islice
 from proc.results_logging import ProgressIndicator
 
 import db.corpora as cp
@@ -23,6 +25,15 @@ from celery import group
 
 ES_TYPE_DOC = "doc"
 
+# default number of threads adding documents to the index when not using celery
+DEFAULT_INDEX_WORKERS = 12
+# default number of tasks queued at once when using celery
+DEFAULT_CELERY_BATCH_SIZE = 5000
+
+# fields of the indexes that mix AZ/CoreSC annotations and inlink contexts
+ILC_ANNOTATED_FIELDS = tuple(CORESC_LIST + ["ilc_CSC_" + zone for zone in CORESC_LIST] +
+                             ["_full_ilc", "_all_text", "_full_text"])
+
 
 class BaseIndexer(object):
     """
@@ -43,38 +54,58 @@ class BaseIndexer(object):
         """
         self.initializeIndexer()
 
-        count = 0
-        for guid in testfiles:
-            count += 1
-            print("Building index: paper ", count, "/", len(testfiles), ":", guid)
-
-            fwriters = {}
-            doc = cp.Corpus.loadSciDoc(guid)
-            if not doc:
-                print("Error loading SciDoc for", guid)
-                continue
-
-            indexNames = getDictOfLuceneIndeces(methods)
-
-            for indexName in indexNames:
-                actual_dir = cp.Corpus.getRetrievalIndexPath(guid, indexName, full_corpus=False)
-                fwriters[indexName] = self.createIndexWriter(actual_dir)
-
-            # old way, assuming the documents are fine and one can just load all in-collection references
-            # ...NOT! must select them using the same method that gets the resolvable CITATIONS
-            # updated! Should work well now
-            ##            for ref in doc["references"]:
-            ##                match=cp.Corpus.matcher.matchReference(ref)
-            ##                if match:
-            ##                    ref_guid=match["guid"]
-            # even newer way: just use the precomputed metadata.outlinks
-            outlinks = cp.Corpus.getMetadataByGUID(guid)["outlinks"]
-            for ref_guid in outlinks:
-                addBOWsToIndex(ref_guid, indexNames, 9999, fwriters)
-                # TODO integrate this block below into addBOWsToIndex
+        # all the outlinks are fetched at once instead of one request per file
+        all_metadata = cp.Corpus.getMetadataByGUIDBatch(testfiles, fields=["outlinks"])
+        indexNames = getDictOfLuceneIndeces(methods)
+
+        num_workers = options.get("index_workers", DEFAULT_INDEX_WORKERS)
+        # a single pool for all the files, rather than starting the threads again for each
+        pool = self.createWorkerPool(num_workers)
+        try:
+            count = 0
+            for guid in testfiles:
+                count += 1
+                print("Building index: paper ", count, "/", len(testfiles), ":", guid)
+
+                fwriters = {}
+                doc = cp.Corpus.loadSciDoc(guid)
+                if not doc:
+                    print("Error loading SciDoc for", guid)
+                    continue
 
-            for fwriter in fwriters:
-                fwriters[fwriter].close()
+                for indexName in indexNames:
+                    actual_dir = cp.Corpus.getRetrievalIndexPath(guid, indexName, full_corpus=False)
+                    fwriters[indexName] = self.createIndexWriter(actual_dir)
+
+                # old way, assuming the documents are fine and one can just load all in-collection references
+                # ...NOT! must select them using the same method that gets the resolvable CITATIONS
+                # updated! Should work well now
+                ##            for ref in doc["references"]:
+                ##                match=cp.Corpus.matcher.matchReference(ref)
+                ##                if match:
+                ##                    ref_guid=match["guid"]
+                # even newer way: just use the precomputed metadata.outlinks
+                outlinks = all_metadata[guid]["outlinks"]
+                # each file has its own index, so a reference only needs adding once per file
+                added_refs = set()
+                unique_outlinks = []
+                for ref_guid in outlinks:
+                    if ref_guid in added_refs:
+                        continue
+                    added_refs.add(ref_guid)
+                    unique_outlinks.append(ref_guid)
+
+                # an index missing any of the references is no good, so errors are raised
+                for _ in self.addAllBOWsToIndex(unique_outlinks, indexNames, 9999, fwriters, num_workers,
+                                                raise_errors=True, pool=pool):
+                    pass
+
+                for fwriter in fwriters:
+                    fwriters[fwriter].close()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
 
     def listFieldsToIndex(self, index_data):
         """
@@ -89,14 +120,11 @@ class BaseIndexer(object):
         elif index_data["type"] in ["inlink_context"]:
             pass
         elif index_data["type"] in ["ilc_mashup"]:
-            field_list = CORESC_LIST + ["ilc_CSC_" + zone for zone in CORESC_LIST]
-            field_list.extend(["_full_ilc", "_all_text", "_full_text"])
-            return field_list
+            # a new list every time, createIndex() adds to it
+            return list(ILC_ANNOTATED_FIELDS)
         elif index_data["type"] in ["standard_multi"]:
             if index_data["method"] in ["az_annotated", "ilc_annotated"]:
-                field_list = CORESC_LIST + ["ilc_CSC_" + zone for zone in CORESC_LIST]
-                field_list.extend(["_full_ilc", "_all_text", "_full_text"])
-                return field_list
+                return list(ILC_ANNOTATED_FIELDS)
             else:
                 # this is the standard BOW name
                 return ["text"]
@@ -122,25 +150,47 @@ class BaseIndexer(object):
 
         max_results = options.get("max_files_to_process", sys.maxsize)
 
-        # conditions = [{"range": {"metadata.year": {"lt": index_max_year}}}]
-        conditions = "metadata.year:<=%d" % index_max_year
-        ALL_GUIDS = cp.Corpus.listPapers(conditions, max_results=max_results)
+        if index_max_year:
+            conditions = [{"range": {"metadata.year": {"lte": index_max_year}}}]
+        else:
+            conditions = None
+        # guids are streamed from the corpus as they are added, not listed upfront
+        ALL_GUIDS = cp.Corpus.iterPapers(conditions, max_results=max_results)
+        num_guids = min(cp.Corpus.countPapers(conditions), max_results)
+        index_dirs = []
         for indexName in indexNames:
             actual_dir = cp.Corpus.getRetrievalIndexPath("ALL_GUIDS", indexName, full_corpus=True)
             fields = self.listFieldsToIndex(indexNames[indexName])
-            self.createIndex(actual_dir, fields, options.get("force_recreate_indexes", False))
+            self.createIndex(actual_dir, fields, options.get("force_recreate_indexes", False), bulk_load=True)
+            index_dirs.append(actual_dir)
             fwriters[indexName] = self.createIndexWriter(actual_dir)
 
-        numfiles = len(ALL_GUIDS) - options.get("index_start_at", 0)
+        try:
+            self.addAllToGeneralIndex(ALL_GUIDS, num_guids, indexNames, index_max_year, fwriters, options)
+        finally:
+            for actual_dir in index_dirs:
+                self.finishBulkLoad(actual_dir)
+
+    def addAllToGeneralIndex(self, ALL_GUIDS, num_guids, indexNames, index_max_year, fwriters, options):
+        """
+            Adds the BOWs of every paper in ALL_GUIDS to the general indexes,
+            locally or through celery
+
+            :param ALL_GUIDS: iterable of guids
+            :param num_guids: how many guids ALL_GUIDS yields
+        """
+        numfiles = max(num_guids - options.get("index_start_at", 0), 0)
         print("Adding", numfiles, "files:")
 
+        guids = islice(ALL_GUIDS, options.get("index_start_at", 0), None)
+
         missing_bows = []
         if not self.use_celery:
             progress = ProgressIndicator(True, numfiles, print_out=False)
-            for guid in ALL_GUIDS[options.get("index_start_at", 0):]:
-                try:
-                    addBOWsToIndex(guid, indexNames, index_max_year, fwriters)
-                except:
+            num_workers = options.get("index_workers", DEFAULT_INDEX_WORKERS)
+
+            for guid, success in self.addAllBOWsToIndex(guids, indexNames, index_max_year, fwriters, num_workers):
+                if not success:
                     missing_bows.append(guid)
                     continue
 
@@ -151,28 +201,83 @@ class BaseIndexer(object):
                 fwriters[fwriter].close()
             progress.close()
         else:
-            print("Queueing up files for import...")
             # progress = ProgressIndicator(True, len(ALL_GUIDS), print_out=False)
-            all_tasks = []
-
-            for guid in ALL_GUIDS[options.get("index_start_at", 0):]:
-                all_tasks.append(addToindexTask.s(
-                    guid,
-                    indexNames,
-                    index_max_year))
+            batch_size = options.get("index_celery_batch_size", DEFAULT_CELERY_BATCH_SIZE)
+            num_queued = 0
 
-            jobs = group(all_tasks)
-
-            result = jobs.apply_async(queue="add_to_index", exchange="add_to_index", route_name="add_to_index")
-            print("Waiting for tasks to complete...")
+            # only one batch of tasks is queued at a time, so the broker isn't flooded
             try:
-                result.join()
+                while True:
+                    batch = list(islice(guids, batch_size))
+                    if not batch:
+                        break
+
+                    print("Queueing up files for import...")
+                    jobs = group(addToindexTask.s(guid, indexNames, index_max_year) for guid in batch)
+
+                    result = jobs.apply_async(queue="add_to_index", exchange="add_to_index",
+                                              route_name="add_to_index")
+                    num_queued += len(batch)
+                    print("Waiting for tasks to complete...", num_queued, "/", numfiles)
+                    result.join()
             except KeyboardInterrupt:
                 print("KeyboardInterrupt: Skipping to next stage")
                 pass
             for fwriter in fwriters:
                 fwriters[fwriter].close()
         # print("All missing BOWs:\n", missing_bows)
+
+    def createWorkerPool(self, num_workers):
+        """
+            Returns a pool of num_workers threads to add documents to the
+            index, or None if there is only one worker
+        """
+        if num_workers <= 1:
+            return None
+        # each document is an Elasticsearch round-trip, so threads are enough to overlap them
+        return ThreadPool(num_workers, initializer=self.initializeWorkerThread)
+
+    def addAllBOWsToIndex(self, guids, indexNames, index_max_year, fwriters, num_workers=1, raise_errors=False,
+                          pool=None):
+        """
+            Calls addBOWsToIndex for every guid, from num_workers threads if
+            more than one. Yields (guid, success) as each one is done.
+
+            :param raise_errors: if True, an exception adding any guid is
+                raised instead of logged and yielded as a failure
+            :param pool: pool from createWorkerPool() to use instead of creating
+                one. It is left running for the caller to reuse.
+        """
+
+        def addGuid(guid):
+            try:
+                addBOWsToIndex(guid, indexNames, index_max_year, fwriters)
+            except Exception:
+                if raise_errors:
+                    raise
+                logging.exception("Error adding BOWs of %s to index", guid)
+                return guid, False
+            return guid, True
+
+        if pool is not None:
+            for added in pool.imap_unordered(addGuid, guids):
+                yield added
+            return
+
+        pool = self.createWorkerPool(num_workers)
+        if pool is None:
+            for guid in guids:
+                yield addGuid(guid)
+            return
+
+        try:
+            for added in pool.imap_unordered(addGuid, guids):
+                yield added
+        finally:
+            # all tasks are done unless interrupted, then don't start any more
+            pool.terminate()
+            pool.join()
+
     # -------------------------------------------------------------------------------
     #  Methods to be overriden in descendant classes
     # -------------------------------------------------------------------------------
@@ -183,13 +288,30 @@ class BaseIndexer(object):
         """
         pass
 
-    def createIndex(self, index_name, fields, force_recreate=False):
+    def initializeWorkerThread(self):
+        """
+            Any previous step that is needed in each thread that adds
+            documents to the index
+        """
+        pass
+
+    def createIndex(self, index_name, fields, force_recreate=False, bulk_load=False):
         """
             Create the actual index. Elastic requires this in order to
             specify the mapping, Lucene doesn't
+
+            :param bulk_load: if True, the index is about to get many documents
+                at once and can be set up for that, until finishBulkLoad() is
+                called
         """
         raise NotImplementedError
 
+    def finishBulkLoad(self, index_name):
+        """
+            Undoes any setup for bulk loading done by createIndex()
+        """
+        pass
+
     def createIndexWriter(self, actual_dir, max_field_length=20000000):
         """
             Returns an IndexWriter object created for the actual_dir specified
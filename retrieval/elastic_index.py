@@ -10,37 +10,58 @@ from __future__ import print_function
 import json
 
 from elasticsearch import Elasticsearch
+from db.elastic_serializer import serializerOptions
 from .base_index import BaseIndexer
 from retrieval.elastic_retrieval import ES_TYPE_DOC
 from . import index_functions
-from .elastic_writer import BufferedElasticWriter
+from .elastic_writer import BufferedElasticWriter, DEFAULT_BULK_CHUNK_SIZE, DEFAULT_BULK_MAX_CHUNK_BYTES
 
 DEFAULT_TIMEOUT = 360
 
+# settings while bulk loading an index and after it's loaded
+BULK_LOAD_SETTINGS = {
+    "refresh_interval": "-1",
+    "translog.flush_threshold_size": "1gb"
+}
+AFTER_BULK_LOAD_SETTINGS = {
+    "refresh_interval": "30s"
+}
+
 
 class ElasticIndexer(BaseIndexer):
     """
         Prebuilds BOWs etc. for tests
     """
 
-    def __init__(self, endpoint={"host": "localhost", "port": 9200}, use_celery=False):
+    def __init__(self, endpoint={"host": "localhost", "port": 9200}, use_celery=False,
+                 bulk_chunk_size=DEFAULT_BULK_CHUNK_SIZE, bulk_max_chunk_bytes=DEFAULT_BULK_MAX_CHUNK_BYTES):
         """
+            :param bulk_chunk_size: documents sent to Elastic in each bulk request
+            :param bulk_max_chunk_bytes: max size of each bulk request
         """
         super(self.__class__, self).__init__(use_celery)
-        self.es = Elasticsearch([endpoint], timeout=DEFAULT_TIMEOUT, max_retries=5)
+        self.bulk_chunk_size = bulk_chunk_size
+        self.bulk_max_chunk_bytes = bulk_max_chunk_bytes
+        # indexes in bulk loading mode, see createIndex()
+        self.bulk_loading = set()
+        self.es = Elasticsearch([endpoint], timeout=DEFAULT_TIMEOUT, max_retries=5, **serializerOptions())
         self.es.retry_on_timeout = True
         info = self.es.info()
         # print(info)
         self.es_version = int(info["version"]["number"][0])
 
-    def createIndex(self, index_name, fields, force_recreate=False):
+    def createIndex(self, index_name, fields, force_recreate=False, bulk_load=False):
         """
             Creates the Elastic index
+
+            With bulk_load, refreshing is turned off until finishBulkLoad()
         """
         settings = {
             "number_of_shards": 1,
             "number_of_replicas": 0
         }
+        if bulk_load:
+            settings.update(BULK_LOAD_SETTINGS)
 
         fields.append("_full_text")
         if self.es_version > 2:
@@ -72,12 +93,32 @@ class ElasticIndexer(BaseIndexer):
                 body={"settings": settings, "mappings": {ES_TYPE_DOC: {"properties": properties}}})
         else:
             print(("Index %s already exists" % index_name))
+            if bulk_load:
+                self.es.indices.put_settings(index=index_name, body={"index": BULK_LOAD_SETTINGS})
+
+        if bulk_load:
+            self.bulk_loading.add(index_name)
+
+    def finishBulkLoad(self, index_name):
+        """
+            Turns refreshing back on and merges the segments of the index
+        """
+        if index_name not in self.bulk_loading:
+            return
+
+        self.bulk_loading.discard(index_name)
+        self.es.indices.put_settings(index=index_name, body={"index": AFTER_BULK_LOAD_SETTINGS})
+        self.es.indices.refresh(index=index_name)
+        self.es.indices.forcemerge(index=index_name, max_num_segments=1)
 
     def createIndexWriter(self, actual_dir, max_field_length=20000000):
         """
             Returns an IndexWriter object created for the actual_dir specified
         """
-        res = BufferedElasticWriter(actual_dir, self.es)
+        res = BufferedElasticWriter(actual_dir, self.es,
+                                    bufsize=self.bulk_chunk_size,
+                                    max_chunk_bytes=self.bulk_max_chunk_bytes,
+                                    manage_refresh=actual_dir not in self.bulk_loading)
         return res
 
 
@@ -11,6 +11,7 @@ import logging, sys
 
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import ConnectionError, TransportError
+from db.elastic_serializer import serializerOptions
 
 import db.corpora as cp
 from .base_retrieval import BaseRetrieval, SPECIAL_FIELDS_FOR_TESTS, MAX_RESULTS_RECALL
@@ -39,7 +40,7 @@ class ElasticRetrieval(BaseRetrieval):
             if cp.Corpus.__class__.__name__ == "ElasticCorpus":
                 self.es = cp.Corpus.es
             else:
-                self.es = Elasticsearch(timeout=QUERY_TIMEOUT)
+                self.es = Elasticsearch(timeout=QUERY_TIMEOUT, **serializerOptions())
 
         if not cp.Corpus.isIndexOpen(self.index_name):
             try:
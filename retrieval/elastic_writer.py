@@ -9,6 +9,11 @@ from __future__ import absolute_import
 from .elastic_retrieval import ES_TYPE_DOC
 from elasticsearch.helpers import bulk
 import time, datetime
+import threading
+
+# documents sent in each bulk request, and the most bytes each request can take
+DEFAULT_BULK_CHUNK_SIZE = 1000
+DEFAULT_BULK_MAX_CHUNK_BYTES = 10 * 1024 * 1024
 
 
 class ElasticWriter(object):
@@ -66,14 +71,24 @@ class BufferedElasticWriter(object):
         Like ElasticWriter but writes out using the bulk API
     """
 
-    def __init__(self, index_name, es_instance, bufsize=100):
+    def __init__(self, index_name, es_instance, bufsize=DEFAULT_BULK_CHUNK_SIZE,
+                 max_chunk_bytes=DEFAULT_BULK_MAX_CHUNK_BYTES, manage_refresh=True):
         """
-
+            :param bufsize: number of documents to buffer before sending them,
+                also the chunk_size of each bulk request
+            :param max_chunk_bytes: max size of each bulk request
+            :param manage_refresh: if True, turns off refreshing the index while
+                flushing the buffer and merges it after. Pass False if this is
+                already taken care of for the whole load
         """
         self.es = es_instance
         self.index_name = index_name
         self.buffer = []
         self.bufsize = bufsize
+        self.max_chunk_bytes = max_chunk_bytes
+        self.manage_refresh = manage_refresh
+        # documents can be added from several threads at once
+        self.lock = threading.Lock()
 
     def createIndex(self, index_name):
         """
@@ -96,12 +111,28 @@ class BufferedElasticWriter(object):
             ignore_unavailable=True
         )
 
-    def flushBuffer(self):
+    def takeBuffer(self):
+        """
+            Returns the buffered documents and empties the buffer
+        """
+        with self.lock:
+            docs = self.buffer
+            self.buffer = []
+        return docs
+
+    def flushBuffer(self, docs=None):
+        """
+            Writes out the buffered documents, or @docs if given
+        """
+        if docs is None:
+            docs = self.takeBuffer()
+
         actions = []
 
-        self.setIndexRefresh("-1")
+        if self.manage_refresh:
+            self.setIndexRefresh("-1")
 
-        for doc in self.buffer:
+        for doc in docs:
             id = doc["metadata"]["guid"]
             actions.append({
                 '_index': self.index_name,
@@ -118,13 +149,16 @@ class BufferedElasticWriter(object):
         success = False
         while not success:
             try:
-                bulk(self.es, actions)
+                bulk(self.es, actions, chunk_size=self.bufsize, max_chunk_bytes=self.max_chunk_bytes)
                 success=True
             except Exception as e:
                 print(e)
                 print(datetime.datetime.now(),"Exception running bulk(). Waiting for 5 sec and retrying.")
                 time.sleep(5)
 
+        if not self.manage_refresh:
+            return
+
         try:
             self.setIndexRefresh("10s")
         except Exception as e:
@@ -141,8 +175,6 @@ class BufferedElasticWriter(object):
             print(e)
             time.sleep(5)
 
-        self.buffer = []
-
     def addDocument(self, doc):
         """
             Emulate LuceneIndexWriter.addDocument for elastic
@@ -151,9 +183,16 @@ class BufferedElasticWriter(object):
             stored. Metadata contains the GUID to index it by
             :type doc:dict
         """
-        self.buffer.append(doc)
-        if len(self.buffer) >= self.bufsize:
-            self.flushBuffer()
+        docs = None
+        with self.lock:
+            self.buffer.append(doc)
+            if len(self.buffer) >= self.bufsize:
+                docs = self.buffer
+                self.buffer = []
+
+        # the bulk request is sent outside the lock, so other threads can keep adding
+        if docs:
+            self.flushBuffer(docs)
 
     def close(self):
         """
@@ -50,6 +50,12 @@ class LuceneIndexer(BaseIndexer):
         baseFullIndexDir=cp.Corpus.paths.fileLuceneIndex+os.sep
         ensureDirExists(baseFullIndexDir)
 
+    def initializeWorkerThread(self):
+        """
+            Attaches the thread to the Java VM, or it can't call Lucene
+        """
+        lucene.getVMEnv().attachCurrentThread()
+
     def createIndexWriter(self, actual_dir, max_field_length=20000000):
         """
             Returns an IndexWriter object created for the actual_dir specified
@@ -9,29 +9,65 @@ from __future__ import absolute_import
 import re
 from collections import defaultdict
 import six
+from six.moves import intern
 from functools import reduce
+import numpy
 
 TERM_POSITION_IN_TUPLE = 6
 
+# patterns for the descriptions of the parts of a Lucene/Elastic explanation
+WEIGHT_FIELD_REGEX = re.compile(r"weight\((.*?)\:", re.IGNORECASE)
+WEIGHT_FIELD_TERM_REGEX = re.compile(r"weight\((.*?)\:(.*?)\sin", re.IGNORECASE)
+IDF_REGEX = re.compile(r"idf\(docFreq=(\d+),\smaxDocs=(\d+).*?\)", re.IGNORECASE)
+TF_REGEX = re.compile(r"tf\(freq=(.+?)\).*", re.IGNORECASE)
 
-class StoredFormula:
+# one shared copy of each query term in the hits, like intern() does for
+# the field names, which doesn't work with unicode in Python 2
+TERM_CACHE = {}
+
+# opcodes of the flattened formula, see StoredFormula.compileProgram()
+OP_HIT = 0
+OP_SUM = 1
+OP_PROD = 2
+OP_MAX = 3
+OP_CONST = 4
+
+
+class StoredFormula(object):
     """
         Stores a Lucene explanation and makes it easy to set weights on the
         formula post-hoc and recompute
     """
 
+    # there can be millions of these in memory at once
+    __slots__ = ("formula", "round_to_decimal_places", "program", "program_source", "default_score")
+
     def __init__(self, formula=None):
         if formula:
             self.formula = formula
         else:
             self.formula = {}
         self.round_to_decimal_places = 4
+        # postfix version of self.formula, built the first time it's scored
+        self.program = None
+        self.program_source = None
+        # score with no parameters, which never changes for the same formula
+        self.default_score = None
 
     def __getitem__(self, key):
         return self.formula[key]
 
     def __setitem__(self, key, item):
         self.formula[key] = item
+        self.program = None
+        self.default_score = None
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        for name in state:
+            setattr(self, name, state[name])
 
     def truncate(self, f, n):
         '''Truncates/pads a float f to n decimal places without rounding'''
@@ -66,7 +102,7 @@ class StoredFormula:
 
         for match in matches:
             desc = match.getDescription()
-            field = re.match(r"weight\((.*?)\:", desc, re.IGNORECASE)
+            field = WEIGHT_FIELD_REGEX.match(desc)
             # using dicts
             ##            newMatch={"field":field.group(1)}
             ##            elem=match.getDetails()[0]
@@ -92,7 +128,7 @@ class StoredFormula:
             ##                newMatch.fw=elements[1].getValue()
 
             # using tuple
-            field_name = str(field.group(1))
+            field_name = intern(str(field.group(1)))
             elem = match.getDetails()[0]
             if "fieldWeight" in elem.getDescription():
                 # if the queryWeight is 1, .explain() will not report it
@@ -141,10 +177,12 @@ class StoredFormula:
                 docFreq = None
                 maxDocs = None
 
-                field = re.match(r"weight\((.*?)\:(.*?)\sin", detail["description"], re.IGNORECASE)
+                field = WEIGHT_FIELD_TERM_REGEX.match(detail["description"])
                 if field:
-                    field_name = str(field.group(1))
+                    # the same few field names are in every hit
+                    field_name = intern(str(field.group(1)))
                     term = six.text_type(field.group(2))
+                    term = TERM_CACHE.setdefault(term, term)
                     elem = detail["details"][0]
                     if elem["description"].startswith("fieldWeight"):
                         qw = 1.0
@@ -165,19 +203,24 @@ class StoredFormula:
                         for element in elements:
                             if docFreq and tf:
                                 break
-                            for detail in element["details"]:
-                                idf_match = re.match(r"idf\(docFreq=(\d+),\smaxDocs=(\d+).*?\)", detail["description"],
-                                                     re.IGNORECASE)
-                                if idf_match:
-                                    docFreq = int(idf_match.group(1))
-                                    maxDocs = int(idf_match.group(2))
-                                    break
-
-                            for detail in element["details"]:
-                                tf_match = re.match(r"tf\(freq=(.+?)\).*", detail["description"],
-                                                     re.IGNORECASE)
-                                if tf_match:
-                                    tf = int(float(tf_match.group(1)))
+                            # one walk over the details, only the first idf and tf of each element count
+                            found_idf = False
+                            found_tf = False
+                            for sub_detail in element["details"]:
+                                description = sub_detail["description"]
+                                prefix = description[:4].lower()
+                                if not found_idf and prefix == "idf(":
+                                    idf_match = IDF_REGEX.match(description)
+                                    if idf_match:
+                                        docFreq = int(idf_match.group(1))
+                                        maxDocs = int(idf_match.group(2))
+                                        found_idf = True
+                                elif not found_tf and prefix[:3] == "tf(":
+                                    tf_match = TF_REGEX.match(description)
+                                    if tf_match:
+                                        tf = int(float(tf_match.group(1)))
+                                        found_tf = True
+                                if found_idf and found_tf:
                                     break
 
                         if save_terms:
@@ -213,28 +256,30 @@ class StoredFormula:
             Recursive. Call with None or
             formula.formula as parameter first, it will iterate from there.
 
+            The whole formula is scored by running its postfix version (see
+            compileProgram()), which is built once and reused for every new
+            set of parameters. Its score without parameters is only computed
+            once.
+
             :param part: tuple, list or dict
             :returns: floating-point score
         """
         if part is None:
             part = self.formula
 
-        if isinstance(part, tuple) or isinstance(part, list):
-            if field_parameters:
-                field_multiplier = field_parameters[part[0]]
-            else:
-                field_multiplier = 1
-
-            if kw_parameters:
-                if len(part) <= 3:
-                    raise ValueError("Record missing 4th parameter: <term>")
-                query_weight = kw_parameters.get(part[TERM_POSITION_IN_TUPLE], 0) * part[1]
-                # part[TERM_POSITION_IN_TUPLE] should be the actual term string.
-                # NOTE: only matching exact terms. If kw not in dict, score of 0
-            else:
-                query_weight = part[1]  # qw
+        if part is self.formula and isinstance(part, dict):
+            if self.program is None or self.program_source is not self.formula:
+                self.program = self.compileProgram(self.formula)
+                self.program_source = self.formula
+                self.default_score = None
+            if not field_parameters and not kw_parameters:
+                if self.default_score is None:
+                    self.default_score = self.runProgram(self.program)
+                return self.default_score
+            return self.runProgram(self.program, field_parameters, kw_parameters)
 
-            return query_weight * field_multiplier * part[2]  # qw * param * fw (tf * idf * fieldNorm)
+        if isinstance(part, tuple) or isinstance(part, list):
+            return self.computeHitScore(part, field_parameters, kw_parameters)
 
         elif isinstance(part, dict):
             if part["type"] in ["*", "+", "max"]:
@@ -255,6 +300,260 @@ class StoredFormula:
         else:
             raise ValueError("Unexpected type %s" % type(part))
 
+    def computeHitScore(self, part, field_parameters=None, kw_parameters=None):
+        """
+            Score of a single hit of the formula: a (field, qw, fw, ...) tuple
+        """
+        if field_parameters:
+            field_multiplier = field_parameters[part[0]]
+        else:
+            field_multiplier = 1
+
+        if kw_parameters:
+            if len(part) <= 3:
+                raise ValueError("Record missing 4th parameter: <term>")
+            query_weight = kw_parameters.get(part[TERM_POSITION_IN_TUPLE], 0) * part[1]
+            # part[TERM_POSITION_IN_TUPLE] should be the actual term string.
+            # NOTE: only matching exact terms. If kw not in dict, score of 0
+        else:
+            query_weight = part[1]  # qw
+
+        return query_weight * field_multiplier * part[2]  # qw * param * fw (tf * idf * fieldNorm)
+
+    def compileProgram(self, part):
+        """
+            Flattens a formula into a list of operations in postfix order: the
+            operands of every operation come before it. Hits are (OP_HIT, hit),
+            constants (OP_CONST, value) and the rest (OP_SUM/OP_PROD/OP_MAX, n)
+            where n is the number of operands.
+
+            Multiplying by a constant 1 (e.g. coord when all clauses match)
+            changes nothing, so those constants are left out of products.
+
+            :param part: tuple, list or dict
+            :returns: list of tuples, to be run with runProgram()
+        """
+        program = []
+
+        def isUnitConstant(part):
+            return isinstance(part, dict) and part["type"] in ["const", "coord"] and part["value"] == 1
+
+        def addPart(part):
+            if isinstance(part, tuple) or isinstance(part, list):
+                program.append((OP_HIT, part))
+            elif isinstance(part, dict):
+                if part["type"] == "*":
+                    factors = [sub_part for sub_part in part["parts"] if not isUnitConstant(sub_part)]
+                    if not factors:
+                        factors = part["parts"]
+                    for sub_part in factors:
+                        addPart(sub_part)
+                    if len(factors) > 1:
+                        program.append((OP_PROD, len(factors)))
+                elif part["type"] in ["+", "max"]:
+                    for sub_part in part["parts"]:
+                        addPart(sub_part)
+                    if part["type"] == "+":
+                        program.append((OP_SUM, len(part["parts"])))
+                    else:
+                        program.append((OP_MAX, len(part["parts"])))
+                elif part["type"] in ["const", "coord"]:
+                    assert (part["value"] is not None)
+                    program.append((OP_CONST, part["value"]))
+                else:
+                    raise ValueError("Unexpected operation type: %s" % part["type"])
+            else:
+                raise ValueError("Unexpected type %s" % type(part))
+
+        addPart(part)
+        return program
+
+    def runProgram(self, program, field_parameters=None, kw_parameters=None):
+        """
+            Computes the score of a formula compiled with compileProgram(), the
+            same as computeScore() would, using a stack instead of recursion
+        """
+        stack = []
+        default_weights = not field_parameters and not kw_parameters
+        for op, arg in program:
+            if op == OP_HIT:
+                if default_weights:
+                    # qw * fw, what computeHitScore() returns with no parameters
+                    stack.append(arg[1] * arg[2])
+                else:
+                    stack.append(self.computeHitScore(arg, field_parameters, kw_parameters))
+            elif op == OP_CONST:
+                stack.append(arg)
+            else:
+                operands = stack[len(stack) - arg:]
+                del stack[len(stack) - arg:]
+                if op == OP_SUM:
+                    stack.append(sum(operands))
+                elif op == OP_PROD:
+                    stack.append(reduce(lambda x, y: x * y, operands))
+                else:
+                    stack.append(max(operands))
+        return stack[0]
+
+    def linearCoefficients(self, part=None):
+        """
+            Decomposes the formula into a linear function of the per-field
+            weights, so that computeScore(part, field_parameters) ==
+            const + sum(coefs[field] * field_parameters[field]).
+
+            Recursive, like computeScore(). Only field weights are considered,
+            not per-keyword weights.
+
+            :param part: tuple, list or dict
+            :returns: tuple (coefs, const) where coefs is a dict {field: coefficient},
+                or None if the score is not linear in the field weights (e.g. it
+                contains a "max" over parts that depend on them)
+        """
+        if part is None:
+            part = self.formula
+
+        if isinstance(part, tuple) or isinstance(part, list):
+            return {part[0]: part[1] * part[2]}, 0.0
+
+        elif isinstance(part, dict):
+            if part["type"] in ["const", "coord"]:
+                assert (part["value"] is not None)
+                return {}, part["value"]
+            elif part["type"] not in ["*", "+", "max"]:
+                raise ValueError("Unexpected operation type: %s" % part["type"])
+
+            sub_parts = []
+            for sub_part in part["parts"]:
+                linear = self.linearCoefficients(sub_part)
+                if linear is None:
+                    return None
+                sub_parts.append(linear)
+
+            if part["type"] == "+":
+                coefs = defaultdict(float)
+                for sub_coefs, _ in sub_parts:
+                    for field in sub_coefs:
+                        coefs[field] += sub_coefs[field]
+                return dict(coefs), sum(const for _, const in sub_parts)
+
+            variable_parts = [(sub_coefs, const) for sub_coefs, const in sub_parts if sub_coefs]
+            if part["type"] == "max":
+                if variable_parts:
+                    return None
+                return {}, max(const for _, const in sub_parts)
+
+            # a product stays linear as long as only one of its factors depends on the weights
+            if len(variable_parts) > 1:
+                return None
+            multiplier = reduce(lambda x, y: x * y, [const for sub_coefs, const in sub_parts if not sub_coefs], 1)
+            if not variable_parts:
+                return {}, multiplier
+            coefs, const = variable_parts[0]
+            return {field: coefs[field] * multiplier for field in coefs}, const * multiplier
+        else:
+            raise ValueError("Unexpected type %s" % type(part))
+
+
+class StoredFormulaBatch(object):
+    """
+        Scores many stored formulas at once for the same parameters.
+
+        Formulas that are just a sum of hits, which is the most common shape,
+        are flattened into parallel arrays with one element per hit, so all of
+        them are scored with a few vectorized operations. Any other formula is
+        scored on its own with StoredFormula.computeScore().
+    """
+
+    def __init__(self, formulas):
+        """
+            :param formulas: list of formulas, as in StoredFormula.formula
+        """
+        self.num_formulas = len(formulas)
+        self.fields = {}
+        self.terms = {}
+        # formulas that aren't a flat sum of hits: (position, StoredFormula)
+        self.other_formulas = []
+
+        formula_index = []
+        field_index = []
+        term_index = []
+        qw = []
+        fw = []
+        self.has_terms = True
+
+        for index, formula in enumerate(formulas):
+            hits = self.getFlatHits(formula)
+            if hits is None:
+                self.other_formulas.append((index, StoredFormula(formula)))
+                continue
+
+            for hit in hits:
+                formula_index.append(index)
+                field_index.append(self.fields.setdefault(hit[0], len(self.fields)))
+                qw.append(hit[1])
+                fw.append(hit[2])
+                if len(hit) > TERM_POSITION_IN_TUPLE:
+                    term_index.append(self.terms.setdefault(hit[TERM_POSITION_IN_TUPLE], len(self.terms)))
+                else:
+                    self.has_terms = False
+                    term_index.append(-1)
+
+        self.formula_index = numpy.array(formula_index, dtype=numpy.int64)
+        self.field_index = numpy.array(field_index, dtype=numpy.int64)
+        self.term_index = numpy.array(term_index, dtype=numpy.int64)
+        self.qw = numpy.array(qw, dtype=numpy.float64)
+        self.fw = numpy.array(fw, dtype=numpy.float64)
+
+    def getFlatHits(self, formula):
+        """
+            Returns the hits of a formula that is a single hit or a sum of hits,
+            or None for any other formula
+        """
+        if isinstance(formula, (tuple, list)):
+            hits = [formula]
+        elif isinstance(formula, dict) and formula.get("type") == "+" and \
+                all(isinstance(part, (tuple, list)) for part in formula["parts"]):
+            hits = formula["parts"]
+        else:
+            return None
+
+        # the term is only needed when scoring keyword weights, which
+        # computeScores() checks for
+        if any(len(hit) < 3 for hit in hits):
+            return None
+        return hits
+
+    def computeScores(self, field_parameters=None, kw_parameters=None):
+        """
+            Computes the score of every formula, the same as
+            StoredFormula.computeScore() would
+
+            :returns: list of floats, one per formula
+        """
+        # same order of operations as computeHitScore(), so the scores are identical
+        if kw_parameters:
+            if not self.has_terms:
+                raise ValueError("Record missing 4th parameter: <term>")
+            term_weights = numpy.zeros(len(self.terms), dtype=numpy.float64)
+            for term in self.terms:
+                term_weights[self.terms[term]] = kw_parameters.get(term, 0)
+            hit_scores = term_weights[self.term_index] * self.qw
+        else:
+            hit_scores = self.qw.copy()
+
+        if field_parameters:
+            field_weights = numpy.zeros(len(self.fields), dtype=numpy.float64)
+            for field in self.fields:
+                field_weights[self.fields[field]] = field_parameters[field]
+            hit_scores *= field_weights[self.field_index]
+
+        hit_scores *= self.fw
+        scores = numpy.bincount(self.formula_index, weights=hit_scores, minlength=self.num_formulas).tolist()
+
+        for index, formula in self.other_formulas:
+            scores[index] = formula.computeScore(formula.formula, field_parameters, kw_parameters)
+        return scores
+
 
 def main():
     pass
@@ -10,17 +10,57 @@ from __future__ import print_function
 
 from __future__ import absolute_import
 import json, sys, re
-from copy import deepcopy
+from collections import OrderedDict
 
-from proc.nlp_functions import rx_word_boundaries, replaceXMLCitationsWithUnderscoreCitations, AUTHOR_MARKER, \
+from multiprocessing.pool import ThreadPool
+
+from proc.general_utils import loadJSON, loadJSONBytes, loadFileBytes, dumpJSONBytes, saveJSONDictStreamed
+from proc.text_kernels import countWords
+from proc.nlp_functions import replaceXMLCitationsWithUnderscoreCitations, AUTHOR_MARKER, \
     CIT_MARKER, cleanXML
 from scidoc.citation_utils import CITATION_FORM
 from scidoc.reference_formatting import formatAPACitationAuthors, formatReference
 import six
 
-SENTENCE_TYPES = ["s", "fig-caption", "s-li"]
-PARAGRAPH_TYPES = ["p", "footnote", "p-li"]
-SECTION_TYPES = ["section"]
+SENTENCE_TYPES = frozenset(["s", "fig-caption", "s-li"])
+PARAGRAPH_TYPES = frozenset(["p", "footnote", "p-li"])
+SECTION_TYPES = frozenset(["section"])
+
+# element type -> kind, so adding an element takes a single lookup
+ELEMENT_KIND_BY_TYPE = {}
+ELEMENT_KIND_BY_TYPE.update((element_type, "sentence") for element_type in SENTENCE_TYPES)
+ELEMENT_KIND_BY_TYPE.update((element_type, "paragraph") for element_type in PARAGRAPH_TYPES)
+ELEMENT_KIND_BY_TYPE.update((element_type, "section") for element_type in SECTION_TYPES)
+ABSTRACT_HEADER = "abstract"
+
+# threads reading files ahead in loadSciDocs()
+DEFAULT_LOAD_WORKERS = 8
+
+CITATION_TAG_REGEX = re.compile(r"<cit\sid=(.{1,6})\s?/>", re.IGNORECASE)
+# maximum number of characters between two citations of the same cluster
+MULTI_CITATION_MAX_GAP = 7
+XREF_CITATION_REGEX = re.compile(r"<xref.*?rid=\"(.*?)\".*?>(.*?)</xref>", re.IGNORECASE | re.DOTALL)
+AUTHOR_IN_PARENTHESES_REGEX = re.compile(r"\(\s*\_\_author\s*\.\)?")
+WORD_BEFORE_CIT_REGEX = re.compile(r"(\w)" + re.escape(CIT_MARKER))
+AUTHOR_YEAR_REGEX = re.compile(re.escape(AUTHOR_MARKER) + r"\s*\(\d+\w?\)")
+CAPITAL_LETTER_REGEX = re.compile("[A-Z]")
+# rewrites of re.escape()'d author mentions. Python 3.7+ no longer escapes spaces
+ESCAPED_ET_AL_REGEX = re.compile(r"al\\\.")
+ESCAPED_AND_REGEX = re.compile(r"\\? and\\? ")
+ESCAPED_SPACE_REGEX = re.compile(r"\\? ")
+
+
+def copyJSONData(data):
+    """
+        Copies the nested dicts and lists of JSON-like data. Much faster than
+        deepcopy(), as there are no cycles or shared objects to keep track of
+        and anything else is immutable.
+    """
+    if isinstance(data, dict):
+        return {key: copyJSONData(value) for key, value in six.iteritems(data)}
+    if isinstance(data, list):
+        return [copyJSONData(value) for value in data]
+    return data
 
 
 class SciDoc(object):
@@ -74,10 +114,16 @@ class SciDoc(object):
         self.glob = {}
         self.ignore_errors = ignore_errors if ignore_errors else []
         self.known_author_strings = None
+        # known_author_strings compiled into a single alternation, with what can
+        # follow each one. known_author_regexes is the fallback if that fails
+        self.known_authors_regex = None
+        self.known_author_regexes = []
 
         if data:
             if isinstance(data, six.string_types):
-                self.loadFromFile(data)
+                # loadFromFile() already builds the lists and dicts
+                if self.loadFromFile(data):
+                    return
             elif isinstance(data, dict) and "content" in data and "references" in data and "metadata" in data:
                 self.data = data
 
@@ -103,11 +149,15 @@ class SciDoc(object):
             Updates the dicts for a single item, typically to be used just after
             an item has been added
         """
-        if self.isSentence(element):
+        kind = ELEMENT_KIND_BY_TYPE.get(element["type"])
+        if kind == "sentence":
+            self.element_index[element["id"]] = len(self.allsentences)
             self.allsentences.append(element)
-        if self.isParagraph(element):
+        elif kind == "paragraph":
+            self.element_index[element["id"]] = len(self.allparagraphs)
             self.allparagraphs.append(element)
-        if self.isSection(element):
+        elif kind == "section":
+            self.element_index[element["id"]] = len(self.allsections)
             self.allsections.append(element)
         self.element_by_id[element["id"]] = element
 
@@ -121,21 +171,28 @@ class SciDoc(object):
         self.allparagraphs = []
         self.allsections = []
         self.element_by_id = {}
+        # position of each element in its list above, kept out of the elements
+        # themselves so it doesn't end up in the JSON
+        self.element_index = {}
         self.abstract = {}
+        # (abstract, number of elements, ids) from getAbstractElementIds()
+        self.abstract_ids_cache = None
         self.citation_by_id = {}
         self.reference_by_id = {}
+        self.reference_by_original_id = {}
         self.ignore_errors = ["error_match_citation_with_reference"]
 
+        abstract = None
         for element in self.data["content"]:
             self.processSingleElement(element)
-
-        # try to find abstract section
-        for section in self.allsections:
-            if section["header"].lower() == "abstract":
-                self.abstract = section
-
-        # if unsuccessful, set the first section to be the abstract
-        if len(self.allsections) > 0:
+            # try to find abstract section
+            if self.isSection(element) and self.isAbstractHeader(element["header"]):
+                abstract = element
+
+        if abstract is not None:
+            self.abstract = abstract
+        elif len(self.allsections) > 0:
+            # if unsuccessful, set the first section to be the abstract
             self.abstract = self.allsections[0]
 
         self.updateReferences()
@@ -162,27 +219,44 @@ class SciDoc(object):
             and updates the ["citations"] links for each reference
         """
         self.reference_by_id = {}
+        self.reference_by_original_id = {}
         self.citation_by_id = {}
 
         for ref in self.data["references"]:
             if self.isReference(ref):
                 self.reference_by_id[ref["id"]] = ref
+            self.indexReferenceOriginalId(ref)
 
+        # ids already in each reference's ["citations"], so checking for
+        # duplicates doesn't scan the list for every citation
+        linked_ids = {}
         for cit in self.data["citations"]:
             self.citation_by_id[cit["id"]] = cit
             # update citations link for the reference
             if cit["ref_id"]:
-                try:
-                    ref_citations = self.reference_by_id[cit["ref_id"]]["citations"]
-                    if cit["id"] not in ref_citations:
-                        ref_citations.append(cit["id"])
-                except KeyError as e:
+                ref = self.reference_by_id.get(cit["ref_id"])
+                if ref is None:
                     if "error_match_citation_with_reference" in self.ignore_errors:
                         # print("Cannot match citation %s with reference %s, ignoring." % (cit["id"], cit["ref_id"]))
                         continue
                     else:
                         raise KeyError("Cannot match citation with reference")
 
+                ref_citations = ref.setdefault("citations", [])
+                linked = linked_ids.get(cit["ref_id"])
+                if linked is None:
+                    linked = linked_ids[cit["ref_id"]] = set(ref_citations)
+                if cit["id"] not in linked:
+                    linked.add(cit["id"])
+                    ref_citations.append(cit["id"])
+
+    def isAbstractHeader(self, header):
+        """
+            True if the section header is "abstract", in any case. Only headers
+            of the right length get lowercased.
+        """
+        return len(header) == len(ABSTRACT_HEADER) and header.lower() == ABSTRACT_HEADER
+
     def isSentence(self, element):
         """
             True if element is sentence. This includes figure captions, list items, footnotes
@@ -212,25 +286,33 @@ class SciDoc(object):
 
     def getElementIndex(self, element):
         """
+            Returns the position of the element in allsentences,
+            allparagraphs or allsections
         """
         if self.isSentence(element):
-            return self.allsentences.index(element)
+            element_list = self.allsentences
         elif self.isParagraph(element):
-            return self.allparagraphs.index(element)
+            element_list = self.allparagraphs
         elif self.isSection(element):
-            return self.allsections.index(element)
+            element_list = self.allsections
         else:
             return None
 
+        index = self.element_index.get(element.get("id"), None)
+        if index is not None and index < len(element_list) and element_list[index] is element:
+            return index
+        return element_list.index(element)
+
     def addElement(self, element):
         """
             Handy for adding an element without worrying about IDs and updating dicts
         """
-        if self.isSentence(element):
+        kind = ELEMENT_KIND_BY_TYPE.get(element["type"])
+        if kind == "sentence":
             element["id"] = "s" + str(len(self.allsentences))
-        if self.isParagraph(element):
+        elif kind == "paragraph":
             element["id"] = "p" + str(len(self.allparagraphs))
-        if self.isSection(element):
+        elif kind == "section":
             element["id"] = "sect" + str(len(self.allsections))
 
         self.data["content"].append(element)
@@ -285,6 +367,19 @@ class SciDoc(object):
         self.citation_by_id[newCitation["id"]] = newCitation
         return newCitation
 
+    def addCitations(self, count, sent_id=None):
+        """
+            Same as calling addCitation() count times, returns the list of new
+            citations
+        """
+        citations = self.data["citations"]
+        first = len(citations)
+        newCitations = [{"id": "cit" + str(num), "parent_s": sent_id, "ref_id": None}
+                        for num in range(first, first + count)]
+        citations.extend(newCitations)
+        self.citation_by_id.update((cit["id"], cit) for cit in newCitations)
+        return newCitations
+
     def addReference(self):
         """
             Create a new reference element, automatically set id, return it
@@ -307,20 +402,36 @@ class SciDoc(object):
             with output from an external citation parsing service like ParsCit
             or FreeCite.
         """
-        newReference = deepcopy(existing_reference)
+        newReference = copyJSONData(existing_reference)
         newReference["id"] = "ref" + str(len(self.data["references"]))
         newReference["type"] = "reference"
         newReference["citations"] = []
         self.data["references"].append(newReference)
         self.reference_by_id[newReference["id"]] = newReference
+        self.indexReferenceOriginalId(newReference)
         return newReference
 
+    def indexReferenceOriginalId(self, ref):
+        """
+            Adds the reference to reference_by_original_id, unless another one
+            with the same original_id came first
+        """
+        original_id = ref.get("original_id", None)
+        if original_id is not None:
+            self.reference_by_original_id.setdefault(original_id, ref)
+
     def matchReferenceById(self, ref_id):
         """
             Matches and returns a reference by its unique id
         """
+        ref = self.reference_by_id.get(ref_id, None)
+        if ref is not None and ref["id"] == ref_id:
+            return ref
+
+        # readers can change the id of a reference after adding it
         for ref in self.data["references"]:
             if ref["id"] == ref_id:
+                self.reference_by_id[ref_id] = ref
                 return ref
         return None
 
@@ -337,8 +448,14 @@ class SciDoc(object):
         """
             Returns a reference from the bibliography by its original_id if found, None otherwise
         """
+        ref = self.reference_by_original_id.get(str(id), None)
+        if ref is not None and ref.get("original_id", None) == str(id):
+            return ref
+
+        # readers can set the original_id of a reference after adding it
         for ref in self["references"]:
             if ref.get("original_id", None) == str(id):
+                self.reference_by_original_id[str(id)] = ref
                 return ref
         return None
 
@@ -347,38 +464,38 @@ class SciDoc(object):
             Runs the functions to update the *_by_id dicts and other shortcuts
         """
         self.data = data
+        # this also calls updateReferences()
         self.updateContentLists()
-        self.updateReferences()
 
     def loadFromFile(self, filename):
         """
             Loads the json into [data] and calls loadFromData
+
+            :returns: True if the file was loaded
         """
         try:
-            f = open(filename, "rb")
-            res = json.load(f)
-            f.close()
+            res = loadJSON(filename)
         except:
             print("Exception in SciDoc.loadFromFile():", sys.exc_info()[:2])
             return None
 
         self.loadFromData(res)
+        return True
 
     def getJSONstring(self):
         """
             Returns a json string representation of self
         """
-        return json.dumps(self.data)
+        return dumpJSONBytes(self.data).decode("utf-8")
 
     def saveToFile(self, filename, indent=2):
         """
-            A wrapper that json.dump's() self.data to a file and catches the
-            potential exception
+            A wrapper that dumps self.data to a file as JSON and catches the
+            potential exception. Elements are encoded one at a time, so big
+            documents don't need a second copy in memory as one huge string.
         """
         try:
-            f = open(filename, "wb")
-            json.dump(self.data, f, indent=indent)
-            f.close()
+            saveJSONDictStreamed(self.data, filename, indent=indent)
         except:
             print("Exception in SciDoc.saveToFile(): %s" % sys.exc_info()[:2])
 
@@ -387,45 +504,95 @@ class SciDoc(object):
             Iterate over sentences, add word count to each sentence dict
         """
 
-        def num_words_in_line(line):
-            return len(rx_word_boundaries.findall(line)) >> 1
-
-        for s in self.allsentences:
-            s["wordlen"] = num_words_in_line(s["text"])
+        counts = countWords([s["text"] for s in self.allsentences])
+        for s, count in zip(self.allsentences, counts):
+            s["wordlen"] = count >> 1
 
     def getParagraphText(self, p):
         """
             Returns the plain text representation of a paragraph
         """
-        res = ""
+        parts = []
+        self.addParagraphTextParts(p, parts)
+        return "".join(parts)
+
+    def addParagraphTextParts(self, p, parts):
+        """
+            Appends the text of each sentence in a paragraph to the parts list
+        """
+        element_by_id = self.element_by_id
+        append = parts.append
         for s in p["content"]:
-            sent = self.element_by_id[s]
+            sent = element_by_id[s]
             if isinstance(sent, dict) and "text" in sent:
-                res += sent["text"] + " "
-        return res
+                append(sent["text"])
+                append(" ")
 
     def getSectionText(self, section, headers=False):
         """
             Returns the text contained in a section, headers optional
         """
-        text = ""
-        if headers:
-            text += section.get("header", "") + "\n"
+        parts = []
+        self.addSectionTextParts(section, parts, headers)
+        return "".join(parts)
 
-        for element_id in section.get("content", []):
-            element = self.element_by_id[element_id]
-            if self.isSection(element):
-                text += self.getSectionText(element, headers)
-            elif self.isParagraph(element):
-                text += self.getParagraphText(element) + "\n"
+    def addSectionTextParts(self, section, parts, headers=False):
+        """
+            Appends the text of a section and its subsections to the parts
+            list, so it's joined only once at the end. Subsections are walked
+            with a stack of iterators instead of recursion, so deep section
+            trees can't hit the recursion limit.
+        """
+        if headers:
+            parts.append(section.get("header", ""))
+            parts.append("\n")
 
-        return text
+        stack = [iter(section.get("content", []))]
+        while stack:
+            for element_id in stack[-1]:
+                element = self.element_by_id[element_id]
+                if self.isSection(element):
+                    if headers:
+                        parts.append(element.get("header", ""))
+                        parts.append("\n")
+                    # carry on with the parent's content once this one is done
+                    stack.append(iter(element.get("content", [])))
+                    break
+                elif self.isParagraph(element):
+                    self.addParagraphTextParts(element, parts)
+                    parts.append("\n")
+            else:
+                stack.pop()
 
     def getAbstract(self):
         text = self.getSectionText(self.abstract)
         text = cleanXML(text)
         return text
 
+    def getAbstractElementIds(self):
+        """
+            Returns the set of ids of the abstract section, its paragraphs and
+            their sentences. It's cached until the abstract is replaced or
+            elements are added to the document.
+        """
+        if not self.abstract:
+            return frozenset()
+
+        cache = self.abstract_ids_cache
+        if cache is not None and cache[0] is self.abstract and cache[1] == len(self.data["content"]):
+            return cache[2]
+
+        ids = [self.abstract["id"]]
+        for element_id in self.abstract["content"]:
+            ids.append(element_id)
+            element = self.element_by_id[element_id]
+            if element["type"] == "p":
+                ids.extend(element["content"])
+
+        ids = frozenset(ids)
+        self.abstract_ids_cache = (self.abstract, len(self.data["content"]), ids)
+        return ids
+
     def getFullDocumentText(self, headers=False, include_bibliography=False, cit_style="APA", exclude_abstract=False):
         """
             Returns the whole document in plain text. Basic function for
@@ -439,62 +606,53 @@ class SciDoc(object):
                 a string with the rendered document
         """
 
-        def recurseSectionsBibliography(biblos):
-            res = ""
-
-            if isinstance(biblos, dict) and "references" in biblos:
-                # here we should be adding the different bibliography sections, but in a plain TXT file it makes little sense
-                ##            if biblos.has_key("header"):
-                ##                  res += biblos ["header"]
-                for ref in biblos["references"]:
+        def addBibliographyParts(biblos, res):
+            if not (isinstance(biblos, dict) and "references" in biblos):
+                return
+            # here we should be adding the different bibliography sections, but in a plain TXT file it makes little sense
+            ##            if biblos.has_key("header"):
+            ##                  res += biblos ["header"]
+            stack = [iter(biblos["references"])]
+            while stack:
+                for ref in stack[-1]:
                     if ref["type"] == "subsection":
-                        res += recurseSectionsBibliography(ref)
+                        if isinstance(ref, dict) and "references" in ref:
+                            stack.append(iter(ref["references"]))
+                            break
                     elif ref["type"] == "ref":
                         if ref.get("text", "") != "":  # if the reference is in raw text, not processed
                             reftext = ref["text"]
                         else:
                             reftext = formatReference(ref)
-                        res += reftext + "\n\n"
-            return res
-
-        def processElement(element):
-            result = ""
-            if self.isSection(element):
-                if headers:
-                    result += element["header"] + " \n"
-            if self.isSentence(element):
-                result += element["text"] + " "
-            return result
-
-        text = self.data["metadata"]["title"] if self.data["metadata"]["title"] is not None else ""
-        text += "\n\n"
+                        res.append(reftext)
+                        res.append("\n\n")
+                else:
+                    stack.pop()
 
-        to_ignore = []
-        if exclude_abstract and self.abstract:
-            to_ignore.append(self.abstract["id"])
-            for element_id in self.abstract["content"]:
-                to_ignore.append(element_id)
-                element = self.element_by_id[element_id]
-                if element["type"] == "p":
-                    for s_id in element["content"]:
-                        to_ignore.append(s_id)
+        parts = [self.data["metadata"]["title"] if self.data["metadata"]["title"] is not None else "", "\n\n"]
 
-        to_ignore = set(to_ignore)
+        to_ignore = self.getAbstractElementIds() if exclude_abstract else frozenset()
 
         for element in self.data["content"]:
             if exclude_abstract and element["id"] in to_ignore:
                 continue
-            text += processElement(element)
+            if self.isSection(element):
+                if headers:
+                    parts.append(element["header"])
+                    parts.append(" \n")
+            if self.isSentence(element):
+                parts.append(element["text"])
+                parts.append(" ")
 
-        biblio_add = ""
         if include_bibliography and "references" in self.data:
-            biblio_add += recurseSectionsBibliography(self.data["references"])
+            biblio_add = []
+            addBibliographyParts(self.data["references"], biblio_add)
 
-            if len(biblio_add) > 0:
-                text += "\n\nBibliography\n\n"
-                text += biblio_add
+            if any(biblio_add):
+                parts.append("\n\nBibliography\n\n")
+                parts.extend(biblio_add)
 
-        return text
+        return "".join(parts)
 
     def formatTextForExtraction(self, text):
         """
@@ -513,16 +671,20 @@ class SciDoc(object):
         text = replaceXMLCitationsWithUnderscoreCitations(text)
         text = cleanXML(text)
 
-        for author_regex in self.known_author_strings:
-            try:
-                text = re.sub(author_regex + "(\s*\,?\s*\d+\w?)?", AUTHOR_MARKER + " ", text)
-                text = re.sub(author_regex + "(\s*\(\d+\w?\))?", AUTHOR_MARKER + " ", text)
-            except Exception as e:
-                print(e)
-
-        text = re.sub("\(\s*\_\_author\s*\.\)?", "( " + AUTHOR_MARKER + " )", text)
-        text = re.sub("(\w)" + re.escape(CIT_MARKER), r"\1 " + CIT_MARKER, text)
-        text = re.sub(re.escape(AUTHOR_MARKER) + "\s*\(\d+\w?\)", AUTHOR_MARKER + " ", text)
+        if self.known_authors_regex:
+            # one pass over the text for all the authors
+            text = self.known_authors_regex.sub(AUTHOR_MARKER + " ", text)
+        else:
+            for author_with_number, author_with_year in self.known_author_regexes:
+                try:
+                    text = author_with_number.sub(AUTHOR_MARKER + " ", text)
+                    text = author_with_year.sub(AUTHOR_MARKER + " ", text)
+                except Exception as e:
+                    print(e)
+
+        text = AUTHOR_IN_PARENTHESES_REGEX.sub("( " + AUTHOR_MARKER + " )", text)
+        text = WORD_BEFORE_CIT_REGEX.sub(r"\1 " + CIT_MARKER, text)
+        text = AUTHOR_YEAR_REGEX.sub(AUTHOR_MARKER + " ", text)
         # text = re.sub(re.escape(CIT_MARKER+CIT_MARKER), CIT_MARKER+" "+CIT_MARKER, text)
         return text
 
@@ -544,47 +706,68 @@ class SciDoc(object):
                 names = [r"\b%s\b" % name for name in names]
 
             text = re.escape(text)
-            text = text.replace("al\.", "al\.?\,?")
-            text = text.replace(r"\ and\ ", "\ (and|\&amp\;|\&)\ ")
-            text = text.replace("\\ ", "\\s*")
+            text = ESCAPED_ET_AL_REGEX.sub(lambda match: r"al\.?\,?", text)
+            text = ESCAPED_AND_REGEX.sub(lambda match: r"\s*(?:and|\&amp\;|\&)\s*", text)
+            text = ESCAPED_SPACE_REGEX.sub(lambda match: r"\s*", text)
             # print(text)
             inline_ref_mentions.append(text)
             # names_from_institution=ref["institution"].replace()
             inline_ref_mentions.extend(names)
 
-        inline_ref_mentions = set([ref for ref in inline_ref_mentions if re.search("[A-Z]", ref)])
-        self.known_author_strings = list(inline_ref_mentions)
+        # removes duplicates, keeping the order
+        inline_ref_mentions = OrderedDict.fromkeys(inline_ref_mentions)
+        self.known_author_strings = [ref for ref in inline_ref_mentions if CAPITAL_LETTER_REGEX.search(ref)]
+
+        self.known_author_regexes = []
+        for author_regex in self.known_author_strings:
+            try:
+                self.known_author_regexes.append((re.compile(author_regex + r"(\s*\,?\s*\d+\w?)?"),
+                                                  re.compile(author_regex + r"(\s*\(\d+\w?\))?")))
+            except Exception as e:
+                print(e)
+
+        self.known_authors_regex = None
+        if self.known_author_strings:
+            # longest first, so a full "X and Y" mention wins over its single names
+            alternatives = sorted(self.known_author_strings, key=len, reverse=True)
+            try:
+                self.known_authors_regex = re.compile(r"(?:" + "|".join(alternatives) + r")" +
+                                                      r"(?:\s*\,?\s*\d+\w?|\s*\(\d+\w?\))?")
+            except Exception as e:
+                print(e)
 
     def countMultiCitations(self, newSent):
         """
             Locate and cluster together multiple citations in a single sentence,
             i.e. (Johns & Smith (2005), Bla and Bla (2007))
         """
+        text = newSent["text"]
         cits = []
-        ed = newSent["text"]
-
-        match = 1
+        previous = None
 
-        while match:
-            match = re.search(r"(<cit\sid=(.{1,6})\s?/>).{0,7}<cit\sid=(.{1,6})\s?/>", ed, re.IGNORECASE)
-            if match:
-                c1 = match.group(2).strip()
-                c2 = match.group(3).strip()
-                cits.append([c1, c2])
-                ed = ed[:match.start(1)] + ed[match.end(1):]
+        # pairs of consecutive citations with up to MULTI_CITATION_MAX_GAP
+        # characters (no newlines) between them
+        for match in CITATION_TAG_REGEX.finditer(text):
+            if previous is not None:
+                gap = match.start() - previous.end()
+                if gap <= MULTI_CITATION_MAX_GAP and "\n" not in text[previous.end():match.start()]:
+                    cits.append([previous.group(1).strip(), match.group(1).strip()])
+            previous = match
 
         groups = []
+        # index of the first group each citation id is in
+        group_index = {}
 
         for cit in cits:
-            added = False
-
-            for group in groups:
-                if cit[0] in group:
-                    group.append(cit[1])
-                    added = True
-                    break
-            if not added:
+            index = group_index.get(cit[0])
+            if index is not None:
+                groups[index].append(cit[1])
+            else:
+                index = len(groups)
                 groups.append(cit)
+                group_index[cit[0]] = index
+            if group_index.get(cit[1], index) >= index:
+                group_index[cit[1]] = index
 
         for group in groups:
             for cit_id in group:
@@ -611,32 +794,61 @@ class SciDoc(object):
             Returns a printable representation of the sentence where all
             references are now placeholders with numbers.
         """
-        global ref_rep_count
-        ref_rep_count = 0
-
         newSent = self.element_by_id[sent_id]
 
-        def repFunc(match):
-            """
-                This is called by the re.sub() function for every citation match.
-            """
-            global ref_rep_count
-            ref_rep_count += 1
+        text = s.renderContents(encoding=None)
+        newSent["text"] = text
 
+        # the nth citation in the text is the nth in the sentence's ["citations"]
+        parts = []
+        pos = 0
+        for ref_rep_count, match in enumerate(XREF_CITATION_REGEX.finditer(text)):
+            parts.append(text[pos:match.start()])
             ref_id = match.group(1).replace("\"", "").replace("'", "")
             if ref_id in self.reference_by_id:
-                res = CITATION_FORM % six.text_type(self.citation_by_id[newSent["citations"][ref_rep_count - 1]]["id"])
+                parts.append(CITATION_FORM % six.text_type(self.citation_by_id[newSent["citations"][ref_rep_count]]["id"]))
             else:
-                res = match.group(0).replace(u"xref", u"inref")
+                parts.append(match.group(0).replace(u"xref", u"inref"))
                 print("Ran out of citations for sentence: this is bad")
                 print(match.group(0))
                 print(newSent)
-            return res
+            pos = match.end()
+        parts.append(text[pos:])
+        return "".join(parts)
 
-        text = s.renderContents(encoding=None)
-        newSent["text"] = text
-        text = re.sub(r"<xref.*?rid=\"(.*?)\".*?>(.*?)</xref>", repFunc, text, 0, re.IGNORECASE | re.DOTALL)
-        return text
+
+def loadSciDocs(filenames, num_workers=DEFAULT_LOAD_WORKERS, ignore_errors=None):
+    """
+        Loads many SciDoc JSON files, yielding each SciDoc in the same order as
+        the filenames. A pool of threads reads the files ahead, so waiting on
+        the disk overlaps with parsing and processing the previous documents.
+
+        Files that can't be read or parsed are yielded as None.
+    """
+
+    def readFile(filename):
+        try:
+            return loadFileBytes(filename)
+        except (IOError, OSError):
+            print("Exception in loadSciDocs() reading %s:" % filename, sys.exc_info()[:2])
+            return None
+
+    filenames = list(filenames)
+    pool = ThreadPool(num_workers)
+    try:
+        for filename, contents in six.moves.zip(filenames, pool.imap(readFile, filenames)):
+            if contents is None:
+                yield None
+                continue
+            try:
+                data = loadJSONBytes(contents)
+            except ValueError:
+                print("Exception in loadSciDocs() parsing %s:" % filename, sys.exc_info()[:2])
+                yield None
+                continue
+            yield SciDoc(data, ignore_errors=ignore_errors)
+    finally:
+        pool.terminate()
 
 
 def basicTest():
@@ -10,7 +10,9 @@ from __future__ import absolute_import
 from __future__ import print_function
 import os, glob, re, codecs, json
 import six.moves.cPickle, random
-from bs4 import BeautifulStoneSoup
+from copy import deepcopy
+from xml.sax.saxutils import escape
+from lxml import etree
 
 from proc.general_utils import *
 
@@ -29,8 +31,29 @@ rxdate = re.compile(r"(<DATE>)(.*?)(</DATE>)", re.IGNORECASE | re.DOTALL)
 rxsingleauthor = re.compile(r"(<SURNAME>)(.*?)(</SURNAME>)", re.IGNORECASE | re.DOTALL)
 ##rxsingleyear=re.compile(r"\d{4}\w{0,1}", re.IGNORECASE | re.DOTALL)
 rxsingleyear = re.compile(r"in\spress|to\sappear|forthcoming|submitted|\d{4}\w{0,1}", re.IGNORECASE | re.DOTALL)
-rxwtwoauthors = re.compile(r"(\w+)\sand\s(\w+)", re.IGNORECASE | re.DOTALL)
-rxetal = re.compile(r"(\w+)\set\sal", re.IGNORECASE | re.DOTALL)
+# "X and Y" anywhere or else "X et al": the lazy prefix makes the first
+# alternative be tried at every position before falling back to the second
+rxcitationauthors = re.compile(r"^(?:.*?(?P<author1>\w+)\sand\s(?P<author2>\w+)|.*?(?P<etal>\w+)\set\sal)",
+                               re.IGNORECASE | re.DOTALL)
+
+rxtag = re.compile(r"</?.+?>")
+rxpersonname = re.compile(r"^\s*(?P<given>\S+)(?:\s+(?P<middle>.+?))?\s+(?P<family>\S+)\s*$", re.DOTALL)
+rxwhitespace = re.compile(r"\s+")
+rxopenreference = re.compile(r"<reference.+?>", re.IGNORECASE | re.DOTALL)
+rxclosereference = re.compile(r"</reference>", re.IGNORECASE | re.DOTALL)
+rxauthorblock = re.compile(r"<author>.*</author>", re.IGNORECASE | re.DOTALL)
+rxtagblock = re.compile(r"<(\w+).*?>.*?</\1>", re.IGNORECASE | re.DOTALL)
+rxrefblock = re.compile(r"<ref.*?</ref>", re.IGNORECASE | re.DOTALL)
+rxrefauthortag = re.compile(r"</?refauthor>", re.IGNORECASE | re.DOTALL)
+rxrefauthorcontent = re.compile(r"<refauthor(?:\s[^>]*)?>(.*?)</refauthor>", re.IGNORECASE | re.DOTALL)
+rxdatecontent = re.compile(r"<date(?:\s[^>]*)?>(.*?)</date>", re.IGNORECASE | re.DOTALL)
+
+# code point -> replacement tables for unicode.translate()
+TAB_TRANSLATION = {ord(u"\t"): u" "}
+PUNCTUATION_TRANSLATION = {ord(u","): u" ", ord(u"."): u" "}
+
+# recover=True to get through badly formed files, as BeautifulStoneSoup used to
+SCIXML_PARSER = etree.XMLParser(recover=True, resolve_entities=False, huge_tree=True, encoding="utf-8")
 
 ##DOCS_TO_IGNORE=[
 ##"a83-1002.xml", # authorlist missing, tag doesn't close
@@ -60,11 +83,90 @@ def cleanxml(xmlstr):
     """
         Removes all XML/HTML tags
     """
-    xmlstr = re.sub(r"</?.+?>", " ", xmlstr)
-    xmlstr = xmlstr.replace("  ", " ").strip()
+    xmlstr = rxtag.sub(" ", xmlstr)
+    xmlstr = rxwhitespace.sub(" ", xmlstr).strip()
     return xmlstr
 
 
+def cleanElementText(element):
+    """
+        Same as cleanxml() for an already parsed element: its text without tags,
+        whitespace collapsed
+    """
+    return rxwhitespace.sub(" ", u" ".join(element.itertext())).strip()
+
+
+def tryToExtractTitle(reftext):
+    """
+        If no <title> tag is available, try to strip everything else and make the remainder the title
+    """
+    reftext = rxopenreference.sub("", reftext)
+    reftext = rxclosereference.sub("", reftext)
+    reftext = rxauthorblock.sub("", reftext)
+    reftext = rxtagblock.sub("", reftext)
+    reftext = reftext.replace(", , , , and . . ", "").replace(", , , and . .", "")
+    reftext = reftext.replace(" and . . ", "").replace(" and  ().", "").replace(" and  .", "").replace(" and , ", "")
+    reftext = reftext.strip()
+    return reftext
+
+
+def parseSciXML(xml, collect=None):
+    """
+        Parses SciXML with lxml and lowercases all tag and attribute names,
+        like BeautifulStoneSoup did, so they can be looked up in lowercase.
+
+        :param collect: optional dict of tag -> list. The elements with those
+            tags are appended to the lists in document order, in the same walk
+            over the tree, so they needn't be searched for afterwards
+        :returns: the root element, or None if nothing could be parsed
+    """
+    if isinstance(xml, six.text_type):
+        xml = xml.encode("utf-8")
+    root = etree.fromstring(xml, SCIXML_PARSER)
+    if root is None:
+        return None
+
+    for element in root.iter(etree.Element):
+        element.tag = element.tag.lower()
+        if collect is not None and element.tag in collect:
+            collect[element.tag].append(element)
+        if any(not key.islower() for key in element.attrib.keys()):
+            attributes = element.attrib.items()
+            element.attrib.clear()
+            for key, value in attributes:
+                element.set(key.lower(), value)
+    return root
+
+
+def findElement(element, tag):
+    """
+        Returns the first element with that tag in document order, including
+        the element itself, or None
+    """
+    return next(element.iter(tag), None)
+
+
+def elementText(element):
+    """
+        Returns all the text inside an element, without tags
+    """
+    return u"".join(element.itertext())
+
+
+def elementXML(element):
+    """
+        Returns the XML serialization of an element, without its tail text
+    """
+    return etree.tostring(element, encoding="unicode", with_tail=False)
+
+
+def innerXML(element):
+    """
+        Returns the XML serialization of what's inside an element
+    """
+    return escape(element.text or u"") + u"".join(etree.tostring(child, encoding="unicode") for child in element)
+
+
 def processPlainTextAuthor(author):
     """
         Returns a dictionary with a processed author's name
@@ -72,7 +174,6 @@ def processPlainTextAuthor(author):
 
     ##    print author
 
-    bits = author.split()
     res = {"family": "", "given": "", "text": author}
 
     ##    if "<surname>" in author.lower():
@@ -80,15 +181,15 @@ def processPlainTextAuthor(author):
     ##        if match:
     ##            surname=match.group(2)
 
-    if len(bits) > 1:
-        res["family"] = bits[-1]
-        res["given"] = bits[0]
-        if len(bits) > 2:
-            res["middlename"] = " ".join(bits[1:-2])
-    elif len(bits) == 1:
-        res["family"] = bits[0]
+    match = rxpersonname.match(author)
+    if match:
+        res["family"] = match.group("family")
+        res["given"] = match.group("given")
+        if match.group("middle"):
+            res["middlename"] = " ".join(match.group("middle").split())
     else:
-        pass
+        # a single name or nothing at all
+        res["family"] = author.strip()
 
     return res
 
@@ -97,12 +198,21 @@ class SciXMLReader(BaseSciDocXMLReader):
     """
     """
 
+    def __init__(self):
+        super(SciXMLReader, self).__init__()
+        # parsed element of each reference loaded, by reference id, for fuseReferences
+        self.reference_elements = {}
+        # parsed <ref> of each citation, by citation id, so it needn't be parsed again to match it
+        self.citation_elements = {}
+        # lowercased BOW of each reference loaded, by reference id, built as it is loaded
+        self.reference_bows = {}
+
     def processReference(self, ref, doc):
         """
             Process reference format, try to recover title, authors, date
         """
 
-        lines = ref.__repr__()
+        lines = elementXML(ref)
 
         lines = lines.replace("<reference> ", "<reference>\n")
         match = rxauthors.search(lines)
@@ -129,89 +239,94 @@ class SciXMLReader(BaseSciDocXMLReader):
 
         def fuseReferences(doc, ref):
             """
+                Appends the contents of this <reference> to the previous one
+                and loads them as a single reference
             """
-            prevref = doc["references"][-1]
-            doc["metadata"]["ref_replace_list"] = doc["metadata"].get("ref_replace_list", {})
-            ref_id = ""
-            try:
-                ref_id = ref["id"]
-                if not ref_id:
-                    ref_id = prevref["id"]
-                    if isinstance(id, six.string_types):
-                        ref_id = "ref" + str(len(doc["references"]) + 1)
-                    elif isinstance(id, int):
-                        ref_id = id + 1
-            except:
-                ref_id = "ref" + str(len(doc["references"]) + 1)
-
-            doc["metadata"]["ref_replace_list"][ref_id] = prevref["id"]
-            doc["references"].remove(prevref)
-
-            fullstring = re.sub(r"</reference>", "", prevref["xml"], 0, re.IGNORECASE)
-            fullstring += re.sub(r"<reference.+?>", "", ref.__repr__(), 0, re.IGNORECASE)
-            ##                ref=BeautifulStoneSoup(prevref["xml"]+ref.__repr__())
-            ref = BeautifulStoneSoup(fullstring).find("reference")
-            processReferenceXML(ref, doc, False)
-
-        xmltext = ref.__repr__()
-        authors = ref.findAll("author")
+            references = doc["references"]
+            prevref = references[-1]
+            replist = doc["metadata"].setdefault("ref_replace_list", {})
+            ref_id = ref.get("id")
+            if ref_id is None:
+                ref_id = "ref" + str(len(references) + 1)
+            elif not ref_id:
+                ref_id = prevref["id"]
+
+            replist[ref_id] = prevref["id"]
+            references.remove(prevref)
+
+            fused = self.reference_elements.get(prevref["id"])
+            if fused is None:
+                fused = parseSciXML(prevref["xml"])
+            else:
+                fused = deepcopy(fused)
+
+            # the text before the first child goes after the previous reference's content
+            if ref.text:
+                if len(fused):
+                    fused[-1].tail = (fused[-1].tail or "") + ref.text
+                else:
+                    fused.text = (fused.text or "") + ref.text
+            fused.extend(list(ref))
+            self.processReferenceXML(fused, doc, False)
+
+        metadata = doc["metadata"]
+        references = doc["references"]
+        xmltext = elementXML(ref)
+        authors = list(ref.iter("author"))
         authorlist = []
         surnames = []
-        original_id = ref["id"] if "id" in ref else None
+        original_id = ref.get("id")
 
         if authors:
             for a in authors:
-                astring = a.__repr__()
-                surname = a.find("surname")
-                if surname:
-                    surnames.append(surname.text)
-                    surname = surname.text
-                ##                astring=astring.replace("<surname>","").replace("</surname>","")
-                astring = cleanxml(astring)
-                authorlist.append(astring)
+                surname = findElement(a, "surname")
+                if surname is not None:
+                    surnames.append(elementText(surname))
+                authorlist.append(cleanElementText(a))
         else:
-            srnms = ref.findAll("surname")
-            for s in srnms:
-                surnames.append(s.text)
+            for s in ref.iter("surname"):
+                surnames.append(elementText(s))
 
         if len(surnames) == 0:
             for a in authorlist:
                 surnames.extend(a.split())
 
-        title = ref.find("title")
-        title = title.text if title else tryToExtractTitle(xmltext)
+        title = findElement(ref, "title")
+        title = elementText(title) if title is not None else tryToExtractTitle(xmltext)
 
-        date = ref.find("date")
-        if not date:
+        date = findElement(ref, "date")
+        if date is None:
             match = rxsingleyear.search(xmltext)
             if match:
                 date = match.group(0)
             else:
                 date = "????"  # wooooot! no date? Must be wrong
-                if ref.find("author"):
-                    doc["metadata"][
+                if authors:
+                    metadata[
                         "ADD_NEXT_REF"] = True  # no date in this one, maybe it is in the next one, so add it
-                elif len(doc["references"]) > 0 and firstcall:
+                elif len(references) > 0 and firstcall:
                     ##            if len(doc["references"]) > 0 and firstcall:
                     fuseReferences(doc, ref)
                     return
 
         else:
-            date = date.text
+            date = elementText(date)
 
-        if doc["metadata"].pop("ADD_NEXT_REF", False):
-            if len(doc["references"]) > 0:
+        if metadata.pop("ADD_NEXT_REF", False):
+            if len(references) > 0:
                 fuseReferences(doc, ref)
             return
 
         newref = doc.addReference()
         newref["xml"] = xmltext
-        newref["text"] = cleanxml(xmltext)
+        newref["text"] = cleanElementText(ref)
         newref["authors"] = authorlist
         newref["surnames"] = surnames
         newref["title"] = title
         newref["year"] = date
         if original_id: newref["original_id"] = original_id
+        self.reference_elements[newref["id"]] = ref
+        self.reference_bows[newref["id"]] = self.buildReferenceBOW(newref)
         return newref
 
     def processCitationXML(self, intext):
@@ -219,18 +334,27 @@ class SciXMLReader(BaseSciDocXMLReader):
             Extract the authors, date of an in-text citation <ref> from XML dom
         """
         if isinstance(intext, six.string_types):
-            xml = BeautifulStoneSoup(intext)
+            # entities, comments, CDATA and empty tags need the parser, but a
+            # plain fragment doesn't
+            if "&" not in intext and "<!" not in intext and "/>" not in intext:
+                authors = [rxtag.sub("", a) for a in rxrefauthorcontent.findall(intext)]
+                date = rxdatecontent.search(intext)
+                date = cleanxml(date.group(1)) if date else ""
+                if authors == [] or date == "":
+                    return None, None
+                return authors, date
+            xml = parseSciXML(intext)
         else:
             xml = intext
 
-        if not xml:
+        if xml is None:
             return None, None
         authors = []
-        for a in xml.findAll("refauthor"):
-            authors.append(a.text)
-        date = xml.find("date")
-        if date:
-            date = cleanxml(date.__repr__())
+        for a in xml.iter("refauthor"):
+            authors.append(elementText(a))
+        date = findElement(xml, "date")
+        if date is not None:
+            date = cleanElementText(date)
         else:
             date = ""
 
@@ -247,127 +371,193 @@ class SciXMLReader(BaseSciDocXMLReader):
         year = rxsingleyear.search(intext)
         if year: year = year.group(0)
 
-        match = rxwtwoauthors.search(intext)
+        match = rxcitationauthors.match(intext)
         if match:
-            authors.append(match.group(1))
-            authors.append(match.group(2))
-        else:
-            match = rxetal.search(intext)
-            if match:
-                authors.append(match.group(1))
-            else:  # not X and X, not et al - single author
-                intext = intext.replace(",", " ").replace(".", " ")
-                bits = intext.split()
-                authors.append(bits[0])
+            if match.group("author1") is not None:
+                authors.append(match.group("author1"))
+                authors.append(match.group("author2"))
+            else:
+                authors.append(match.group("etal"))
+        else:  # not X and X, not et al - single author
+            intext = intext.translate(PUNCTUATION_TRANSLATION)
+            bits = intext.split()
+            authors.append(bits[0])
 
         return authors, year
 
-    def loadCitation(self, ref, sentence_id, newDocument, section):
+    def loadCitation(self, ref, sentence_id, newDocument, section, replist=None, res=None):
         """
             Extract all info from <ref> tag, return dictionary
+
+            :param replist: the document's ref_replace_list, if already at hand
+            :param res: citation already added to the document to fill in,
+                otherwise a new one is added
         """
-        res = newDocument.addCitation()
+        if res is None:
+            res = newDocument.addCitation()
 
-        if "citation_id" in ref:
-            res["original_id"] = ref["citation_id"]
+        if ref.get("citation_id") is not None:
+            res["original_id"] = ref.get("citation_id")
 
-        res["original_text"] = ref.__repr__()
+        original_text = elementXML(ref)
+        res["original_text"] = original_text
         res["ref_id"] = 0
         res["parent_section"] = section
 
-        if "refid" in ref:
-            if ref["refid"] != "?":
+        refid = ref.get("refid")
+        # if refid is "?", the citation is matched with a reference later
+        if refid is not None and refid != "?":
+            if replist is None:
                 replist = newDocument["metadata"].get("ref_replace_list", {})
-                if str(ref["refid"]) in replist:
-                    res["ref_id"] = replist[str(ref["refid"])]
-                else:
-                    res["ref_id"] = ref["refid"]
-            else:
-                # try to match citation with reference
-                # don't, do it later
-                pass
+            refid = str(refid)
+            res["ref_id"] = replist.get(refid, refid)
 
-        authors, date = processCitationXML(ref)
+        authors, date = self.processCitationXML(ref)
         if not authors or not date:
-            authors, date = processCitation(ref.__repr__())
+            authors, date = self.processCitation(original_text)
 
         res["authors"] = authors
         res["date"] = date
         res["parent_s"] = sentence_id
+        self.citation_elements[res["id"]] = ref
         return res
 
-    def findMatchingReferenceByOriginalId(self, id, doc):
+    def buildReferencesByOriginalId(self, doc):
         """
-            Returns a reference from the bibliography by its original_id if found, None otherwise
+            Returns a dict of the references by their original_id as a string,
+            the first reference wins if several have the same one
         """
+        references_by_original_id = {}
         for ref in doc["references"]:
-            if "original_id" in ref and str(ref["original_id"]) == str(id):
-                return ref
-        return None
+            if "original_id" in ref:
+                references_by_original_id.setdefault(str(ref["original_id"]), ref)
+        return references_by_original_id
+
+    def findMatchingReferenceByOriginalId(self, id, doc, references_by_original_id=None):
+        """
+            Returns a reference from the bibliography by its original_id if found, None otherwise
 
-    def matchCitationWithReference(self, intext, doc):
+            :param references_by_original_id: dict from buildReferencesByOriginalId(),
+                to avoid building it again for every citation
+        """
+        if references_by_original_id is None:
+            references_by_original_id = self.buildReferencesByOriginalId(doc)
+        return references_by_original_id.get(str(id))
+
+    def buildReferenceBOW(self, ref):
+        """
+            Returns the list of surnames and author name words of a reference,
+            lowercased
+        """
+        bow = [surname.lower() for surname in ref["surnames"]]
+        for a in ref["authors"]:
+            bow.extend(a.lower().split())
+        return bow
+
+    def buildReferenceTable(self, references):
+        """
+            Returns what matchCitationWithReference needs of each reference as
+            parallel lists, so it isn't looked up again for every citation:
+            (references, word weights, years as int or None, years as lowercase string)
+
+            The weight of a word is the sum of the weights of the positions it
+            appears at in the BOW, the earlier the heavier.
+        """
+        word_weights = []
+        years_int = []
+        years_lower = []
+        for ref in references:
+            weights = {}
+            bow = self.reference_bows.get(ref["id"])
+            if bow is None:
+                bow = self.buildReferenceBOW(ref)
+            for i, w in enumerate(bow):
+                weights[w] = weights.get(w, 0) + max(0.1, 1 - (i * 0.05))
+            word_weights.append(weights)
+
+            try:
+                years_int.append(int(ref["year"]))
+            except (ValueError, TypeError):
+                years_int.append(None)
+            years_lower.append(str(ref["year"]).lower())
+
+        return list(references), word_weights, years_int, years_lower
+
+    def matchCitationWithReference(self, intext, doc, reference_table=None, element=None):
         """
             Matches an in-text reference with the bibliography
 
             TODO: check this actually works
-        """
 
-        def buildBOW(ref):
-            """
-            """
-            bow = [surname for surname in ref["surnames"]]
-            for a in ref["authors"]:
-                bow.extend(a.split())
-            return bow
+            :param reference_table: tuple of parallel lists from buildReferenceTable(),
+                so it isn't built again for every citation
+            :param element: the already parsed <ref> that intext is the XML of, if available
+        """
 
-        def computeOverlap(authors, year, bow):
+        def computeOverlap(author_counts, weights):
             """
                 Returns the score of likelihood a citation points to a reference
+
+                :param author_counts: dict of lowercased citation author -> times it appears
+                :param weights: dict of lowercased word of the reference -> weight
             """
             score = 0
-            for i, w in enumerate(bow):
-                for a in authors:
-                    if w.lower() == a.lower():
-                        score += max(0.1, 1 - (i * 0.05))
+            for w, count in author_counts.items():
+                weight = weights.get(w)
+                if weight:
+                    score += count * weight
             return score
 
-        authors, year = processCitationXML(intext)
+        authors, year = self.processCitationXML(element if element is not None else intext)
         if not authors or not year:
-            authors, year = processCitation(intext)
+            authors, year = self.processCitation(intext)
 
         yearlen = len(str(year))
         found = False
 
-        potentials = []
+        if reference_table is None:
+            reference_table = self.buildReferenceTable(doc["references"])
+        references, word_weights, ref_years_int, ref_years_lower = reference_table
+
+        author_counts = {}
+        for a in authors:
+            a = a.lower()
+            author_counts[a] = author_counts.get(a, 0) + 1
+
         if not found:
-            for ref in doc["references"]:
-                breaking = False
-                bow = buildBOW(ref)
-                score = computeOverlap(authors, year, bow)
-                if score >= 0.3:
-                    potentials.append((ref, score))
-
-            scores = []
-            for p in potentials:
-                if yearlen < 4:
-                    diff = 2
-                else:
-                    lev_diff = 99
-                    try:
-                        y1 = int(year)
-                        y2 = int(p[0]["year"])
-                        diff = abs(y1 - y2)
-                    except:
-                        diff = 99
-                        lev_diff = levenshtein(str(year).lower(), str(p[0]["year"]).lower())
-                if diff <= 2 or lev_diff <= 1:
-                    scores.append(p)
-
-            scores = sorted(scores, key=lambda x: x[1], reverse=True)
-            if len(scores) > 0:
-                ##            print "I think ", authors, year, "matches ", scores[0][0]["authors"], scores[0][0]["year"],
-                ##            print "with confidence", scores[0][1]
-                return scores[0][0]
+            try:
+                year_int = int(year)
+            except (ValueError, TypeError):
+                year_int = None
+            year_lower = str(year).lower()
+
+            # the first reference with the highest score wins, so the year only
+            # needs checking for those that would beat the best one so far
+            best_ref = None
+            best_score = 0.3
+            for index, weights in enumerate(word_weights):
+                score = computeOverlap(author_counts, weights)
+                if score < best_score or (best_ref is not None and score == best_score):
+                    continue
+
+                if yearlen >= 4:
+                    ref_year_int = ref_years_int[index]
+                    if year_int is not None and ref_year_int is not None:
+                        if abs(year_int - ref_year_int) > 2:
+                            continue
+                    else:
+                        ref_year_lower = ref_years_lower[index]
+                        # the edit distance is at least the difference in length
+                        if abs(len(year_lower) - len(ref_year_lower)) > 1 or \
+                                levenshtein(year_lower, ref_year_lower) > 1:
+                            continue
+
+                best_ref = references[index]
+                best_score = score
+
+            ##            print "I think ", authors, year, "matches ", best_ref["authors"], best_ref["year"],
+            ##            print "with confidence", best_score
+            return best_ref
 
         return None
 
@@ -375,118 +565,124 @@ class SciXMLReader(BaseSciDocXMLReader):
     #   Corpus reference matching functions
     # ------------------------------------------------------------------------------
 
-    def extractSentenceText(s, newSent_id, doc):
+    def extractSentenceText(self, s, newSent_id, doc):
         """
             Returns a printable representation of the sentence where all references are now placeholders with numbers
         """
-        global ref_rep_count
-        ref_rep_count = 0
-
         newSent = doc.element_by_id[newSent_id]
+        citation_by_id = doc.citation_by_id
+        citation_ids = iter([citation_by_id[c]["id"] for c in newSent["citations"]])
 
         def repFunc(match):
             """
+                Replaces each <ref> block with the placeholder of the next citation
             """
-            global ref_rep_count
-            ref_rep_count += 1
+            return " <CIT ID=" + str(next(citation_ids)) + " />"
 
-            res = " <CIT ID=" + str(doc.citation_by_id[newSent["citations"][ref_rep_count - 1]]["id"]) + " />"
-            return res
-
-        text = s.renderContents()
-        text = re.sub(r"<ref.*?</ref>", repFunc, text, 0, re.IGNORECASE | re.DOTALL)
-        text = re.sub(r"</?refauthor>", "", text, 0, re.IGNORECASE | re.DOTALL)
+        text = innerXML(s)
+        text = rxrefblock.sub(repFunc, text)
+        text = rxrefauthortag.sub("", text)
         return text
 
-    def loadStructureProcessPara(p, newDocument, parent):
-        newPar_id = newDocument.addParagraph(parent)
-
-        for s in p.findChildren("s"):
-            newSent_id = newDocument.addSentence(newPar_id, "")
-            newSent = newDocument.element_by_id[newSent_id]
-            loadAttributesIfPresent(s, ["ia", "az", "refid"], newSent)
-            refs = s.findAll("ref")
-            num = len(newDocument["citations"]) + 1
+    def loadStructureProcessPara(self, p, newDocument, parent):
+        newPar_id = newDocument.addParagraph(parent)["id"]
+        # all references have been loaded already, so this doesn't change
+        replist = newDocument["metadata"].get("ref_replace_list", {})
+        element_by_id = newDocument.element_by_id
+        addSentence = newDocument.addSentence
+        addCitations = newDocument.addCitations
+        loadCitation = self.loadCitation
+
+        for s in p.iter("s"):
+            newSent_id = addSentence(newPar_id, "")["id"]
+            newSent = element_by_id[newSent_id]
+            self.loadAttributesIfPresent(s, ["ia", "az", "refid"], newSent)
+            ##            num = len(newDocument["citations"]) + 1
             ##            for cit in citations:
             ##                r["citation_id"]=num
             ##                num+=1
-            loaded_refs = [loadCitation(r, newSent_id, newDocument, parent) for r in refs]
+            refs = list(s.iter("ref"))
+            # all the citations of the sentence are added to the document at once
+            loaded_refs = [loadCitation(r, newSent_id, newDocument, parent, replist, cit)
+                           for r, cit in zip(refs, addCitations(len(refs), newSent_id))]
 
             newSent["citations"] = [aref["id"] for aref in loaded_refs]
-            newSent["text"] = extractSentenceText(s, newSent_id, newDocument)
+            newSent["text"] = self.extractSentenceText(s, newSent_id, newDocument)
             newDocument.countMultiCitations(
                 newSent)  # deal with many citations within characters of each other: make them know they are a cluster TODO cluster them
 
         return newPar_id
 
-    def loadStructureProcessDiv(div, newDocument):
-        header = div.find("header")
-        if not header:
+    def loadStructureProcessDiv(self, div, newDocument):
+        header = findElement(div, "header")
+        if header is None:
             header_id = 0
             header_text = ""
         else:
-            header_id = header["id"] or 0
-            header_text = re.sub(r"</?header.*?>", "", header.__repr__())
+            header_id = header.get("id") or 0
+            header_text = innerXML(header)
 
-        newSection_id = newDocument.addSection("root", header_text, header_id)
+        newSection_id = newDocument.addSection("root", header_text, header_id)["id"]
 
-        for p in div.findAll("p"):
-            newPar_id = loadStructureProcessPara(p, newDocument, newSection_id)
+        for p in div.iter("p"):
+            newPar_id = self.loadStructureProcessPara(p, newDocument, newSection_id)
 
-    def loadMetadataIfExists(branch, key, doc):
-        meta = branch.find(key)
-        if meta:
-            doc["metadata"][key] = meta.text
+    def loadMetadataIfExists(self, branch, key, doc):
+        meta = findElement(branch, key)
+        if meta is not None:
+            doc["metadata"][key] = elementText(meta)
 
-    def loadAttributesIfPresent(branch, attributes, sent):
+    def loadAttributesIfPresent(self, branch, attributes, sent):
         """
             For each element in attributes, if present in branch, it is added to sent
         """
         for a in attributes:
-            if a in branch:
-                sent[a] = branch[a]
+            value = branch.get(a)
+            if value is not None:
+                sent[a] = value
 
-    def loadMetadata(newDocument, paper, fileno):
+    def loadMetadata(self, newDocument, paper, fileno):
         """
             Does all the painful stuff of trying to recover metadata from inside a badly converted
             SciXML file
         """
-        title = paper.findChildren("title")
-        newDocument["metadata"]["title"] = title[0].text if len(title) > 0 else "NO TITLE"
+        root = paper.getroottree().getroot()
+        title = findElement(paper, "title")
+        newDocument["metadata"]["title"] = elementText(title) if title is not None else "NO TITLE"
 
         if fileno == "":
-            fileno = paper.find("fileno").text
+            fileno = elementText(findElement(paper, "fileno"))
 
         newDocument["metadata"]["fileno"] = fileno
 
         authors = []
-        meta = soup.find("metadata")
-        if not meta:
-            debugAddMessage(newDocument, "error", "NO METADATA IN DOCUMENT! file:" + filename)
+        meta = findElement(root, "metadata")
+        if meta is None:
+            debugAddMessage(newDocument, "error", "NO METADATA IN DOCUMENT! file:" + newDocument["metadata"]["filename"])
             return newDocument
 
-        for a in meta.findChildren("author"):
-            authors.append(processPlainTextAuthor(a.text))
+        for a in meta.iter("author"):
+            authors.append(processPlainTextAuthor(elementText(a)))
 
+        authorlist = None
         if authors == []:
-            authorlist = soup.find("authorlist")
+            authorlist = findElement(root, "authorlist")
 
-        if authorlist:
-            for author in authorlist.findChildren("refauthor"):
-                authors.append(author.text)
+        if authorlist is not None:
+            for author in authorlist.iter("refauthor"):
+                authors.append(elementText(author))
 
-        appeared = meta.find("appeared")
-        if appeared:
-            loadMetadataIfExists(appeared, "conference", newDocument)
-            loadMetadataIfExists(appeared, "year", newDocument)
+        appeared = findElement(meta, "appeared")
+        if appeared is not None:
+            self.loadMetadataIfExists(appeared, "conference", newDocument)
+            self.loadMetadataIfExists(appeared, "year", newDocument)
 
         newDocument["metadata"]["authors"] = authors
-        newDocument["metadata"]["year"] = meta.find("year").text
+        newDocument["metadata"]["year"] = elementText(findElement(meta, "year"))
 
     def sanitizeString(self, s, maxlen=200):
-        s = s.replace("\t", " ")
-        s = s[:maxlen]
-        return s
+        # cut first: the replacement is one character for one
+        return s[:maxlen].translate(TAB_TRANSLATION)
 
     def makeSureValuesAreReadable(self, newDocument):
         """
@@ -495,7 +691,14 @@ class SciXMLReader(BaseSciDocXMLReader):
         newDocument["metadata"]["title"] = self.sanitizeString(newDocument["metadata"]["title"])
         newAuthors = []
         for author in newDocument["metadata"]["authors"]:
-            newAuthors.append(self.sanitizeString(author, 70))
+            if isinstance(author, dict):
+                # as returned by processPlainTextAuthor()
+                author = dict(author)
+                author["family"] = self.sanitizeString(author["family"], 70)
+                author["given"] = self.sanitizeString(author["given"], 70)
+                newAuthors.append(author)
+            else:
+                newAuthors.append(self.sanitizeString(author, 70))
         newDocument["metadata"]["authors"] = newAuthors
 
         newSurnames = []
@@ -511,20 +714,27 @@ class SciXMLReader(BaseSciDocXMLReader):
         """
             Match each citation with its reference
         """
-        allcitations = []
+        # built once for all the citations
+        references_by_original_id = self.buildReferencesByOriginalId(newDocument)
+        reference_table = self.buildReferenceTable(newDocument["references"])
+        citation_by_id = newDocument.citation_by_id
+        citation_elements = self.citation_elements
+
         for s in newDocument.allsentences:
-            for citation_id in s["citations"]:
-                cit = newDocument.citation_by_id[citation_id]
+            for citation_id in s.get("citations", []):
+                cit = citation_by_id[citation_id]
 
                 if cit[
                     "ref_id"] != 0:  # the citation already has a matching reference id in the original document, use it
-                    match = self.findMatchingReferenceByOriginalId(cit["ref_id"], newDocument)
+                    match = self.findMatchingReferenceByOriginalId(cit["ref_id"], newDocument,
+                                                                   references_by_original_id)
                     if not match:
                         ##                        print cit
                         match = newDocument.matchReferenceById(cit["ref_id"])
                 else:
                     # attempt to guess which reference the citation should point to
-                    match = self.matchCitationWithReference(cit["original_text"], newDocument)
+                    match = self.matchCitationWithReference(cit["original_text"], newDocument, reference_table,
+                                                            citation_elements.get(cit["id"]))
 
                 if match:
                     # whatever the previous case, make sure citation points to the ID of its reference
@@ -538,23 +748,53 @@ class SciXMLReader(BaseSciDocXMLReader):
                                     "NO MATCH for CITATION in REFERENCES: " + cleanxml(cit["original_text"]) + ", ")
                     pass
 
-    def read(self, filename, identifier):
+    def readFile(self, filename):
         """
+            Load a SciXML file into a SciDoc. The bytes of the file are handed
+            to the parser as they are unless they aren't valid UTF-8, instead of
+            being decoded into a string and encoded again.
+
+            :param filename: full path to file to read
+            :returns: SciDoc instance
         """
-        # main loadSciXML
-        text = loadFileText(filename)
-        soup = BeautifulStoneSoup(text)
+        xml = loadFileBytes(filename)
+        try:
+            xml.decode("utf-8")
+        except UnicodeDecodeError:
+            # same as loadFileText()
+            xml = xml.decode("utf-8", "replace")
+        return self.read(xml, filename)
+
+    def read(self, xml, identifier):
+        """
+            Load a SciXML file into a SciDoc.
 
-        fileno = soup.find("docno")
-        fileno = fileno.text if fileno else ""
+            :param xml: full xml string, or its UTF-8 encoded bytes
+            :param identifier: an identifier for this document, e.g. file name
+            :returns: SciDoc instance
+        """
+        filename = identifier
+        self.reference_elements = {}
+        self.citation_elements = {}
+        self.reference_bows = {}
+        # main loadSciXML
+        elements = {"reference": [], "div": []}
+        root = parseSciXML(xml, collect=elements)
 
         # Create a new SciDoc to store the paper
         newDocument = SciDoc()
         newDocument["metadata"]["filename"] = os.path.basename(filename)
         newDocument["metadata"]["filepath"] = filename
 
-        paper = soup.find("paper")
-        if not paper:
+        if root is None:
+            debugAddMessage(newDocument, "error", "CANNOT PARSE XML! file: " + filename)
+            return newDocument
+
+        fileno = findElement(root, "docno")
+        fileno = elementText(fileno) if fileno is not None else ""
+
+        paper = findElement(root, "paper")
+        if paper is None:
             debugAddMessage(newDocument, "error", "NO <PAPER> IN THIS PAPER! file: " + filename)
             return newDocument
 
@@ -579,29 +819,29 @@ class SciXMLReader(BaseSciDocXMLReader):
         self.makeSureValuesAreReadable(newDocument)
 
         # Load all references from the XML
-        for ref in soup.findAll("reference"):
+        for ref in elements["reference"]:
             self.processReferenceXML(ref, newDocument)
 
         # Load Abstract
-        abstract = soup.find("abstract")
-        if not abstract:
+        abstract = findElement(root, "abstract")
+        if abstract is None:
             debugAddMessage(newDocument, "error", "CANNOT LOAD ABSTRACT! file: " + filename + "\n")
             # TODO: LOAD first paragraph as abstract
         else:
-            newSection_id = newDocument.addSection("root", "Abstract")
-            newPar_id = newDocument.addParagraph(newSection_id)
+            newSection_id = newDocument.addSection("root", "Abstract")["id"]
+            newPar_id = newDocument.addParagraph(newSection_id)["id"]
 
-            for s in abstract.findChildren("a-s"):
-                newSent_id = newDocument.addSentence(newPar_id, s.text)
+            for s in abstract.iter("a-s"):
+                newSent_id = newDocument.addSentence(newPar_id, elementText(s))["id"]
                 self.loadAttributesIfPresent(s, ["ia", "az", "refid"], newDocument.element_by_id[newSent_id])
 
             newDocument.abstract = newDocument.element_by_id[newSection_id]
 
-        for div in soup.findAll("div"):
+        for div in elements["div"]:
             self.loadStructureProcessDiv(div, newDocument)
 
-            # try to match each citation with its reference
-            self.matchCitationsWithReferences(newDocument)
+        # try to match each citation with its reference, once they're all loaded
+        self.matchCitationsWithReferences(newDocument)
 
         # "in press", "forthcoming", "submitted", "to appear" = dates to fix & match
         # No functiona por: unicode
@@ -609,6 +849,10 @@ class SciXMLReader(BaseSciDocXMLReader):
         ##        k=ref.get("AZ",["NO AZ"])
         ##        print k, most_common(k)
 
+        # don't keep the parsed tree alive through the caches once the document is loaded
+        self.reference_elements = {}
+        self.citation_elements = {}
+        self.reference_bows = {}
         return newDocument
 
 
@@ -7,20 +7,36 @@
 
 from __future__ import absolute_import
 from __future__ import print_function
-import re, codecs
+import re, io, os
+import multiprocessing
 
 from proc.general_utils import safe_unicode
 from .base_classes import BaseSciDocXMLReader,BaseSciDocXMLWriter
 import six
 
+# code point -> entity, for unicode.translate()
+ESCAPE_TRANSLATION={ord(u"&"):u"&amp;", ord(u"<"):u"&lt;", ord(u">"):u"&gt;"}
+UNSAFE_CHARS_REGEX=re.compile(u"[&<>]")
+
+CIT_PLACEHOLDER_REGEX=re.compile(r"<CIT ID=(.*?)\s?/>")
+
+# bytes buffered when writing the XML file
+WRITE_BUFFER_SIZE=1 << 20
+
+# SciDocs handed to each worker process at a time by saveSciXMLBatch()
+BATCH_CHUNK_SIZE=32
+
+# sentence tag, indexed by in_abstract
+SENTENCE_TAGS=(u"S", u"A-S")
+
 def escapeText(text):
     """
         Escapes (X/H)TML characters in the string
     """
-    text=re.sub(r"(>|&gt;)","&gt;",text, flags=re.IGNORECASE)
-    text=re.sub(r"(<|&lt;)","&lt;",text, flags=re.IGNORECASE)
-    text=re.sub(r"(&|&amp;)","&amp;",text, flags=re.IGNORECASE)
-    return text
+    # most strings have nothing to escape, and checking is cheaper than translating
+    if not UNSAFE_CHARS_REGEX.search(text):
+        return text
+    return text.translate(ESCAPE_TRANSLATION)
 
 class SciXMLWriter(BaseSciDocXMLWriter):
     """
@@ -30,24 +46,24 @@ class SciXMLWriter(BaseSciDocXMLWriter):
         """
         """
         self.header_depth=0
-        self.already_rendered=[]
+        self.already_rendered=set()
 
-    def writeMetadata(self, doc):
+    def writeMetadata(self, doc, out):
         """
         """
-        lines=[]
-        lines.append("<METADATA>")
-        if "fileno" in doc["metadata"]:
-            lines.append("<FILENO>"+escapeText(doc.metadata["fileno"])+"</FILENO>\n")
+        metadata=doc.metadata
+        out.write("<METADATA>")
+        if "fileno" in metadata:
+            out.write("<FILENO>"+escapeText(metadata["fileno"])+"</FILENO>\n")
 
-        lines.append("<TITLE>"+escapeText(doc.metadata["title"])+"</TITLE>\n")
-        lines.append("<FILENAME>"+escapeText(doc.metadata["filename"])+"</FILENAME>\n")
+        out.write("<TITLE>"+escapeText(metadata["title"])+"</TITLE>\n")
+        out.write("<FILENAME>"+escapeText(metadata["filename"])+"</FILENAME>\n")
 
-        lines.append("<APPEARED>")
-        if "conference" in doc.metadata:
-            lines.append("<CONFERENCE>"+(doc.metadata["conference"])+"</CONFERENCE>\n")
-        if "journal" in doc.metadata:
-            lines.append("<JOURNAL>"+(doc.metadata["journal"])+"</JOURNAL>\n")
+        out.write("<APPEARED>")
+        if "conference" in metadata:
+            out.write("<CONFERENCE>"+(metadata["conference"])+"</CONFERENCE>\n")
+        if "journal" in metadata:
+            out.write("<JOURNAL>"+(metadata["journal"])+"</JOURNAL>\n")
 
 ##        lines.append(u"<CURRENT_AUTHORLIST>")
 ##        for author in doc.metadata["authors"]:
@@ -57,10 +73,10 @@ class SciXMLWriter(BaseSciDocXMLWriter):
 ##            lines.append(u"</CURRENT_AUTHOR>")
 ##        lines.append(u"</CURRENT_AUTHORLIST>")
 
-        lines.append(u"<AUTHORS>")
-        for author in doc.metadata["authors"]:
-            lines.append("<AUTHOR>%s %s</AUTHOR>" % (escapeText(author["given"]),escapeText(author["family"])))
-        lines.append(u"</AUTHORS>")
+        out.write(u"<AUTHORS>")
+        for author in metadata["authors"]:
+            out.write("<AUTHOR>%s %s</AUTHOR>" % (escapeText(author["given"]),escapeText(author["family"])))
+        out.write(u"</AUTHORS>")
 
 
 ##        lines.append("<SURNAMES>")
@@ -68,28 +84,27 @@ class SciXMLWriter(BaseSciDocXMLWriter):
 ##
 ##        lines.append("</SURNAMES>")
 
-        lines.append(u"<YEAR>"+doc.metadata["year"]+"</YEAR>")
-        lines.append(u"</APPEARED>")
+        out.write(u"<YEAR>"+metadata["year"]+"</YEAR>")
+        out.write(u"</APPEARED>")
 
-        if "revisionhistory" in doc["metadata"]:
-            lines.append(u"<REVISIONHISTORY>"+escapeText(doc.metadata["revisionhistory"])+u"</REVISIONHISTORY>\n")
-        lines.append(u"</METADATA>")
-        return lines
+        if "revisionhistory" in metadata:
+            out.write(u"<REVISIONHISTORY>"+escapeText(metadata["revisionhistory"])+u"</REVISIONHISTORY>\n")
+        out.write(u"</METADATA>")
 
-    def writeAbstract(self, doc):
+    def writeAbstract(self, doc, out):
         """
         """
-        lines=[]
-        lines.append(u"<ABSTRACT>")
-        if "content" in doc.abstract:
-            for element_id in doc.abstract["content"]:
-                s=doc.element_by_id[element_id]
+        abstract=doc.abstract
+        out.write(u"<ABSTRACT>")
+        if "content" in abstract:
+            element_by_id=doc.element_by_id
+            for element_id in abstract["content"]:
+                s=element_by_id[element_id]
                 if s["type"]=="s":
-                    lines.append(self.writeSentence(doc,s, True))
+                    out.write(self.writeSentence(doc,s, True))
                 if s["type"]=="p":
-                    lines.extend(self.writeParagraph(doc,s, True))
-        lines.append(u"</ABSTRACT>")
-        return lines
+                    self.writeParagraph(doc,s, out, True)
+        out.write(u"</ABSTRACT>")
 
     def processSentenceText(self, s, doc):
         """
@@ -102,108 +117,105 @@ class SciXMLWriter(BaseSciDocXMLWriter):
         """
             Fixes all the contents of the sentence, returns a string of proper XML
         """
+        citation_by_id=doc.citation_by_id
 
         def repl_func(m):
             """
                 Replaces <CIT ID=0 /> with <REF ID=cit0 REFID=ref0 />
             """
             cit_id=m.group(1) # this is the actual unique identifier of a citation in the document
-            ref_id=doc.citation_by_id[cit_id]["ref_id"] # this is the id of the reference the cit cites
+            ref_id=citation_by_id[cit_id]["ref_id"] # this is the id of the reference the cit cites
             return u'<REF ID="'+safe_unicode(cit_id)+u'" REFID="'+safe_unicode(ref_id)+'" />'
 
-        if in_abstract:
-            xmltag=u"A-S"
-        else:
-            xmltag=u"S"
-
-        res=u"<"+xmltag+u' ID="A-%s"' % s["id"]
+        xmltag=SENTENCE_TAGS[bool(in_abstract)]
 
         if "az" in s:
-            res+=u' AZ="%s"' % s["az"]
+            az=u' AZ="%s"' % s["az"]
+        else:
+            az=u""
 
         text=self.processSentenceText(s, doc)
-        text=re.sub(r"<CIT ID=(.*?)\s?/>",repl_func, text)
-        res+=">"+text+"</"+xmltag+">"
-
-        return res
+        text=CIT_PLACEHOLDER_REGEX.sub(repl_func, text)
+        # a single format instead of adding up the pieces
+        return u'<%s ID="A-%s"%s>%s</%s>' % (xmltag, s["id"], az, text, xmltag)
 
-    def writeParagraph(self, doc,paragraph, in_abstract=False):
+    def writeParagraph(self, doc,paragraph, out, in_abstract=False):
         """
         """
-        lines=[]
-
         # fix for empty paragraphs: should it be here?
         if len(paragraph["content"]) == 0:
-            return lines
+            return
+
+        if len(paragraph["content"]) == 1:
+            # most paragraphs have a single sentence: write it in one go
+            element=doc.element_by_id[paragraph["content"][0]]
+            if element["type"]=="s":
+                sentence=self.writeSentence(doc,element, in_abstract)
+                out.write(sentence if in_abstract else u"<P>%s</P>" % sentence)
+            elif not in_abstract:
+                out.write(u"<P></P>")
+            return
 
         if not in_abstract:
-            lines.append(u"<P>")
+            out.write(u"<P>")
+        element_by_id=doc.element_by_id
+        writeSentence=self.writeSentence
         for element in paragraph["content"]:
-            element=doc.element_by_id[element]
+            element=element_by_id[element]
             if element["type"]=="s":
-                lines.append(self.writeSentence(doc,element, in_abstract))
+                out.write(writeSentence(doc,element, in_abstract))
 
         if not in_abstract:
-            lines.append(u"</P>")
-        return lines
+            out.write(u"</P>")
 
-    def writeSection(self, doc,section, header_depth):
+    def writeSection(self, doc,section, header_depth, out):
         """
         """
         if section["id"] in self.already_rendered:
-            return []
-        self.already_rendered.append(section["id"])
+            return
+        self.already_rendered.add(section["id"])
 
         self.header_depth+=1
-        lines=[]
-        lines.append(u'<DIV DEPTH="'+str(header_depth+1)+'">')
-        lines.append(u"<HEADER ID='H-1'>%s</HEADER>" % (escapeText(section["header"])))
+        out.write(u'<DIV DEPTH="'+str(header_depth+1)+'">')
+        out.write(u"<HEADER ID='H-1'>%s</HEADER>" % (escapeText(section["header"])))
+        element_by_id=doc.element_by_id
         for element in section["content"]:
-            element=doc.element_by_id[element]
+            element=element_by_id[element]
             if element["type"]=="section":
-                lines.extend(self.writeSection(doc,element, header_depth))
+                self.writeSection(doc,element, header_depth, out)
             elif element["type"]=="p":
-                lines.extend(self.writeParagraph(doc,element))
+                self.writeParagraph(doc,element, out)
 
-        lines.append(u"</DIV>")
+        out.write(u"</DIV>")
         self.header_depth-=1
-        return lines
 
-    def writeBody(self, doc):
+    def writeBody(self, doc, out):
         """
         """
-        lines=[]
-        lines.append(u"<BODY>")
+        out.write(u"<BODY>")
         for section in doc.allsections:
             if section != doc.abstract:
-                lines.extend(self.writeSection(doc,section,0))
-        lines.append(u"</BODY>")
-        return lines
+                self.writeSection(doc,section,0, out)
+        out.write(u"</BODY>")
 
     def writeRefAuthor(self, doc,author):
         """
+            Returns the <AUTHOR> element of a reference's author as a string
         """
-        lines=[]
-        lines.append(u"<AUTHOR>")
         if isinstance(author,six.string_types):
-            lines.append(escapeText(author))
+            return u"<AUTHOR>%s</AUTHOR>" % escapeText(author)
         elif isinstance(author,dict):
-            lines.append(escapeText(author.get("given","")))
-            lines.append(u"<SURNAME>%s</SURNAME>" % escapeText(author.get("family","")))
-        lines.append(u"</AUTHOR>")
-        return lines
+            return u"<AUTHOR>%s<SURNAME>%s</SURNAME></AUTHOR>" % (escapeText(author.get("given","")),
+                                                                escapeText(author.get("family","")))
+        return u"<AUTHOR></AUTHOR>"
 
     def writeRefAuthors(self, doc, ref):
         """
+            Returns the <AUTHORLIST> of a reference as a string
         """
-        lines=[]
-        lines.append("<AUTHORLIST>")
-        for author in ref["authors"]:
-            lines.extend(self.writeRefAuthor(doc,author))
-        lines.append("</AUTHORLIST>")
-        return lines
-
-    def writeReference(self, doc, ref):
+        return u"<AUTHORLIST>%s</AUTHORLIST>" % u"".join([self.writeRefAuthor(doc,author) for author in ref["authors"]])
+
+    def writeReference(self, doc, ref, out):
         """
         <REFERENCE ID="cit1">
         <AUTHORLIST>
@@ -213,52 +225,44 @@ class SciXMLWriter(BaseSciDocXMLWriter):
         <TITLE></TITLE>
         <JOURNAL>Chem. Rev.<YEAR>1996</YEAR>962607-2624</JOURNAL></REFERENCE>
         """
-        lines=[]
-        lines.append('<REFERENCE ID="%s">' % ref["id"])
-        lines.extend(self.writeRefAuthors(doc,ref))
-        lines.append("<TITLE>%s</TITLE>" % escapeText(ref["title"]))
-        lines.append("<YEAR>%s</YEAR>" % escapeText(ref.get("year","????")))
         if "journal" in ref:
-            lines.append("<JOURNAL>%s</JOURNAL>" % escapeText(ref["journal"]))
-        lines.append("</REFERENCE>")
-        return lines
+            journal=u"<JOURNAL>%s</JOURNAL>" % escapeText(ref["journal"])
+        else:
+            journal=u""
+        # the whole reference in a single string
+        out.write(u'<REFERENCE ID="%s">%s<TITLE>%s</TITLE><YEAR>%s</YEAR>%s</REFERENCE>' % (
+            ref["id"], self.writeRefAuthors(doc,ref), escapeText(ref["title"]),
+            escapeText(ref.get("year","????")), journal))
 
-    def writeReferences(self, doc):
+    def writeReferences(self, doc, out):
         """
         """
-        lines=[]
-        lines.append("<REFERENCELIST>")
+        out.write("<REFERENCELIST>")
         for ref in doc.data["references"]:
-            lines.extend(self.writeReference(doc, ref))
-        lines.append("</REFERENCELIST>")
-        return lines
+            self.writeReference(doc, ref, out)
+        out.write("</REFERENCELIST>")
 
     def write(self, doc, filename):
         """
+            Writes the SciXML of the document to the file. Every write*()
+            method writes its part of the XML to out as it goes.
         """
-        self.already_rendered=[]
-        lines=[]
-        lines.append('<?xml version="1.0" encoding="UTF-8"?>')
-        lines.append('<!DOCTYPE PAPER SYSTEM "paper-structure-annotation.dtd">')
-
-        lines.append("<PAPER>")
-        lines.extend(self.writeMetadata(doc))
-        lines.extend(self.writeAbstract(doc))
-        lines.extend(self.writeBody(doc))
-        lines.extend(self.writeReferences(doc))
-        lines.append("</PAPER>")
-
-        lines2=[]
-        for line in lines:
-            lines2.append(safe_unicode(line))
-
-        lines=lines2
-    ##    text="\n".join(lines)
-        f=codecs.open(filename,"w", encoding="utf-8",errors="ignore")
-    ##    f.writelines([line+"\n" for line in lines])
-        f.writelines(lines)
-        f.close()
-    ##    return text
+        self.already_rendered=set()
+        out=six.StringIO()
+        out.write('<?xml version="1.0" encoding="UTF-8"?>')
+        out.write('<!DOCTYPE PAPER SYSTEM "paper-structure-annotation.dtd">')
+
+        out.write("<PAPER>")
+        self.writeMetadata(doc, out)
+        self.writeAbstract(doc, out)
+        self.writeBody(doc, out)
+        self.writeReferences(doc, out)
+        out.write("</PAPER>")
+
+        # newline="" so "\n" is written as it is on every platform, as codecs.open() did
+        with io.open(filename,"w", encoding="utf-8", errors="ignore", newline="",
+                     buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(out.getvalue())
 
 def saveSciXML(doc,filename):
     """
@@ -267,6 +271,38 @@ def saveSciXML(doc,filename):
     writer=SciXMLWriter()
     writer.write(doc, filename)
 
+def saveSciXMLFromJSON(args):
+    """
+        Loads a SciDoc JSON file and saves it as SciXML, in a worker process
+
+        :param args: tuple (path of the JSON file, output directory)
+        :returns: path of the SciXML file
+    """
+    from scidoc import SciDoc
+
+    json_path, out_dir=args
+    doc=SciDoc(json_path)
+    filename=os.path.join(out_dir, os.path.splitext(os.path.basename(json_path))[0]+".xml")
+    saveSciXML(doc, filename)
+    return filename
+
+def saveSciXMLBatch(json_paths, out_dir, num_processes=None):
+    """
+        Saves many SciDoc JSON files as SciXML in out_dir, in parallel across
+        processes. The paths are handed to the processes rather than the
+        SciDocs, which would have to be pickled.
+
+        :param num_processes: defaults to the number of CPUs
+        :returns: list of paths of the SciXML files
+    """
+    pool=multiprocessing.Pool(processes=num_processes or multiprocessing.cpu_count())
+    try:
+        return list(pool.imap(saveSciXMLFromJSON, [(path, out_dir) for path in json_paths],
+                              chunksize=BATCH_CHUNK_SIZE))
+    finally:
+        pool.close()
+        pool.join()
+
 def basicTest():
     """
     """
@@ -274,7 +310,7 @@ def basicTest():
     from scidoc import SciDoc
 
 ##    doc=loadAZSciXML(r"C:\NLP\PhD\bob\fileDB\jsonDocs\a00-1001.json")
-    saveSciXML(doc,r"C:\NLP\PhD\bob\output\\"+doc["metadata"]["filename"]+".xml")
+    saveSciXML(doc,r"C:\NLP\PhD\bob\output\\"+doc.metadata["filename"]+".xml")
     pass
 
 def main():
@@ -75,14 +75,11 @@ def update_papers():
 
 def update_cache_yield(index="cache"):
     # manually update /cache
-    total_files = None
-
-    for batch, scroll_size in c1.yieldingUnlimitedQuery(body={"query": {"match_all": {}}}, _source=False,
-                                                        index=index):
-        if total_files is None:
-            total_files = scroll_size
-            pbar = tqdm(range(scroll_size), desc="Uploading cached BOWs")
+    query = {"query": {"match_all": {}}}
+    total_files = c1.es.count(index=index, body=query)["count"]
+    pbar = tqdm(range(total_files), desc="Uploading cached BOWs")
 
+    for batch in c1.yieldingUnlimitedQuery(body=query, _source=False, index=index):
         for path in batch:
             path = path["_id"]
             if not c2.es.exists(index="cache", doc_type="cache", id=path):
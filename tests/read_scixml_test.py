@@ -0,0 +1,104 @@
+# Tests for SciXMLReader on a small SciXML document
+#
+# Copyright:   (c) Daniel Duma 2016
+# Author: Daniel Duma <danielduma@gmail.com>
+
+# For license information, see LICENSE.TXT
+
+from __future__ import absolute_import
+from __future__ import print_function
+import db.corpora as cp
+
+SCIXML_FIXTURE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<PAPER>
+<METADATA><FILENO>A00-1001</FILENO><TITLE>A\tTest Paper</TITLE><AUTHORS><AUTHOR>John\tSmith</AUTHOR></AUTHORS><YEAR>2000</YEAR></METADATA>
+<TITLE>A Test Paper</TITLE>
+<ABSTRACT><A-S ID="A-0" AZ="AIM">We do things &amp; stuff.</A-S></ABSTRACT>
+<BODY>
+<DIV DEPTH="1"><HEADER ID="H-0">1 Introduction</HEADER>
+<P><S ID="S-0" AZ="BKG">As shown by <REF ID="R-0" REFID="1"><REFAUTHOR>Lee</REFAUTHOR> and <REFAUTHOR>Ray</REFAUTHOR> (<DATE>1999</DATE>)</REF> it works.</S>
+<S ID="S-1">Also <REF REFID="?">Brown et al. 2003</REF> and more.</S></P>
+</DIV>
+</BODY>
+<REFERENCELIST>
+<REFERENCE ID="1"><AUTHOR><SURNAME>Lee</SURNAME>, J.</AUTHOR> and <AUTHOR><SURNAME>Ray</SURNAME>, K.</AUTHOR> <DATE>1999</DATE>. Some title.</REFERENCE>
+<REFERENCE ID="2">Journal of Things, vol. 3.</REFERENCE>
+<REFERENCE ID="3"><AUTHOR><SURNAME>Brown</SURNAME>, A.</AUTHOR> <DATE>2003</DATE>. Another paper.</REFERENCE>
+</REFERENCELIST>
+</PAPER>
+"""
+
+
+class FixtureCorpus(object):
+    """
+        Just what SciXMLReader needs of the corpus. The paper isn't in the
+        metadata index, so the metadata is loaded from the file itself.
+    """
+    metadata_index = {}
+
+    def getFileUID(self, filename):
+        return filename
+
+    def generateGUID(self, metadata=None):
+        return "fixture-guid"
+
+
+def readFixture():
+    """
+        Reads SCIXML_FIXTURE with FixtureCorpus as the corpus
+    """
+    from scidoc.xmlformats.read_scixml import SciXMLReader
+
+    old_corpus=cp.Corpus
+    cp.Corpus=FixtureCorpus()
+    try:
+        return SciXMLReader().read(SCIXML_FIXTURE, "fixture.xml")
+    finally:
+        cp.Corpus=old_corpus
+
+
+def testReadSciXML():
+    """
+        Loads the references, fuses the one without authors or date into the
+        previous one, matches citations by refid and by BOW and leaves a
+        placeholder for each citation in the text
+    """
+    doc=readFixture()
+
+    # metadata from the file: authors as dicts, tabs sanitized
+    metadata=doc["metadata"]
+    assert metadata["title"] == "A Test Paper"
+    assert metadata["year"] == "2000"
+    assert metadata["authors"][0]["family"] == "Smith"
+    assert metadata["authors"][0]["given"] == "John"
+
+    # reference "2" is just the rest of reference "1", so fuseReferences() joins them
+    references=doc["references"]
+    assert [ref["original_id"] for ref in references] == ["1", "3"]
+    assert metadata["ref_replace_list"] == {"2": references[0]["id"]}
+    assert references[0]["text"].endswith("Journal of Things, vol. 3.")
+    assert references[0]["surnames"] == ["Lee", "Ray"]
+    assert references[0]["year"] == "1999"
+    assert references[1]["surnames"] == ["Brown"]
+    assert references[1]["year"] == "2003"
+
+    # the first citation is matched by its refid, the second by the words in it
+    citations=doc["citations"]
+    assert len(citations) == 2
+    assert citations[0]["ref_id"] == references[0]["id"]
+    assert citations[1]["ref_id"] == references[1]["id"]
+    assert references[0]["citations"] == [citations[0]["id"]]
+    assert references[1]["citations"] == [citations[1]["id"]]
+
+    texts=[sentence["text"] for sentence in doc.allsentences]
+    assert texts == ["We do things & stuff.",
+                     "As shown by  <CIT ID=%s /> it works." % citations[0]["id"],
+                     "Also  <CIT ID=%s /> and more." % citations[1]["id"]]
+
+
+def main():
+    testReadSciXML()
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -88,8 +88,169 @@ def testExplanation():
     # from evaluation.best_keyword_selection import getFormulaTermWeights
     # print((get({"match_guids":doc_ids[0],"formulas":[{"guid":doc_ids[0],"formula":formula.formula}]})))
 
+def testBatchScores():
+    """
+        StoredFormulaBatch must give the same scores as StoredFormula.computeScore()
+        for hits with no term (3- and 6-tuples) and with a term (7-tuples)
+    """
+    from retrieval.stored_formula import StoredFormula, StoredFormulaBatch
+
+    hits3=[("title", 0.5, 1.25), ("abstract", 2.0, 0.75)]
+    hits6=[("title", 0.5, 1.25, 3, 10, 1000), ("abstract", 2.0, 0.75, 1, 20, 1000)]
+    hits7=[("title", 0.5, 1.25, 3, 10, 1000, "autism"), ("abstract", 2.0, 0.75, 1, 20, 1000, "genes")]
+
+    field_parameters={"title": 3, "abstract": 0.5}
+    kw_parameters={"autism": 2, "genes": 0.25}
+
+    for hits in [hits3, hits6, hits7]:
+        formulas=[{"type": "+", "parts": hits}, hits[0]]
+        batch=StoredFormulaBatch(formulas)
+        # all of them must go through the vectorized path
+        assert batch.other_formulas == []
+
+        parameter_sets=[(None, None), (field_parameters, None)]
+        if hits is hits7:
+            parameter_sets.append((field_parameters, kw_parameters))
+
+        for fields, keywords in parameter_sets:
+            batch_scores=batch.computeScores(fields, keywords)
+            for formula, batch_score in zip(formulas, batch_scores):
+                score=StoredFormula(formula).computeScore(formula, fields, keywords)
+                assert abs(batch_score - score) < 1e-9, (formula, batch_score, score)
+
+
+LINEARIZED_FIELDS=["title", "abstract", "Bac", "Met", "Res"]
+
+
+def randomLinearFormula(rnd):
+    """
+        A sum of hits, sometimes multiplied by a coord. The values are small
+        multiples of 0.25, so float32 and float64 scores are exactly the same
+        and ties are ranked the same way by every path.
+    """
+    hits=[(rnd.choice(LINEARIZED_FIELDS), rnd.randint(1, 8) * 0.25, rnd.randint(1, 8) * 0.25)
+          for _ in range(rnd.randint(1, 4))]
+    formula={"type": "+", "parts": hits}
+    if rnd.random() < 0.5:
+        formula={"type": "*", "parts": [formula, {"type": "coord", "value": 0.5}]}
+    return formula
+
+
+def randomPrecomputedResult(rnd, num_docs, linear=True, duplicate_guids=False, num_matches=1):
+    """
+        A precomputed result as read by WeightTrainer: the formula of every
+        retrieved document and the guids of the correct ones. Some of these may
+        not have been retrieved.
+    """
+    guids=["doc%d" % index for index in range(num_docs)]
+    if duplicate_guids:
+        guids[-1]=guids[0]
+
+    formulas=[]
+    for guid in guids:
+        formula=randomLinearFormula(rnd)
+        if not linear:
+            # the max of two parts that depend on the weights isn't linear
+            formula={"type": "max", "parts": [formula, randomLinearFormula(rnd)]}
+        formulas.append({"guid": guid, "formula": formula})
+
+    match_guids=rnd.sample(guids + ["not_retrieved"], num_matches)
+    return {"formulas": formulas, "match_guids": match_guids, "query_method": "window"}
+
+
+def referenceRanking(result, parameters):
+    """
+        Ranks the documents of a precomputed result the way WeightTrainer did
+        before the linearized results: computeScore() for every formula, sorted
+    """
+    from retrieval.stored_formula import StoredFormula
+
+    scores=[(StoredFormula(f["formula"]).computeScore(f["formula"], parameters), f["guid"])
+            for f in result["formulas"]]
+    scores.sort(key=lambda x:x[0], reverse=True)
+    return scores
+
+
+def referenceScores(result, parameters):
+    """
+        measureScores() of referenceRanking()
+    """
+    from proc.results_logging import measureScores
+
+    ranking=referenceRanking(result, parameters)
+    return measureScores([guid for score, guid in ranking], result["match_guids"], {})
+
+
+def testLinearizedScores():
+    """
+        The scoring kernel and the incremental updates of prepareLinearizedResults()
+        must give the same MRR, NDCG, precision and rank as computeScore() and
+        measureScores(), in float64 and float32
+    """
+    import random
+    import numpy
+    from proc.results_logging import measureScores
+    from evaluation.weight_functions import (prepareLinearizedResults, setLinearizedScores,
+                                             applyWeightDelta, rankPreparedResult)
+    from evaluation.weight_kernels import scoreLinearizedResults
+
+    rnd=random.Random(1234)
+    results=[randomPrecomputedResult(rnd, rnd.randint(1, 12), num_matches=rnd.randint(1, 3))
+             for _ in range(50)]
+    # none of the correct documents retrieved
+    results.append(randomPrecomputedResult(rnd, 5, num_matches=1))
+    results[-1]["match_guids"]=["not_retrieved"]
+
+    for dtype in [numpy.float64, numpy.float32]:
+        prepared=prepareLinearizedResults(results, dtype)
+        assert prepared["kernel_ready"]
+
+        parameters={field: 1 for field in LINEARIZED_FIELDS}
+        setLinearizedScores(prepared, parameters)
+        for field, delta in [("title", 3), ("Met", -1), ("Res", 6), ("title", -2)]:
+            applyWeightDelta(prepared, field, delta)
+            parameters[field] += delta
+
+            mrr, ndcg, precision, rank=scoreLinearizedResults(prepared["scores"],
+                                                              prepared["starts"],
+                                                              prepared["ends"],
+                                                              prepared["targets"],
+                                                              prepared["target_starts"],
+                                                              prepared["target_ends"],
+                                                              prepared["num_matches"])
+            for index, (entry, result) in enumerate(zip(prepared["results"], results)):
+                expected=referenceScores(result, parameters)
+                assert abs(mrr[index] - expected["mrr_score"]) < 1e-9, (dtype, index)
+                assert abs(ndcg[index] - expected["ndcg_score"]) < 1e-9, (dtype, index)
+                assert abs(precision[index] - expected["precision_score"]) < 1e-9, (dtype, index)
+                assert rank[index] == expected["rank"], (dtype, index)
+
+                ranked=rankPreparedResult(prepared, entry, parameters)
+                assert [doc["guid"] for score, doc in ranked] == \
+                    [guid for score, guid in referenceRanking(result, parameters)]
+
+    # duplicate guids, no correct documents at all or formulas that aren't
+    # linear can't go through the kernel, only through rankPreparedResult()
+    for result in [randomPrecomputedResult(rnd, 6, duplicate_guids=True),
+                   randomPrecomputedResult(rnd, 6, num_matches=0),
+                   randomPrecomputedResult(rnd, 6, linear=False)]:
+        prepared=prepareLinearizedResults([result])
+        assert not prepared["kernel_ready"]
+
+        parameters={field: rnd.randint(0, 5) for field in LINEARIZED_FIELDS}
+        setLinearizedScores(prepared, parameters)
+        ranked=rankPreparedResult(prepared, prepared["results"][0], parameters)
+        expected=referenceRanking(result, parameters)
+        assert [doc["guid"] for score, doc in ranked] == [guid for score, guid in expected]
+        assert [float(score) for score, doc in ranked] == [score for score, guid in expected]
+        if result["match_guids"]:
+            assert measureScores([doc["guid"] for score, doc in ranked], result["match_guids"], {}) == \
+                referenceScores(result, parameters)
+
 
 def main():
+    testBatchScores()
+    testLinearizedScores()
     connectToElastic()
     testExplanation()
     pass